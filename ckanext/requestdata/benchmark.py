@@ -0,0 +1,438 @@
+import os
+import time
+import random
+import binascii
+import logging
+import datetime
+import contextlib
+
+from sqlalchemy import event
+
+from ckan import model
+from ckan.model.types import make_uuid
+from ckan.plugins import toolkit
+
+from ckanext.requestdata import model as requestdata_model
+
+log = logging.getLogger(__name__)
+
+STATES = ['new', 'open', 'archive']
+
+
+class QueryCounter(object):
+    '''Counts the statements executed by the CKAN database engine while it
+    is listening, see ``counting``.'''
+
+    def __init__(self, engine=None):
+        self.engine = engine or model.meta.engine
+        self.count = 0
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        self.count += 1
+
+    @contextlib.contextmanager
+    def counting(self):
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        try:
+            yield self
+        finally:
+            event.remove(self.engine, 'before_cursor_execute',
+                         self._before_cursor_execute)
+
+
+def generate(organizations=10, packages=20, maintainers=5, requests=10,
+             seed=0):
+    '''Creates organizations with datasets, maintainers and requests to
+    benchmark against. The rows are inserted in bulk, bypassing the
+    actions, so large data sets are created quickly.
+
+    The names of everything created are prefixed with a random run id, so
+    the data of several runs can live in the same database, and it can be
+    removed with ``cleanup``. Only run it against a database that can be
+    thrown away.
+
+    :param organizations: Number of organizations.
+    :type organizations: int
+    :param packages: Number of datasets per organization.
+    :type packages: int
+    :param maintainers: Number of maintainers per organization, at least
+        one. Each dataset gets one to three of them.
+    :type maintainers: int
+    :param requests: Number of requests per dataset.
+    :type requests: int
+    :param seed: Seed of the random states and dates of the requests.
+    :type seed: int
+
+    :returns: the run id (``prefix``), the ``sysadmin`` name and id
+        (``sender_id``), the ``organization`` name and a ``maintainer`` name
+        of that organization to run the benchmarks as
+    :rtype: dictionary
+    '''
+
+    rng = random.Random(seed)
+    prefix = u'bench-{0}'.format(make_uuid()[:8])
+    now = datetime.datetime.now()
+
+    model.repo.new_revision()
+
+    # The users can't be logged in to, their passwords are random and
+    # never shown
+    sysadmin = model.User(name=u'{0}-sysadmin'.format(prefix),
+                          email=u'{0}-sysadmin@example.com'.format(prefix),
+                          password=_random_password(), sysadmin=True)
+    model.Session.add(sysadmin)
+    model.Session.flush()
+
+    out = {
+        'prefix': prefix,
+        'sysadmin': sysadmin.name,
+        'sender_id': sysadmin.id,
+        'organization': u'{0}-org-0'.format(prefix),
+        'maintainer': u'{0}-maintainer-0-0'.format(prefix)
+    }
+    org_users = {}
+    package_rows = []
+
+    for i in range(organizations):
+        org = model.Group(name=u'{0}-org-{1}'.format(prefix, i),
+                          title=u'Benchmark organization {0}'.format(i),
+                          type='organization', is_organization=True)
+        model.Session.add(org)
+        model.Session.flush()
+        org_users[org.id] = []
+
+        for j in range(maintainers):
+            user = model.User(
+                name=u'{0}-maintainer-{1}-{2}'.format(prefix, i, j),
+                email=u'{0}-maintainer-{1}-{2}@example.com'
+                .format(prefix, i, j),
+                password=_random_password())
+            model.Session.add(user)
+            model.Session.flush()
+            model.Session.add(model.Member(table_name='user',
+                                           table_id=user.id,
+                                           group_id=org.id,
+                                           capacity='editor',
+                                           state='active'))
+            org_users[org.id].append({'id': user.id, 'email': user.email})
+
+        for j in range(packages):
+            candidates = org_users[org.id]
+            package_maintainers = rng.sample(
+                candidates, min(len(candidates), rng.randint(1, 3)))
+
+            if j == 0 and candidates[0] not in package_maintainers:
+                # The maintainer the benchmarks run as has requests
+                package_maintainers[0] = candidates[0]
+            package = model.Package(
+                name=u'{0}-dataset-{1}-{2}'.format(prefix, i, j),
+                title=u'Benchmark dataset {0} {1}'.format(i, j),
+                owner_org=org.id,
+                maintainer=u','.join(user['id'] for user in
+                                     package_maintainers))
+            model.Session.add(package)
+            model.Session.flush()
+            package_rows.append(({
+                'id': package.id,
+                'name': package.name,
+                'title': package.title,
+                'owner_org': package.owner_org,
+                'maintainer': package.maintainer
+            }, package_maintainers))
+
+    model.repo.commit_and_remove()
+
+    _generate_requests(rng, package_rows, requests, now, out['sender_id'])
+
+    return out
+
+
+def cleanup(prefix):
+    '''Removes the data created by ``generate``: the requests and their
+    maintainers, counters and statistics, then the datasets, organizations
+    and users.
+
+    :param prefix: The run id, see ``generate``.
+    :type prefix: string
+
+    :returns: the number of requests removed
+    :rtype: int
+    '''
+
+    pattern = u'{0}-%'.format(prefix)
+    package_ids = [row[0] for row in model.Session.query(model.Package.id)
+                   .filter(model.Package.name.like(pattern))]
+    org_ids = [row[0] for row in model.Session.query(model.Group.id)
+               .filter(model.Group.name.like(pattern))]
+    request_ids = [row[0] for row in model.Session.query(
+        requestdata_model.request_data_table.c.id)
+        .filter(requestdata_model.request_data_table.c.package_id
+                .in_(package_ids))] if package_ids else []
+
+    for table, column, ids in [
+            (requestdata_model.maintainers_table, 'request_data_id',
+             request_ids),
+            (requestdata_model.request_data_table, 'id', request_ids),
+            (requestdata_model.request_packages_table, 'package_id',
+             package_ids),
+            (requestdata_model.request_data_counters_table, 'package_id',
+             package_ids),
+            (requestdata_model.organization_stats_table, 'org_id',
+             org_ids)]:
+        if ids:
+            model.Session.execute(table.delete()
+                                  .where(table.c[column].in_(ids)))
+
+    model.Session.commit()
+
+    context = {'model': model, 'session': model.Session,
+               'ignore_auth': True}
+
+    for package_id in package_ids:
+        toolkit.get_action('dataset_purge')(dict(context),
+                                            {'id': package_id})
+
+    for org_id in org_ids:
+        toolkit.get_action('organization_purge')(dict(context),
+                                                 {'id': org_id})
+
+    for user in model.Session.query(model.User)\
+            .filter(model.User.name.like(pattern)):
+        model.Session.query(model.Member)\
+            .filter(model.Member.table_name == 'user')\
+            .filter(model.Member.table_id == user.id)\
+            .delete(synchronize_session=False)
+        model.Session.delete(user)
+
+    model.Session.commit()
+
+    log.info('Removed %s requests and %s datasets.', len(request_ids),
+             len(package_ids))
+
+    return len(request_ids)
+
+
+def _random_password():
+    return unicode(binascii.hexlify(os.urandom(32)))
+
+
+def _generate_requests(rng, package_rows, requests, now, sender_id):
+    request_rows = []
+    maintainer_rows = []
+    projection_rows = []
+    counter_rows = []
+    stats = {}
+
+    for package, package_maintainers in package_rows:
+        counters = dict((column, 0) for column in
+                        requestdata_model.COUNTER_COLUMNS)
+        org_stats = stats.setdefault(package['owner_org'], dict(
+            [(column, 0) for column in requestdata_model.STATS_COLUMNS],
+            org_id=package['owner_org'], last_request_at=None))
+
+        projection_rows.append({
+            'package_id': package['id'],
+            'name': package['name'],
+            'title': package['title'],
+            'owner_org': package['owner_org'],
+            'maintainer': package['maintainer'],
+            'state': 'active',
+            'modified_at': now
+        })
+
+        for i in range(requests):
+            state = rng.choice(STATES)
+            created_at = now - datetime.timedelta(
+                minutes=rng.randint(0, 60 * 24 * 365))
+            shared = state == 'archive' and rng.random() < 0.5
+            rejected = state == 'archive' and not shared and \
+                rng.random() < 0.5
+            request_id = make_uuid()
+
+            request_rows.append({
+                'id': request_id,
+                'sender_name': u'Benchmark sender',
+                'sender_user_id': sender_id,
+                'organization': u'Benchmark',
+                'email_address': u'sender@example.com',
+                'message_content': u'I want the data.',
+                'package_id': package['id'],
+                'state': state,
+                'data_shared': shared,
+                'rejected': rejected,
+                'created_at': created_at,
+                'modified_at': created_at
+            })
+
+            for user in package_maintainers:
+                maintainer_rows.append({
+                    'id': make_uuid(),
+                    'request_data_id': request_id,
+                    'maintainer_id': user['id'],
+                    'email': user['email']
+                })
+
+            counters['requests'] += 1
+            if state == 'archive':
+                counters['declined' if rejected else 'replied'] += 1
+            if shared:
+                counters['shared'] += 1
+
+            org_stats[requestdata_model.STATE_COLUMNS[state]] += 1
+            if org_stats['last_request_at'] is None or \
+                    created_at > org_stats['last_request_at']:
+                org_stats['last_request_at'] = created_at
+
+        for column, value in counters.items():
+            org_stats[column] += value
+
+        counter_rows.append(dict(counters, id=make_uuid(),
+                                 package_id=package['id'],
+                                 org_id=package['owner_org']))
+
+    for table, rows in [
+            (requestdata_model.request_data_table, request_rows),
+            (requestdata_model.maintainers_table, maintainer_rows),
+            (requestdata_model.request_packages_table, projection_rows),
+            (requestdata_model.request_data_counters_table, counter_rows),
+            (requestdata_model.organization_stats_table, stats.values())]:
+        if rows:
+            model.Session.execute(table.insert(), list(rows))
+
+    model.Session.commit()
+
+    log.info('Generated %s requests for %s datasets.', len(request_rows),
+             len(package_rows))
+
+
+def benchmarks(data, app=None):
+    '''Returns the benchmarks to run for the generated data, as
+    ``(name, function)`` pairs.
+
+    :param data: The data returned by ``generate``.
+    :type data: dictionary
+    :param app: A test app to request the dashboards with (optional), the
+        dashboards are skipped without it.
+    :type app: webtest.TestApp
+    '''
+
+    sysadmin = data['sysadmin']
+    org = data['organization']
+    maintainer = data['maintainer']
+
+    def action(name, user, **data_dict):
+        def call():
+            context = {'model': model, 'session': model.Session,
+                       'user': user}
+            return toolkit.get_action(name)(context, data_dict)
+        return call
+
+    def page(url, user):
+        def call():
+            return app.get(url, extra_environ={'REMOTE_USER': str(user)})
+        return call
+
+    out = [
+        ('request_list_for_sysadmin',
+         action('requestdata_request_list_for_sysadmin', sysadmin)),
+        ('request_list_for_sysadmin (limit=50)',
+         action('requestdata_request_list_for_sysadmin', sysadmin,
+                limit=50)),
+        ('request_list_for_organization',
+         action('requestdata_request_list_for_organization', sysadmin,
+                org_id=org)),
+        ('request_list_for_current_user',
+         action('requestdata_request_list_for_current_user', maintainer)),
+        ('request_archive_for_organization',
+         action('requestdata_request_archive_for_organization', sysadmin,
+                org_id=org, limit=20)),
+        ('request_count_by_maintainer',
+         action('requestdata_request_count_by_maintainer', sysadmin,
+                org_id=org)),
+        ('request_data_counters_get_all',
+         action('requestdata_request_data_counters_get_all', sysadmin)),
+        ('request_data_counters_get_by_org',
+         action('requestdata_request_data_counters_get_by_org', sysadmin,
+                org_id=model.Group.get(org).id)),
+        ('request_data_counters_get_all_by_org',
+         action('requestdata_request_data_counters_get_all_by_org',
+                sysadmin)),
+        ('organization_stats',
+         action('requestdata_organization_stats', sysadmin))
+    ]
+
+    if app is not None:
+        out.extend([
+            ('admin dashboard',
+             page('/ckan-admin/requests_data', sysadmin)),
+            ('organization dashboard',
+             page('/organization/requested_data/' + org, sysadmin)),
+            ('user dashboard',
+             page('/user/my_requested_data/' + maintainer, maintainer))
+        ])
+
+    return out
+
+
+def run(data, repeat=5, app=None):
+    '''Times the benchmarks and counts their queries.
+
+    :param data: The data returned by ``generate``.
+    :type data: dictionary
+    :param repeat: Number of timed calls of each benchmark, after one call
+        to warm up.
+    :type repeat: int
+    :param app: See ``benchmarks``.
+    :type app: webtest.TestApp
+
+    :returns: the ``name``, the ``mean``, ``min`` and ``max`` duration in
+        milliseconds and the ``queries`` per call of each benchmark
+    :rtype: list of dictionaries
+    '''
+
+    counter = QueryCounter()
+    results = []
+
+    for name, call in benchmarks(data, app=app):
+        call()
+        model.Session.remove()
+
+        durations = []
+
+        with counter.counting():
+            for i in range(repeat):
+                start = time.time()
+                call()
+                durations.append((time.time() - start) * 1000)
+                model.Session.remove()
+
+        queries = counter.count
+        counter.count = 0
+
+        results.append({
+            'name': name,
+            'mean': sum(durations) / len(durations),
+            'min': min(durations),
+            'max': max(durations),
+            'queries': queries / float(repeat)
+        })
+
+    return results
+
+
+def format_results(results):
+    '''Formats the results of ``run`` as a table.
+
+    :rtype: string
+    '''
+
+    lines = ['{0:<40} {1:>10} {2:>10} {3:>10} {4:>8}'.format(
+        'benchmark', 'mean ms', 'min ms', 'max ms', 'queries')]
+
+    for result in results:
+        lines.append('{name:<40} {mean:>10.1f} {min:>10.1f} {max:>10.1f} '
+                     '{queries:>8.1f}'.format(**result))
+
+    return '\n'.join(lines)
@@ -0,0 +1,219 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from paste.deploy.converters import asint
+
+from ckan import model, logic
+from ckan.common import c
+from ckan.plugins import toolkit
+
+from ckanext.requestdata import metrics
+
+try:
+    # CKAN 2.7 and later
+    from ckan.common import config
+except ImportError:
+    # CKAN 2.6 and earlier
+    from pylons import config
+
+log = logging.getLogger(__name__)
+
+NotFound = logic.NotFound
+
+
+class RequestLookupCache(object):
+    '''Memoizes the results of side effect free actions, e.g.
+    ``package_show`` or ``user_show``, for the lifetime of one HTTP request.
+
+    ``NotFound`` errors are memoized too, so a missing dataset or user is
+    only looked up once.
+
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._results = {}
+
+    def get_action(self, action, data_dict):
+        key = (action, tuple(sorted(data_dict.items())))
+
+        if key in self._results:
+            self.hits += 1
+            metrics.cache_lookups.inc(cache='request_lookups', result='hit')
+        else:
+            self.misses += 1
+            metrics.cache_lookups.inc(cache='request_lookups', result='miss')
+
+            try:
+                result = toolkit.get_action(action)(_get_context(),
+                                                    data_dict)
+            except NotFound as e:
+                result = e
+
+            self._results[key] = result
+
+        result = self._results[key]
+
+        if isinstance(result, NotFound):
+            raise result
+
+        return result
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._results)
+        }
+
+
+class TTLCache(object):
+    '''Thread safe in-process cache whose entries expire ``ttl`` seconds
+    after they were set. Once it holds ``maxsize`` entries the least
+    recently used one is evicted.
+
+    Every worker process has its own cache, so a value changed by another
+    process is seen at the latest when it expires.
+
+    The hits and misses of a cache with a ``name`` are counted in the
+    ``requestdata_cache_lookups_total`` metric.
+
+    '''
+
+    def __init__(self, maxsize, ttl, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is not None and entry[1] >= time.time():
+                # Reinsert the entry as the most recently used
+                self._entries[key] = entry
+            else:
+                entry = None
+
+        if self.name is not None:
+            metrics.cache_lookups.inc(
+                cache=self.name, result='miss' if entry is None else 'hit')
+
+        return default if entry is None else entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+
+            while len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False)
+
+            self._entries[key] = (value, time.time() + self.ttl)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Whether users have seen their latest notification, checked in the header
+# of every page
+notification_flags = TTLCache(
+    asint(config.get('ckanext.requestdata.notification_cache_size', 10000)),
+    asint(config.get('ckanext.requestdata.notification_cache_ttl', 30)),
+    name='notification_flags')
+
+# The emails of the maintainers of the datasets, keyed by user id or name,
+# shown on every dataset page
+maintainer_emails = TTLCache(
+    asint(config.get('ckanext.requestdata.maintainer_email_cache_size',
+                     10000)),
+    asint(config.get('ckanext.requestdata.maintainer_email_cache_ttl', 300)),
+    name='maintainer_emails')
+
+# The parsed maintainer fields of the datasets, keyed by the field's value,
+# so a changed field is parsed again
+maintainer_sets = TTLCache(1000, 60 * 60, name='maintainer_sets')
+
+
+def _get_context():
+    return {
+        'model': model,
+        'session': model.Session,
+        'user': c.user or c.author,
+        'auth_user_obj': c.userobj
+    }
+
+
+def request_lookups():
+    '''Returns the lookup cache of the current HTTP request, creating it on
+    first use.
+
+    :rtype: RequestLookupCache
+
+    '''
+
+    lookups = getattr(c, 'requestdata_lookups', None)
+
+    if not lookups:
+        lookups = RequestLookupCache()
+        c.requestdata_lookups = lookups
+
+    return lookups
+
+
+def current_user():
+    '''Returns the id and name of the logged in user, read from
+    ``c.userobj`` once per HTTP request.
+
+    :returns: the id and name, or ``None`` for anonymous users
+    :rtype: tuple
+
+    '''
+
+    user = getattr(c, 'requestdata_current_user', None)
+
+    if not user:
+        userobj = c.userobj if c.user else None
+        user = (userobj.id, userobj.name) if userobj else (None, None)
+        c.requestdata_current_user = user
+
+    return user if user[0] else None
+
+
+def maintainer_set(maintainers):
+    '''Returns the ids or names in a dataset's maintainer field as a set.
+
+    :param maintainers: The maintainer field, ids or names separated by
+        commas.
+    :type maintainers: string
+
+    :rtype: frozenset
+
+    '''
+
+    key = maintainers or ''
+    parsed = maintainer_sets.get(key)
+
+    if parsed is None:
+        parsed = frozenset(x.strip() for x in key.split(',') if x.strip())
+        maintainer_sets.set(key, parsed)
+
+    return parsed
+
+
+def log_lookup_stats(name):
+    '''Logs the hits and misses of the current request's lookup cache.'''
+
+    stats = request_lookups().stats()
+
+    log.debug('%s lookups: %s hits, %s misses.', name, stats['hits'],
+              stats['misses'])
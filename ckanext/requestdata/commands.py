@@ -0,0 +1,161 @@
+import sys
+import time
+
+from ckan.lib.cli import CkanCommand
+
+
+class RequestdataCommand(CkanCommand):
+    '''Management commands for the requestdata extension
+
+    Usage:
+
+        paster requestdata upgrade-db -c <path to config file>
+            - Apply the pending schema migrations of the requestdata tables
+
+        paster requestdata db-version -c <path to config file>
+            - Show the applied schema version of the requestdata tables
+
+        paster requestdata send-emails [--watch] [--interval=N]
+                                       -c <path to config file>
+            - Deliver the queued emails that are due. With --watch keep
+              polling the outbox every N seconds (default 10)
+
+        paster requestdata benchmark --yes [--organizations=N]
+                                     [--packages=N] [--maintainers=N]
+                                     [--requests=N] [--repeat=N] [--keep]
+                                     -c <path to config file>
+            - Generate organizations with N datasets each, N maintainers
+              each and N requests per dataset, then time the request
+              actions and dashboards and count their queries. The data is
+              written to the configured database, --yes confirms that it
+              can be thrown away. The generated data is removed afterwards
+              unless --keep is given
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def __init__(self, name):
+        super(RequestdataCommand, self).__init__(name)
+
+        self.parser.add_option('--watch', dest='watch', action='store_true',
+                               default=False,
+                               help='Keep delivering the queued emails')
+        self.parser.add_option('--interval', dest='interval', type='int',
+                               default=10,
+                               help='Seconds between polls of the outbox')
+        self.parser.add_option('--organizations', dest='organizations',
+                               type='int', default=10,
+                               help='Number of organizations to generate')
+        self.parser.add_option('--packages', dest='packages', type='int',
+                               default=20,
+                               help='Number of datasets per organization')
+        self.parser.add_option('--maintainers', dest='maintainers',
+                               type='int', default=5,
+                               help='Number of maintainers per organization')
+        self.parser.add_option('--requests', dest='requests', type='int',
+                               default=10,
+                               help='Number of requests per dataset')
+        self.parser.add_option('--repeat', dest='repeat', type='int',
+                               default=5,
+                               help='Number of timed calls per benchmark')
+        self.parser.add_option('--yes', dest='yes', action='store_true',
+                               default=False,
+                               help='Confirm that the benchmark data can be '
+                               'written to the configured database')
+        self.parser.add_option('--keep', dest='keep', action='store_true',
+                               default=False,
+                               help='Keep the generated benchmark data')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+
+        if cmd == 'upgrade-db':
+            self.upgrade_db()
+        elif cmd == 'db-version':
+            self.db_version()
+        elif cmd == 'send-emails':
+            self.send_emails()
+        elif cmd == 'benchmark':
+            self.benchmark()
+        else:
+            print self.usage
+            sys.exit(1)
+
+    def upgrade_db(self):
+        from ckanext.requestdata import migration
+
+        version = migration.upgrade()
+
+        print 'Requestdata schema is at version {0}.'.format(version)
+
+    def db_version(self):
+        from ckanext.requestdata import migration
+
+        print migration.current_version()
+
+    def send_emails(self):
+        from ckanext.requestdata import emailer
+
+        while True:
+            # Drain the outbox, the worker delivers at most one batch at a
+            # time
+            while True:
+                result = emailer.send_queued_emails()
+
+                if not result['sent'] and not result['failed']:
+                    break
+
+                print '{0} emails sent, {1} failed.'.format(result['sent'],
+                                                            result['failed'])
+
+            if not self.options.watch:
+                break
+
+            time.sleep(self.options.interval)
+
+    def benchmark(self):
+        from ckan import model
+        from ckan.tests import helpers
+        from ckanext.requestdata import benchmark
+
+        if not self.options.yes:
+            print 'The benchmark writes organizations, users, datasets and '\
+                'requests to the database configured in {0}. Only run it '\
+                'against a database that can be thrown away, and confirm '\
+                'with --yes.'.format(self.options.config)
+            sys.exit(1)
+
+        if self.options.organizations < 1 or self.options.maintainers < 1:
+            print 'At least one organization and one maintainer per '\
+                'organization are needed.'
+            sys.exit(1)
+
+        print 'Generating {0} organizations with {1} datasets and {2} '\
+            'requests per dataset...'.format(self.options.organizations,
+                                             self.options.packages,
+                                             self.options.requests)
+
+        data = benchmark.generate(organizations=self.options.organizations,
+                                  packages=self.options.packages,
+                                  maintainers=self.options.maintainers,
+                                  requests=self.options.requests)
+
+        try:
+            # The dashboards are requested through the full middleware stack
+            results = benchmark.run(data, repeat=self.options.repeat,
+                                    app=helpers._get_test_app())
+
+            print benchmark.format_results(results)
+        finally:
+            if self.options.keep:
+                print 'The generated data is prefixed with {0}.'.format(
+                    data['prefix'])
+            else:
+                print 'Removing the generated data...'
+                model.Session.remove()
+                benchmark.cleanup(data['prefix'])
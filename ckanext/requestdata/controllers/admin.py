@@ -10,13 +10,17 @@ from ckan import model
 from ckan.common import c, _
 import ckan.lib.base as base
 import ckan.lib.helpers as h
-import ckanext.requestdata.helpers as requestdata_helper
 import ckan.logic as logic
+import ckan.lib.navl.dictization_functions as df
 import unicodecsv as csv
 import json
+import time
+import datetime
 from cStringIO import StringIO
-from collections import Counter
-from ckanext.requestdata import helpers
+from ckanext.requestdata import email_template, dashboard, metrics
+from ckanext.requestdata.logic import schema
+from ckanext.requestdata.logic.actions import get_organization
+from ckanext.requestdata.model import iter_requests
 
 from ckan.common import response, request
 
@@ -26,6 +30,10 @@ NotAuthorized = logic.NotAuthorized
 redirect = base.redirect
 abort = base.abort
 
+# Number of requests read from the database and written per chunk when
+# exporting
+EXPORT_BATCH_SIZE = 1000
+
 
 def _get_context():
     return {
@@ -55,6 +63,7 @@ class AdminController(AdminController):
                 data_dict = dict(request.POST)
                 del data_dict['save']
                 data = _get_action('config_option_update', data_dict)
+                email_template.invalidate()
                 h.flash_success(_('Successfully updated.'))
             except logic.ValidationError, e:
                 errors = e.error_dict
@@ -81,321 +90,256 @@ class AdminController(AdminController):
             :returns: template
 
         '''
+        start = time.time()
+
         try:
             requests = _get_action('requestdata_request_list_for_sysadmin', {})
         except NotAuthorized:
             abort(403, _('Not authorized to see this page.'))
-        organizations = []
-        tmp_orgs = []
-        filtered_maintainers = []
+        request_params = request.params.dict_of_lists()
+        maintainer_filters = {}
         filtered_organizations = []
+        orders = {}
+
+        for value in request_params.get('filter_by_maintainers', []):
+            org_name, maintainers = dashboard.parse_maintainer_filter(value)
+
+            if maintainers is not None:
+                maintainer_filters.setdefault(org_name, [])\
+                                  .extend(maintainers)
+
+        if request_params.get('filter_by_organizations'):
+            filtered_organizations = \
+                request_params['filter_by_organizations'][0].split(',')
+
+        for value in request_params.get('order_by', []):
+            params = value.split('|')
+            orders[params[1].split(':')[1]] = \
+                dashboard.parse_order(params[0])
+
+        counters = None
+
+        if any(order[0] in ('shared', 'requests')
+               for order in orders.values()):
+            package_ids = list(set(x['package_id'] for x in requests))
+            counters = \
+                _get_action('requestdata_request_data_counters_get_many',
+                            {'package_ids': package_ids})
+
+        maintainer_keys = dashboard.maintainer_keys(requests)
+
+        for maintainers in maintainer_filters.values():
+            maintainer_keys.update(maintainers)
+
+        users = dashboard.prefetch_users(maintainer_keys)
+        # The counters and the number of requests of the organizations are
+        # read from their statistics, one row per organization
+        stats = _get_action('requestdata_organization_stats', {})
+        organizations_by_id = dashboard.prefetch_organizations(
+            set(item['owner_org'] for item in requests) | set(stats))
+        empty_counters = dict((key, 0) for key in
+                              ['requests', 'replied', 'declined', 'shared'])
+        organizations = []
         organizations_for_filters = {}
-        reverse = True
-        q_organizations = []
-        request_params = request.params.dict_of_lists()
-        order = 'last_request_created_at'
-
-        for item in request_params:
-            if item == 'filter_by_maintainers':
-                for x in request_params[item]:
-                    params = x.split('|')
-                    org = params[0].split(':')[1]
-                    maintainers = params[1].split(':')[1].split(',')
-                    maintainers_ids = []
-
-                    if maintainers[0] != '*all*':
-                        for i in maintainers:
-                            try:
-                                user = _get_action('user_show', {'id': i})
-                                maintainers_ids.append(user['id'])
-                            except NotFound:
-                                pass
-
-                        data = {
-                            'org': org,
-                            'maintainers': maintainers_ids
-                        }
-
-                        filtered_maintainers.append(data)
-            elif item == 'filter_by_organizations':
-                filtered_organizations = request_params[item][0].split(',')
-            elif item == 'order_by':
-                for x in request_params[item]:
-                    params = x.split('|')
-                    q_organization = params[1].split(':')[1]
-                    order = params[0]
-
-                    if 'asc' in order:
-                        reverse = False
-                        order = 'title'
-                        current_order_name = 'Alphabetical (A-Z)'
-                    elif 'desc' in order:
-                        reverse = True
-                        order = 'title'
-                        current_order_name = 'Alphabetical (Z-A)'
-                    elif 'most_recent' in order:
-                        reverse = True
-                        order = 'last_request_created_at'
-                        current_order_name = 'Most Recent'
-                    elif 'shared' in order:
-                        current_order_name = 'Sharing Rate'
-                    elif 'requests' in order:
-                        current_order_name = 'Requests Rate'
-
-                    data = {
-                        'org': q_organization,
-                        'order': order,
-                        'reverse': reverse,
-                        'current_order_name': current_order_name
-                    }
-
-                    q_organizations.append(data)
-
-                for x in requests:
-                    package =\
-                        _get_action('package_show', {'id': x['package_id']})
-                    count = \
-                        _get_action('requestdata_request_data_counters_get',
-                                    {'package_id': x['package_id']})
-                    if count:
-                        x['shared'] = count.shared
-                        x['requests'] = count.requests
-                    x['title'] = package['title']
-                    data_dict = {'id': package['owner_org']}
-                    current_org = _get_action('organization_show', data_dict)
-                    x['name'] = current_org['name']
-
-        # Group requests by organization
-        for item in requests:
-            try:
-                package = \
-                    _get_action('package_show', {'id': item['package_id']})
-                package_maintainer_ids = package['maintainer'].split(',')
-                data_dict = {'id': package['owner_org']}
-                org = _get_action('organization_show', data_dict)
-                item['title'] = package['title']
-            except NotFound, e:
-                # package was not found, possibly deleted
-                continue
+        senders = set()
+        total_requests_counters = dict(empty_counters)
+
+        for org_id, org_stats in stats.items():
+            for key in total_requests_counters:
+                total_requests_counters[key] += org_stats[key]
 
-            if org['id'] in organizations_for_filters:
-                organizations_for_filters[org['id']]['requests'] += 1
-            else:
-                organizations_for_filters[org['id']] = {
+            org = organizations_by_id.get(org_id)
+            requests_count = sum(org_stats[key] for key in
+                                 ['requests_new', 'requests_open',
+                                  'requests_archive'])
+
+            if org is not None and requests_count > 0:
+                organizations_for_filters[org_id] = {
                     'name': org['name'],
                     'title': org['title'],
-                    'requests': 1
+                    'requests': requests_count
                 }
 
+        for org in dashboard.group_by_organization(requests,
+                                                   organizations_by_id):
+            org_requests = org.pop('requests')
+
             if len(filtered_organizations) > 0\
                     and org['name'] not in filtered_organizations:
                 continue
-            maintainers = []
-            name = ''
-            username = ''
-            for id in package_maintainer_ids:
-                try:
-                    user = _get_action('user_show', {'id': id})
-                    username = user['name']
-                    name = user['fullname']
-                    payload = {
-                        'id': id,
-                        'name': name,
-                        'username': username,
-                        'fullname': name
-                    }
-                    maintainers.append(payload)
-
-                    if not name:
-                        name = username
-                except NotFound:
-                    pass
-            item['maintainers'] = maintainers
-            counters = \
-                _get_action('requestdata_request_data_counters_get_by_org',
-                            {'org_id': org['id']})
-
-            if org['id'] not in tmp_orgs:
-                data = {
-                    'title': org['title'],
-                    'name': org['name'],
-                    'id': org['id'],
-                    'requests_new': [],
-                    'requests_open': [],
-                    'requests_archive': [],
-                    'maintainers': [],
-                    'counters': counters
-                }
-
-                if item['state'] == 'new':
-                    data['requests_new'].append(item)
-                elif item['state'] == 'open':
-                    data['requests_open'].append(item)
-                elif item['state'] == 'archive':
-                    data['requests_archive'].append(item)
-
-                payload = {'id': id, 'name': name, 'username': username}
-                data['maintainers'].append(payload)
-
-                organizations.append(data)
-            else:
-                current_org = \
-                    next(item for item in organizations
-                         if item['id'] == org['id'])
-
-                payload = {'id': id, 'name': name, 'username': username}
-                current_org['maintainers'].append(payload)
-
-                if item['state'] == 'new':
-                    current_org['requests_new'].append(item)
-                elif item['state'] == 'open':
-                    current_org['requests_open'].append(item)
-                elif item['state'] == 'archive':
-                    current_org['requests_archive'].append(item)
-
-            tmp_orgs.append(org['id'])
-
-        for org in organizations:
-            copy_of_maintainers = org['maintainers']
-            org['maintainers'] = \
-                dict((item['id'], item)
-                     for item in org['maintainers']).values()
-
-            # Count how many requests each maintainer has
-            for main in org['maintainers']:
-                c = Counter(item for dct in copy_of_maintainers
-                            for item in dct.items())
-                main['count'] = c[('id', main['id'])]
-
-            # Sort maintainers by number of requests
-            org['maintainers'] = \
-                sorted(org['maintainers'],
-                       key=lambda k: k['count'],
-                       reverse=True)
-
-            total_organizations = \
-                org['requests_new'] + \
-                org['requests_open'] +\
-                org['requests_archive']
-
-            for i, r in enumerate(total_organizations):
-                maintainer_found = False
-
-                package = _get_action('package_show', {'id': r['package_id']})
-                package_maintainer_ids = package['maintainer'].split(',')
-                is_hdx = requestdata_helper.is_hdx_portal()
-
-                if is_hdx:
-                    # Quick fix for hdx portal
-                    maintainer_ids = []
-                    for maintainer_name in package_maintainer_ids:
-                        try:
-                            main_ids =\
-                                _get_action('user_show',
-                                            {'id': maintainer_name})
-                            maintainer_ids.append(main_ids['id'])
-                        except NotFound:
-                            pass
-                data_dict = {'id': package['owner_org']}
-                organ = _get_action('organization_show', data_dict)
-
-                # Check if current request is part of a filtered maintainer
-                for x in filtered_maintainers:
-                    if x['org'] == organ['name']:
-                        for maint in x['maintainers']:
-                            if is_hdx:
-                                if maint in maintainer_ids:
-                                    maintainer_found = True
-                            else:
-                                if maint in package_maintainer_ids:
-                                    maintainer_found = True
-
-                        if not maintainer_found:
-                            if r['state'] == 'new':
-                                org['requests_new'].remove(r)
-                            elif r['state'] == 'open':
-                                org['requests_open'].remove(r)
-                            elif r['state'] == 'archive':
-                                org['requests_archive'].remove(r)
-
-            org['requests_archive'] = \
-                helpers.group_archived_requests_by_dataset(
-                    org['requests_archive'])
-
-            q_org = [x for x in q_organizations if x.get('org') == org['name']]
-
-            if q_org:
-                q_org = q_org[0]
-                order = q_org.get('order')
-                reverse = q_org.get('reverse')
-                current_order_name = q_org.get('current_order_name')
-            else:
-                order = 'last_request_created_at'
-                reverse = True
-                current_order_name = 'Most Recent'
 
+            order, reverse, current_order_name = orders.get(
+                org['name'], (dashboard.MOST_RECENT, True, 'Most Recent'))
+            maintainer_counts = None
+
+            if org['name'] in maintainer_filters:
+                # The requests of the selected maintainers are filtered in
+                # the database, the maintainers are counted for the whole
+                # organization
+                org_requests = _get_action(
+                    'requestdata_request_list_for_organization',
+                    {'org_id': org['id'],
+                     'maintainer_ids': dashboard.user_ids(
+                         maintainer_filters[org['name']], users)})
+                maintainer_counts = \
+                    _get_action('requestdata_request_count_by_maintainer',
+                                {'org_id': org['id']})
+                users.update(dashboard.prefetch_users(
+                    key for key in maintainer_counts if key not in users))
+
+            org.update(dashboard.build_dashboard(
+                org_requests, users, counters=counters,
+                maintainer_counts=maintainer_counts,
+                order=order, reverse=reverse))
+            org['counters'] = stats.get(org['id'], empty_counters)
             org['current_order_name'] = current_order_name
+            senders.update(dashboard.sender_ids(org_requests))
 
-            if order == 'last_request_created_at':
-                for dataset in org['requests_archive']:
-                    created_at = \
-                        dataset.get('requests_archived')[0].get('created_at')
-                    data = {
-                        'last_request_created_at': created_at
-                    }
-                    dataset.update(data)
-
-            org['requests_archive'] = \
-                sorted(org['requests_archive'],
-                       key=lambda x: x[order],
-                       reverse=reverse)
+            organizations.append(org)
 
         organizations_for_filters = \
             sorted(organizations_for_filters.iteritems(),
                    key=lambda (x, y): y['requests'], reverse=True)
 
-        total_requests_counters =\
-            _get_action('requestdata_request_data_counters_get_all', {})
         extra_vars = {
             'organizations': organizations,
             'organizations_for_filters': organizations_for_filters,
-            'total_requests_counters': total_requests_counters
+            'total_requests_counters': total_requests_counters,
+            'senders': dashboard.prefetch_senders(senders)
         }
 
-        return toolkit.render('admin/all_requests_data.html', extra_vars)
+        output = toolkit.render('admin/all_requests_data.html', extra_vars)
+        metrics.dashboard_render_seconds.time(start, dashboard='admin')
+
+        return output
 
     def download_requests_data(self):
         '''
             Handles creating csv or json file from all of the Requested Data
 
-            :returns: json or csv file
+            The file is streamed in chunks while the requests are read from
+            the database, so the memory used does not grow with the number
+            of requests. The ``format`` is ``csv`` (default), ``json`` or
+            ``jsonl``, and the requests can be filtered by ``org_id``,
+            ``state``, ``created_after`` and ``created_before``.
+
+            :returns: json, json lines or csv file
         '''
 
-        file_format = request.query_string
-        requests = \
-            _get_action('requestdata_request_list_for_sysadmin', {})
+        context = _get_context()
+
+        try:
+            toolkit.check_access('requestdata_request_list_for_sysadmin',
+                                 context, {})
+        except NotAuthorized:
+            abort(403, _('Not authorized to see this page.'))
+
+        data, errors = df.validate(dict(request.params.items()),
+                                   schema.request_export_schema(), context)
+
+        if errors:
+            abort(400, _('Invalid filters: %s') % errors)
+
+        if data.get('org_id'):
+            try:
+                data['org_id'] = get_organization(context, data['org_id']).id
+            except NotFound:
+                abort(404, _('Organization not found'))
+
+        filters = dict((key, data.get(key)) for key in
+                       ['org_id', 'state', 'created_after', 'created_before'])
+        requests = iter_requests(batch_size=EXPORT_BATCH_SIZE, **filters)
+
+        if data['format'] == 'jsonl':
+            content_type = 'application/x-ndjson'
+            chunks = _json_lines_chunks(requests)
+        elif data['format'] == 'json':
+            content_type = 'application/json'
+            chunks = _json_chunks(requests)
+        else:
+            content_type = 'text/csv'
+            chunks = _csv_chunks(requests)
+
+        file_name = 'data_requests.{0}'.format(data['format'])
+
+        response.headerlist = \
+            [('Content-Type', content_type),
+             ('Content-Disposition',
+              'attachment;filename="{0}"'.format(file_name))]
+
+        return chunks
+
+    def metrics(self):
+        '''
+            Exposes the metrics of this worker process in the Prometheus
+            text format, see ``ckanext.requestdata.metrics``.
+
+            :returns: text
+        '''
+
+        try:
+            toolkit.check_access('sysadmin', _get_context(), {})
+        except NotAuthorized:
+            abort(403, _('Not authorized to see this page.'))
+
+        response.headers['Content-Type'] = metrics.CONTENT_TYPE
+
+        return metrics.registry.render()
+
+
+def _export_dict(item):
+    # Same date format as DomainObject.as_dict
+    for key, value in item.items():
+        if isinstance(value, datetime.datetime):
+            item[key] = str(value).replace(' ', 'T')
+
+    return item
+
+
+def _batches(requests):
+    batch = []
+
+    for item in requests:
+        batch.append(_export_dict(item))
+
+        if len(batch) == EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _csv_chunks(requests):
+    header = None
+
+    for batch in _batches(requests):
         s = StringIO()
+        writer = csv.writer(s, encoding='utf-8')
+
+        if header is None:
+            header = sorted(batch[0].keys())
+            writer.writerow(header)
+
+        for item in batch:
+            writer.writerow([item[key] for key in header])
+
+        yield s.getvalue()
+
+
+def _json_chunks(requests):
+    separator = '[\n'
+
+    for batch in _batches(requests):
+        yield separator + ',\n'.join(json.dumps(item) for item in batch)
+        separator = ',\n'
+
+    if separator == '[\n':
+        yield '[]\n'
+    else:
+        yield '\n]\n'
+
 
-        if 'json' in file_format.lower():
-            response.headerlist = \
-                [('Content-Type', 'application/json'),
-                 ('Content-Disposition',
-                  'attachment;filename="data_requests.json"')]
-            json.dump(requests, s, indent=4)
-
-            return s.getvalue()
-
-        if 'csv' in file_format.lower():
-            response.headerlist = \
-                [('Content-Type', 'text/csv'),
-                 ('Content-Disposition',
-                  'attachment;filename="data_requests.csv"')]
-            writer = csv.writer(s, encoding='utf-8')
-            header = True
-            for k in requests:
-                if header:
-                    writer.writerow(k.keys())
-                    header = False
-                writer.writerow(k.values())
-
-            return s.getvalue()
+def _json_lines_chunks(requests):
+    for batch in _batches(requests):
+        yield ''.join(json.dumps(item) + '\n' for item in batch)
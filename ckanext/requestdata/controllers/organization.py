@@ -1,10 +1,22 @@
+import time
+import urllib
+
+from paste.deploy.converters import asint
+
+try:
+    # CKAN 2.7 and later
+    from ckan.common import config
+except ImportError:
+    # CKAN 2.6 and earlier
+    from pylons import config
 from ckan.lib import base
 from ckan import logic, model
+import ckan.lib.helpers as h
 from ckan.plugins import toolkit
 from ckan.common import c, _, request
 from ckan.controllers import organization
-from collections import Counter
-from ckanext.requestdata import helpers
+from ckanext.requestdata import dashboard, metrics
+from ckanext.requestdata.cache import log_lookup_stats
 
 
 get_action = logic.get_action
@@ -16,6 +28,10 @@ abort = base.abort
 render = base.render
 BaseController = base.BaseController
 
+# Number of datasets shown per page of the archived requests
+ARCHIVE_PAGE_SIZE = asint(
+    config.get('ckanext.requestdata.archive_page_size', 20))
+
 
 def _get_context():
     return {
@@ -40,13 +56,7 @@ class OrganizationController(organization.OrganizationController):
         :returns: template
         '''
 
-        try:
-            requests = _get_action('requestdata_request_list_for_organization',
-                                   {'org_id': id})
-
-        except NotAuthorized:
-            abort(403, _('Not authorized to see this page.'))
-
+        start = time.time()
         group_type = self._ensure_controller_matches_group_type(id)
         context = {
             'model': model,
@@ -55,189 +65,137 @@ class OrganizationController(organization.OrganizationController):
         }
         c.group_dict = self._get_group_dict(id)
         group_type = c.group_dict['type']
+        org_name = c.group_dict['name']
         request_params = request.params.dict_of_lists()
-        filtered_maintainers = []
+        maintainer_filter = None
+        order = dashboard.MOST_RECENT
         reverse = True
-        order = 'last_request_created_at'
-        q_organization = ''
         current_order_name = 'Most Recent'
 
-        for item in request_params:
-            if item == 'filter_by_maintainers':
-                for x in request_params[item]:
-                    params = x.split('|')
-                    org = params[0].split(':')[1]
-                    maintainers = params[1].split(':')[1].split(',')
-                    maintainers_ids = []
-
-                    if maintainers[0] != '*all*':
-                        for i in maintainers:
-                            try:
-                                user = _get_action('user_show', {'id': i})
-                                maintainers_ids.append(user['id'])
-                            except NotFound:
-                                pass
-
-                        data = {
-                            'org': org,
-                            'maintainers': maintainers_ids
-                        }
-
-                        filtered_maintainers.append(data)
-            elif item == 'order_by':
-                params = request_params[item][0].split('|')
-                q_organization = params[1].split(':')[1]
-                order = params[0]
-
-                if 'asc' in order:
-                    reverse = False
-                    order = 'title'
-                    current_order_name = 'Alphabetical (A-Z)'
-                elif 'desc' in order:
-                    reverse = True
-                    order = 'title'
-                    current_order_name = 'Alphabetical (Z-A)'
-                elif 'most_recent' in order:
-                    reverse = True
-                    order = 'last_request_created_at'
-                elif 'shared' in order:
-                    current_order_name = 'Sharing Rate'
-                elif 'requests' in order:
-                    current_order_name = 'Requests Rate'
-
-                for x in requests:
-                    package = \
-                        _get_action('package_show', {'id': x['package_id']})
-                    count = \
-                        _get_action('requestdata_request_data_counters_get',
-                                    {'package_id': x['package_id']})
-                    x['title'] = package['title']
-                    x['shared'] = count.shared
-                    x['requests'] = count.requests
-                    data_dict = {'id': package['owner_org']}
-                    current_org = _get_action('organization_show', data_dict)
-                    x['name'] = current_org['name']
-
-        maintainers = []
-        for item in requests:
-            package = _get_action('package_show', {'id': item['package_id']})
-            package_maintainer_ids = package['maintainer'].split(',')
-            item['title'] = package['title']
-            package_maintainers = []
-
-            for maint_id in package_maintainer_ids:
-                try:
-                    user = _get_action('user_show', {'id': maint_id})
-                    username = user['name']
-                    name = user['fullname']
-
-                    if not name:
-                        name = username
-
-                    payload = {
-                               'id': maint_id,
-                               'name': name,
-                               'username': username,
-                               'fullname': name}
-                    maintainers.append(payload)
-                    package_maintainers.append(payload)
-                except NotFound:
-                    pass
-            item['maintainers'] = package_maintainers
-
-        copy_of_maintainers = maintainers
-        maintainers = dict((item['id'], item) for item in maintainers).values()
-        organ = _get_action('organization_show', {'id': id})
-
-        # Count how many requests each maintainer has
-        for main in maintainers:
-            count = Counter(
-                item for dct in copy_of_maintainers for item in dct.items())
-            main['count'] = count[('id', main['id'])]
-
-        # Sort maintainers by number of requests
-        maintainers = sorted(
-            maintainers, key=lambda k: k['count'], reverse=True)
-
-        for i, r in enumerate(requests[:]):
-            maintainer_found = False
-
-            package = _get_action('package_show', {'id': r['package_id']})
-            package_maintainer_ids = package['maintainer'].split(',')
-            is_hdx = helpers.is_hdx_portal()
-
-            if is_hdx:
-                # Quick fix for hdx portal
-                maintainer_ids = []
-                for maintainer_name in package_maintainer_ids:
-                    try:
-                        main_ids = \
-                            _get_action('user_show', {'id': maintainer_name})
-                        maintainer_ids.append(main_ids['id'])
-                    except NotFound:
-                        pass
-            data_dict = {'id': package['owner_org']}
-            organ = _get_action('organization_show', data_dict)
-
-            # Check if current request is part of a filtered maintainer
-            for x in filtered_maintainers:
-                if x['org'] == organ['name']:
-                    for maint in x['maintainers']:
-                        if is_hdx:
-                            if maint in maintainer_ids:
-                                maintainer_found = True
-                        else:
-                            if maint in package_maintainer_ids:
-                                maintainer_found = True
-
-                    if not maintainer_found:
-                        requests.remove(r)
-
-        requests_new = []
-        requests_open = []
-        requests_archive = []
-
-        for item in requests:
-            if item['state'] == 'new':
-                requests_new.append(item)
-            elif item['state'] == 'open':
-                requests_open.append(item)
-            elif item['state'] == 'archive':
-                requests_archive.append(item)
-
-        grouped_requests_archive =\
-            helpers.group_archived_requests_by_dataset(requests_archive)
-
-        if order == 'last_request_created_at':
-            for dataset in grouped_requests_archive:
-                created_at =\
-                    dataset.get('requests_archived')[0].get('created_at')
-                data = {
-                    'last_request_created_at': created_at
-                }
-                dataset.update(data)
-
-        if organ['name'] == q_organization:
-            grouped_requests_archive = sorted(grouped_requests_archive,
-                                              key=lambda x: x[order],
-                                              reverse=reverse)
-
-        counters =\
-            _get_action('requestdata_request_data_counters_get_by_org',
-                        {'org_id': organ['id']})
+        for value in request_params.get('filter_by_maintainers', []):
+            org, maintainers = dashboard.parse_maintainer_filter(value)
+
+            if org == org_name and maintainers is not None:
+                maintainer_filter = (maintainer_filter or []) + maintainers
+
+        data_dict = {'org_id': id}
+        users = {}
+
+        if maintainer_filter is not None:
+            # The filter is given by user names, the requests are filtered
+            # by their maintainers' ids in the database
+            users = dashboard.prefetch_users(maintainer_filter)
+            data_dict['maintainer_ids'] = \
+                dashboard.user_ids(maintainer_filter, users)
+
+        if request_params.get('order_by'):
+            params = request_params['order_by'][0].split('|')
+
+            # The archived requests are only sorted when they are ordered
+            # for this organization
+            if params[1].split(':')[1] == org_name:
+                order, reverse, current_order_name = \
+                    dashboard.parse_order(params[0])
+
+        try:
+            page = max(int(request.params.get('archive_page', 1)), 1)
+        except ValueError:
+            abort(400, _('"archive_page" parameter must be an integer'))
+
+        def get_archive(page):
+            return _get_action(
+                'requestdata_request_archive_for_organization',
+                dict(data_dict, order_by=order, reverse=reverse,
+                     limit=ARCHIVE_PAGE_SIZE,
+                     offset=(page - 1) * ARCHIVE_PAGE_SIZE))
+
+        # The archive is grouped, ordered and paginated by the database,
+        # only the new and open requests are listed
+        try:
+            requests = []
+
+            for state in ['new', 'open']:
+                requests.extend(_get_action(
+                    'requestdata_request_list_for_organization',
+                    dict(data_dict, state=state)))
+
+            archive = get_archive(page)
+            last_page = max(
+                (archive['count'] + ARCHIVE_PAGE_SIZE - 1) //
+                ARCHIVE_PAGE_SIZE, 1)
+
+            if page > last_page:
+                # A page past the end shows the last one
+                page = last_page
+                archive = get_archive(page)
+
+        except NotAuthorized:
+            abort(403, _('Not authorized to see this page.'))
+
+        # The maintainers of the whole organization are counted, whether
+        # the requests are filtered or not
+        maintainer_counts = \
+            _get_action('requestdata_request_count_by_maintainer',
+                        {'org_id': c.group_dict['id']})
+        maintainer_keys = dashboard.maintainer_keys(requests)
+        maintainer_keys.update(maintainer_counts.keys())
+
+        for group in archive['results']:
+            maintainer_keys.update(
+                dashboard.maintainer_keys(group['requests_archived']))
+
+        users.update(dashboard.prefetch_users(
+            key for key in maintainer_keys if key not in users))
+
+        view = dashboard.build_dashboard(
+            requests, users, maintainer_counts=maintainer_counts)
+        requests_archive = dashboard.build_archive(archive['results'], users)
+
+        def pager_url(q=None, page=None):
+            params = [(k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                      for k, v in request.params.items()
+                      if k != 'archive_page']
+            params.append(('archive_page', page))
+
+            return h.url_for('requestdata_organization_requests',
+                             id=org_name) + '?' + urllib.urlencode(params)
+
+        archive_page = h.Page(
+            collection=requests_archive,
+            page=page,
+            url=pager_url,
+            item_count=archive['count'],
+            items_per_page=ARCHIVE_PAGE_SIZE,
+            presliced_list=True
+        )
+
+        senders = dashboard.prefetch_senders(
+            dashboard.sender_ids(requests) |
+            dashboard.sender_ids(requests_archive))
+        stats = _get_action('requestdata_organization_stats',
+                            {'org_id': c.group_dict['id']})
+        counters = stats[c.group_dict['id']]
 
         extra_vars = {
-            'requests_new': requests_new,
-            'requests_open': requests_open,
-            'requests_archive': grouped_requests_archive,
-            'maintainers': maintainers,
-            'org_name': organ['name'],
+            'requests_new': view['requests_new'],
+            'requests_open': view['requests_open'],
+            'requests_archive': requests_archive,
+            'archive_page': archive_page,
+            'total_archived_requests': archive['total_requests'],
+            'maintainers': view['maintainers'],
+            'org_name': org_name,
             'current_order_name': current_order_name,
-            'counters': counters
+            'counters': counters,
+            'senders': senders
         }
 
         self._setup_template_variables(context, {'id': id},
                                        group_type=group_type)
 
-        return render('requestdata/organization_requested_data.html',
-                      extra_vars)
+        log_lookup_stats('Organization requested data')
+
+        output = render('requestdata/organization_requested_data.html',
+                        extra_vars)
+        metrics.dashboard_render_seconds.time(start, dashboard='organization')
+
+        return output
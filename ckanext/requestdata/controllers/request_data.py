@@ -1,7 +1,7 @@
 from ckan.lib import base
 from ckan.common import c, _
 from ckan import logic
-from ckanext.requestdata import emailer
+from ckanext.requestdata import emailer, email_template
 from ckan.plugins import toolkit
 from ckan.controllers.admin import get_sysadmins
 
@@ -35,120 +35,6 @@ def _get_action(action, data_dict):
     return toolkit.get_action(action)(_get_context(), data_dict)
 
 
-def _get_email_configuration(
-        user_name, data_owner, dataset_name, email, message, organization,
-        data_maintainers, only_org_admins=False):
-    schema = logic.schema.update_configuration_schema()
-    avaiable_terms = ['{name}', '{data_maintainers}', '{dataset}',
-                      '{organization}', '{message}', '{email}']
-    new_terms = [user_name, data_maintainers, dataset_name, organization,
-                 message, email]
-
-    try:
-        is_user_sysadmin = \
-            _get_action('user_show', {'id': c.user}).get('sysadmin')
-    except NotFound:
-        pass
-
-    for key in schema:
-        # get only email configuration
-        if 'email_header' in key:
-            email_header = config.get(key)
-        elif 'email_body' in key:
-            email_body = config.get(key)
-        elif 'email_footer' in key:
-            email_footer = config.get(key)
-    if '{message}' not in email_body and not email_body and not email_footer:
-        email_body += message
-        return email_body
-    for i in range(0, len(avaiable_terms)):
-        if avaiable_terms[i] == '{dataset}' and new_terms[i]:
-            url = toolkit.url_for(
-                                    controller='package',
-                                    action='read',
-                                    id=new_terms[i], qualified=True)
-            new_terms[i] = '<a href="' + url + '">' + new_terms[i] + '</a>'
-        elif avaiable_terms[i] == '{organization}' and is_user_sysadmin:
-            new_terms[i] = config.get('ckan.site_title')
-        elif avaiable_terms[i] == '{data_maintainers}':
-            if len(new_terms[i]) == 1:
-                new_terms[i] = new_terms[i][0]
-            else:
-                maintainers = ''
-                for j, term in enumerate(new_terms[i][:]):
-                    maintainers += term
-
-                    if j == len(new_terms[i]) - 2:
-                        maintainers += ' and '
-                    elif j < len(new_terms[i]) - 1:
-                        maintainers += ', '
-
-                new_terms[i] = maintainers
-
-        email_header = email_header.replace(avaiable_terms[i], new_terms[i])
-        email_body = email_body.replace(avaiable_terms[i], new_terms[i])
-        email_footer = email_footer.replace(avaiable_terms[i], new_terms[i])
-
-    if only_org_admins:
-        owner_org = _get_action('package_show',
-                                {'id': dataset_name}).get('owner_org')
-        url = toolkit.url_for('requestdata_organization_requests',
-                              id=owner_org, qualified=True)
-        email_body += '<br><br> This dataset\'s maintainer does not exist.\
-         Go to your organisation\'s <a href="' + url + '">Requested Data</a>\
-          page to see the new request. Please also edit the dataset and assign\
-           a new maintainer.'
-    else:
-        url = \
-            toolkit.url_for('requestdata_my_requests',
-                            id=data_owner, qualified=True)
-        email_body += '<br><br><strong> Please accept or decline the request\
-         as soon as you can by visiting the \
-         <a href="' + url + '">My Requests</a> page.</strong>'
-
-    organizations =\
-        _get_action('organization_list_for_user', {'id': data_owner})
-
-    package = _get_action('package_show', {'id': dataset_name})
-
-    if not only_org_admins:
-        for org in organizations:
-            if org['name'] in organization\
-                    and package['owner_org'] == org['id']:
-                url = \
-                    toolkit.url_for('requestdata_organization_requests',
-                                    id=org['name'], qualified=True)
-                email_body += '<br><br> Go to <a href="' + url + '">\
-                              Requested data</a> page in organization admin.'
-
-    site_url = config.get('ckan.site_url')
-    site_title = config.get('ckan.site_title')
-    newsletter_url = config.get('ckanext.requestdata.newsletter_url', site_url)
-    twitter_url = \
-        config.get('ckanext.requestdata.twitter_url', 'https://twitter.com')
-    contact_email = config.get('ckanext.requestdata.contact_email', '')
-
-    email_footer += """
-        <br/><br/>
-        <small>
-          <p>
-            <a href=" """ + site_url + """ ">""" + site_title + """</a>
-          </p>
-          <p>
-            <a href=" """ + newsletter_url + """ ">\
-            Sign up for our newsletter</a> | \
-            <a href=" """ + twitter_url + """ ">Follow us on Twitter</a>\
-             | <a href="mailto:""" + contact_email + """ ">Contact us</a>
-          </p>
-        </small>
-
-    """
-
-    result = email_header + '<br><br>' + email_body + '<br><br>' + email_footer
-
-    return result
-
-
 class RequestDataController(BaseController):
 
     def send_request(self):
@@ -249,19 +135,20 @@ class RequestDataController(BaseController):
                     data_maintainers.append(admin.get('fullname'))
                 only_org_admins = True
 
-            content = _get_email_configuration(
-                sender_name, data_owner, dataset_name, email,
-                message, org, data_maintainers,
-                only_org_admins=only_org_admins)
+            email_context = self._email_context(
+                package, sender_name, data_owner, email, message, org,
+                data_maintainers, only_org_admins)
+            content = email_template.get_renderer().render(email_context)
 
             response_message = \
-                emailer.send_email(content, users_email, mail_subject)
+                emailer.dispatch_email(content, users_email, mail_subject)
 
             # notify package creator that new data request was made
             _get_action('requestdata_notification_create', data_dict)
             data_dict = {
                 'package_id': data['package_id'],
-                'flag': 'request'
+                'flag': 'request',
+                'org_id': package['owner_org']
             }
 
             action_name = 'requestdata_increment_request_data_counters'
@@ -276,6 +163,56 @@ class RequestDataController(BaseController):
 
             return json.dumps(message)
 
+    def _email_context(self, package, sender_name, data_owner, email,
+                       message, organization, data_maintainers,
+                       only_org_admins):
+        '''Collects everything the email template renderer needs, so
+        rendering the email makes no further lookups.'''
+
+        dataset_name = package['name']
+        organization_requests_url = None
+
+        if only_org_admins:
+            requests_url = \
+                toolkit.url_for('requestdata_organization_requests',
+                                id=package['owner_org'], qualified=True)
+        else:
+            requests_url = \
+                toolkit.url_for('requestdata_my_requests',
+                                id=data_owner, qualified=True)
+
+            # Link the organization's requests when the sender is a
+            # member of the dataset's organization that the data owner
+            # can manage
+            owner_org = package.get('organization') or {}
+
+            if owner_org.get('name') and owner_org['name'] in organization:
+                owner_orgs = _get_action('organization_list_for_user',
+                                         {'id': data_owner})
+
+                for org in owner_orgs:
+                    if org['id'] == package['owner_org']:
+                        organization_requests_url = \
+                            toolkit.url_for(
+                                'requestdata_organization_requests',
+                                id=org['name'], qualified=True)
+
+        return {
+            'name': sender_name,
+            'email': email,
+            'message': message,
+            'organization': organization,
+            'data_maintainers': data_maintainers,
+            'dataset_name': dataset_name,
+            'dataset_url': toolkit.url_for(controller='package',
+                                           action='read', id=dataset_name,
+                                           qualified=True),
+            'is_sysadmin': c.userobj.sysadmin,
+            'only_org_admins': only_org_admins,
+            'requests_url': requests_url,
+            'organization_requests_url': organization_requests_url
+        }
+
     def _org_admins_for_dataset(self, dataset_name):
         package = _get_action('package_show', {'id': dataset_name})
         owner_org = package['owner_org']
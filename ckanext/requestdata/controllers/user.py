@@ -1,4 +1,5 @@
 import json
+import time
 from paste.deploy.converters import asbool
 from pylons import config
 from email_validator import validate_email
@@ -8,8 +9,8 @@ from ckan.plugins import toolkit
 from ckan.common import c, _, request
 from ckan import authz
 import ckan.lib.helpers as h
-from ckanext.requestdata.emailer import send_email
-from ckanext.requestdata import helpers
+from ckanext.requestdata.emailer import dispatch_email
+from ckanext.requestdata import dashboard, metrics
 
 get_action = logic.get_action
 NotFound = logic.NotFound
@@ -46,6 +47,8 @@ class UserController(BaseController):
 
         '''
 
+        start = time.time()
+
         try:
             requests = _get_action('requestdata_request_list_for_current_user',
                                    {})
@@ -58,92 +61,33 @@ class UserController(BaseController):
             abort(403, _('Not authorized to see this page.'))
 
         order_by = request.query_string
-        requests_new = []
-        requests_open = []
-        requests_archive = []
+        order = dashboard.MOST_RECENT
         reverse = True
-        order = 'last_request_created_at'
         current_order_name = 'Most Recent'
+        counters = None
 
-        if order_by is not '':
-            if 'shared' in order_by:
-                order = 'shared'
-                current_order_name = 'Sharing Rate'
-            elif 'requests' in order_by:
-                order = 'requests'
-                current_order_name = 'Requests Rate'
-            elif 'asc' in order_by:
-                reverse = False
-                order = 'title'
-                current_order_name = 'Alphabetical (A-Z)'
-            elif 'desc' in order_by:
-                reverse = True
-                order = 'title'
-                current_order_name = 'Alphabetical (Z-A)'
-            elif 'most_recent' in order_by:
-                reverse = True
-                order = 'last_request_created_at'
-
-            for item in requests:
-                package =\
-                    _get_action('package_show', {'id': item['package_id']})
-                count = _get_action('requestdata_request_data_counters_get',
-                                    {'package_id': item['package_id']})
-                item['title'] = package['title']
-                item['shared'] = count.shared
-                item['requests'] = count.requests
-
-        for item in requests:
-            try:
-                package =\
-                    _get_action('package_show', {'id': item['package_id']})
-                package_maintainers_ids = package['maintainer'].split(',')
-                item['title'] = package['title']
-            except NotFound, e:
-                # package was not found, possibly deleted
-                continue
-            maintainers = []
-            for i in package_maintainers_ids:
-                try:
-                    user = _get_action('user_show', {'id': i})
-                    payload = {
-                        'id': i,
-                        'fullname': user['fullname']
-                    }
-                    maintainers.append(payload)
-                except NotFound:
-                    pass
-            item['maintainers'] = maintainers
-            if item['state'] == 'new':
-                requests_new.append(item)
-            elif item['state'] == 'open':
-                requests_open.append(item)
-            elif item['state'] == 'archive':
-                requests_archive.append(item)
-
-        requests_archive = \
-            helpers.group_archived_requests_by_dataset(requests_archive)
-
-        if order == 'last_request_created_at':
-            for dataset in requests_archive:
-                created_at = \
-                    dataset.get('requests_archived')[0].get('created_at')
-                data = {
-                    'last_request_created_at': created_at
-                }
-                dataset.update(data)
+        if order_by != '':
+            order, reverse, current_order_name = \
+                dashboard.parse_order(order_by)
+
+            if order in ('shared', 'requests'):
+                package_ids = list(set(item['package_id']
+                                       for item in requests))
+                counters = \
+                    _get_action('requestdata_request_data_counters_get_many',
+                                {'package_ids': package_ids})
 
-        if order:
-            requests_archive = \
-                sorted(requests_archive,
-                       key=lambda x: x[order],
-                       reverse=reverse)
+        users = dashboard.prefetch_users(dashboard.maintainer_keys(requests))
+        view = dashboard.build_dashboard(requests, users, counters=counters,
+                                         order=order, reverse=reverse)
 
         extra_vars = {
-            'requests_new': requests_new,
-            'requests_open': requests_open,
-            'requests_archive': requests_archive,
-            'current_order_name': current_order_name
+            'requests_new': view['requests_new'],
+            'requests_open': view['requests_open'],
+            'requests_archive': view['requests_archive'],
+            'current_order_name': current_order_name,
+            'senders': dashboard.prefetch_senders(
+                dashboard.sender_ids(requests))
         }
 
         context = _get_context()
@@ -160,7 +104,11 @@ class UserController(BaseController):
         }
         self._setup_template_variables(_get_context(), data_dict)
 
-        return toolkit.render('requestdata/my_requested_data.html', extra_vars)
+        output = toolkit.render('requestdata/my_requested_data.html',
+                                extra_vars)
+        metrics.dashboard_render_seconds.time(start, dashboard='user')
+
+        return output
 
     def _setup_template_variables(self, context, data_dict):
         c.is_sysadmin = authz.is_sysadmin(c.user)
@@ -257,7 +205,7 @@ class UserController(BaseController):
             message_content += '<br><br> You can contact the maintainer on '\
                 'this email address: ' + reply_email
 
-        response = send_email(message_content, to, subject, file=file)
+        response = dispatch_email(message_content, to, subject, file=file)
 
         if response['success'] is False:
             error = {
@@ -0,0 +1,414 @@
+from sqlalchemy import or_
+
+from ckan import model
+
+MOST_RECENT = 'last_request_created_at'
+
+STATES = ['new', 'open', 'archive']
+
+
+def parse_order(order_by):
+    '''Returns how the archived requests are ordered for an ``order_by``
+    query parameter.
+
+    :param order_by: One of ``asc``, ``desc``, ``requests``, ``shared`` or
+        ``most_recent``.
+    :type order_by: string
+
+    :returns: the key to sort by, whether the order is descending and the
+        name of the order shown in the page
+    :rtype: tuple
+    '''
+
+    if 'shared' in order_by:
+        return 'shared', True, 'Sharing Rate'
+    elif 'requests' in order_by:
+        return 'requests', True, 'Requests Rate'
+    elif 'asc' in order_by:
+        return 'title', False, 'Alphabetical (A-Z)'
+    elif 'desc' in order_by:
+        return 'title', True, 'Alphabetical (Z-A)'
+
+    return MOST_RECENT, True, 'Most Recent'
+
+
+def parse_maintainer_filter(value):
+    '''Parses a ``filter_by_maintainers`` query parameter.
+
+    :param value: e.g. ``org:name|maintainers:user1,user2``
+    :type value: string
+
+    :returns: the organization name and the maintainer ids or names, or
+        ``None`` when all of the maintainers are selected
+    :rtype: tuple
+    '''
+
+    params = value.split('|')
+    org = params[0].split(':')[1]
+    maintainers = params[1].split(':')[1].split(',')
+
+    if maintainers[0] == '*all*':
+        return org, None
+
+    return org, maintainers
+
+
+def prefetch_users(keys):
+    '''Looks up the users with one query.
+
+    :param keys: The ids or names of the users, as stored in the maintainer
+        field of the datasets.
+    :type keys: iterable
+
+    :returns: the users keyed by both id and name
+    :rtype: dictionary
+    '''
+
+    keys = list(set(key for key in keys if key))
+
+    if not keys:
+        return {}
+
+    query = model.Session.query(model.User.id, model.User.name,
+                                model.User.fullname)\
+        .filter(or_(model.User.id.in_(keys), model.User.name.in_(keys)))
+
+    users = {}
+
+    for id, name, fullname in query:
+        user = {'id': id, 'name': name, 'fullname': fullname}
+        users[id] = user
+        users[name] = user
+
+    return users
+
+
+def prefetch_organizations(ids):
+    '''Looks up the organizations with one query.
+
+    :returns: the organizations keyed by id
+    :rtype: dictionary
+    '''
+
+    ids = list(set(id for id in ids if id))
+
+    if not ids:
+        return {}
+
+    query = model.Session.query(model.Group.id, model.Group.name,
+                                model.Group.title)\
+        .filter(model.Group.id.in_(ids))
+
+    return dict((id, {'id': id, 'name': name, 'title': title})
+                for id, name, title in query)
+
+
+def prefetch_senders(user_ids):
+    '''Looks up the organizations of the senders of the requests, and their
+    role in the first one, with one membership query.
+
+    As with ``organization_list_for_user``, these are the organizations the
+    sender is an admin of, or all of the organizations for sysadmins.
+
+    :param user_ids: The ``sender_user_id`` of the requests.
+    :type user_ids: iterable
+
+    :returns: the organizations, ordered by title, and the role in the first
+        one keyed by user id. Senders without organizations are left out.
+    :rtype: dictionary
+    '''
+
+    user_ids = list(set(id for id in user_ids if id))
+
+    if not user_ids:
+        return {}
+
+    sysadmins = set(id for (id,) in model.Session.query(model.User.id)
+                    .filter(model.User.id.in_(user_ids))
+                    .filter(model.User.sysadmin.is_(True)))
+
+    query = model.Session.query(model.Member.table_id,
+                                model.Member.capacity, model.Group.id,
+                                model.Group.name, model.Group.title)\
+        .join(model.Group, model.Group.id == model.Member.group_id)\
+        .filter(model.Member.table_name == 'user')\
+        .filter(model.Member.table_id.in_(user_ids))\
+        .filter(model.Member.state == 'active')\
+        .filter(model.Group.is_organization.is_(True))\
+        .filter(model.Group.state == 'active')\
+        .order_by(model.Group.title)
+
+    senders = {}
+    capacities = {}
+
+    for user_id, capacity, id, name, title in query:
+        capacities[(user_id, id)] = capacity
+
+        if user_id in sysadmins or capacity != 'admin':
+            continue
+        if user_id not in senders:
+            senders[user_id] = ([], capacity)
+
+        senders[user_id][0].append({'id': id, 'name': name, 'title': title})
+
+    if sysadmins:
+        query = model.Session.query(model.Group.id, model.Group.name,
+                                    model.Group.title)\
+            .filter(model.Group.is_organization.is_(True))\
+            .filter(model.Group.state == 'active')\
+            .order_by(model.Group.title)
+        orgs = [{'id': id, 'name': name, 'title': title}
+                for id, name, title in query]
+
+        if orgs:
+            for user_id in sysadmins:
+                senders[user_id] = (
+                    orgs, capacities.get((user_id, orgs[0]['id']), ''))
+
+    return senders
+
+
+def sender_ids(requests):
+    '''Returns the ids of the senders of the requests, including the
+    archived requests grouped by dataset, to prefetch them.'''
+
+    ids = set()
+
+    for item in requests:
+        if 'requests_archived' in item:
+            ids.update(sender_ids(item['requests_archived']))
+        else:
+            ids.add(item.get('sender_user_id'))
+
+    return ids
+
+
+def maintainer_keys(requests):
+    '''Returns the ids or names of all of the maintainers of the requests'
+    datasets, to prefetch them.'''
+
+    keys = set()
+
+    for item in requests:
+        keys.update(_maintainer_keys(item))
+
+    return keys
+
+
+def user_ids(keys, users):
+    '''Returns the ids of the users given by id or name, skipping the ones
+    that don't exist.
+
+    :param users: The users, see ``prefetch_users``.
+    :type users: dictionary
+
+    :rtype: list of strings
+    '''
+
+    return sorted(set(users[key]['id'] for key in keys if key in users))
+
+
+def build_dashboard(requests, users, counters=None, maintainer_counts=None,
+                    order=MOST_RECENT, reverse=True):
+    '''Builds the view model of a requested data page in one pass over the
+    requests.
+
+    :param requests: The requests, as returned by the request list actions.
+        Requests of datasets that no longer exist are skipped.
+    :type requests: list of dictionaries
+    :param users: The maintainers, see ``prefetch_users``.
+    :type users: dictionary
+    :param counters: The counters of the datasets keyed by package id, used
+        to order by ``shared`` or ``requests`` (optional).
+    :type counters: dictionary
+    :param maintainer_counts: The number of requests of each maintainer
+        keyed by user id, see ``requestdata_request_count_by_maintainer``.
+        Used for the ``maintainers`` when the requests are filtered by
+        maintainer, otherwise they are counted from the requests
+        (optional).
+    :type maintainer_counts: dictionary
+    :param order: The key to sort the archived requests by, ``None`` keeps
+        them grouped by package id.
+    :type order: string
+    :param reverse: Whether the archived requests are sorted descending.
+    :type reverse: bool
+
+    :returns: the ``requests_new``, ``requests_open`` and
+        ``requests_archive`` (grouped by dataset) and the ``maintainers`` of
+        all of the requests with their ``count``, most requested first
+    :rtype: dictionary
+    '''
+
+    buckets = dict((state, []) for state in STATES)
+    archive = {}
+    counts = {}
+
+    for item in requests:
+        if item['owner_org'] is None:
+            # package was not found, possibly purged
+            continue
+
+        item['maintainers'] = _maintainers(item, users)
+
+        if maintainer_counts is None:
+            for payload in item['maintainers']:
+                key = payload['id']
+
+                if key in counts:
+                    counts[key]['count'] += 1
+                else:
+                    counts[key] = dict(payload, count=1)
+
+        if counters is not None:
+            count = counters.get(item['package_id'])
+
+            if count:
+                item['shared'] = count['shared']
+                item['requests'] = count['requests']
+
+        if item['state'] not in buckets:
+            continue
+
+        buckets[item['state']].append(item)
+
+        if item['state'] == 'archive':
+            _add_to_archive(archive, item, order)
+
+    if order is None:
+        archive = sorted(archive.values(), key=lambda x: x['package_id'])
+    else:
+        archive = sorted(archive.values(), key=lambda x: x[order],
+                         reverse=reverse)
+
+    if maintainer_counts is not None:
+        counts = _count_maintainers(maintainer_counts, users)
+
+    return {
+        'requests_new': buckets['new'],
+        'requests_open': buckets['open'],
+        'requests_archive': archive,
+        'maintainers': sorted(counts.values(), key=lambda x: x['count'],
+                              reverse=True)
+    }
+
+
+def build_archive(groups, users):
+    '''Adds the maintainers to the archived requests grouped by dataset,
+    see ``requestdata_request_archive_for_organization``.
+
+    :param users: The maintainers, see ``prefetch_users``.
+    :type users: dictionary
+
+    :returns: the groups
+    :rtype: list of dictionaries
+    '''
+
+    for group in groups:
+        for item in group['requests_archived']:
+            item['maintainers'] = _maintainers(item, users)
+
+        # The dataset's maintainers are taken from its most recent request
+        group['maintainers'] = group['requests_archived'][0]['maintainers'] \
+            if group['requests_archived'] else []
+
+    return groups
+
+
+def group_by_organization(requests, organizations):
+    '''Groups the requests by the organization of their dataset, keeping
+    the order of the requests.
+
+    :param organizations: The organizations, see
+        ``prefetch_organizations``. Requests of other organizations are
+        skipped.
+    :type organizations: dictionary
+
+    :returns: the organizations, in the order of their first request, each
+        with its ``requests``
+    :rtype: list of dictionaries
+    '''
+
+    grouped = {}
+    ordered = []
+
+    for item in requests:
+        org = organizations.get(item['owner_org'])
+
+        if org is None:
+            continue
+
+        if org['id'] not in grouped:
+            grouped[org['id']] = dict(org, requests=[])
+            ordered.append(grouped[org['id']])
+
+        grouped[org['id']]['requests'].append(item)
+
+    return ordered
+
+
+def _maintainer_keys(item):
+    return (item['package_maintainer'] or '').split(',')
+
+
+def _maintainers(item, users):
+    maintainers = []
+
+    for key in _maintainer_keys(item):
+        user = users.get(key)
+
+        if user is None:
+            continue
+
+        name = user['fullname'] or user['name']
+        maintainers.append({
+            'id': key,
+            'name': name,
+            'username': user['name'],
+            'fullname': name
+        })
+
+    return maintainers
+
+
+def _count_maintainers(maintainer_counts, users):
+    counts = {}
+
+    for user_id, count in maintainer_counts.items():
+        user = users.get(user_id)
+
+        if user is None:
+            continue
+
+        name = user['fullname'] or user['name']
+        counts[user_id] = {
+            'id': user_id,
+            'name': name,
+            'username': user['name'],
+            'fullname': name,
+            'count': count
+        }
+
+    return counts
+
+
+def _add_to_archive(archive, item, order):
+    package_id = item['package_id']
+    group = archive.get(package_id)
+
+    if group is None:
+        # The dataset's fields are taken from its most recent request
+        group = {
+            'package_id': package_id,
+            'title': item.get('title'),
+            'maintainers': item.get('maintainers'),
+            'requests_archived': [],
+            'shared': item.get('shared'),
+            'requests': item.get('requests')
+        }
+
+        if order == MOST_RECENT:
+            group[MOST_RECENT] = item.get('created_at')
+
+        archive[package_id] = group
+
+    group['requests_archived'].append(item)
@@ -0,0 +1,169 @@
+import re
+import logging
+
+try:
+    # CKAN 2.7 and later
+    from ckan.common import config
+except ImportError:
+    # CKAN 2.6 and earlier
+    from pylons import config
+
+log = logging.getLogger(__name__)
+
+TEMPLATE_KEYS = ['email_header', 'email_body', 'email_footer']
+
+PLACEHOLDER = re.compile(
+    r'\{(name|data_maintainers|dataset|organization|message|email)\}')
+
+_cache = {'key': None, 'renderer': None}
+
+
+class EmailTemplateRenderer(object):
+    '''Renders the email sent to the maintainers of a dataset when a new
+    request is made, from the header, body and footer configured in the
+    admin dashboard.
+
+    The templates are split into literal text and placeholders once, so
+    rendering is a single join per template. Rendering uses only the
+    values of the context passed in, see ``render``.
+
+    '''
+
+    def __init__(self, header, body, footer, site_url, site_title,
+                 newsletter_url, twitter_url, contact_email):
+        # Without a body and footer the message is sent as it is
+        self.message_only = not body and not footer
+        self.header = _compile(header or '')
+        self.body = _compile(body or '')
+        self.footer = _compile(footer or '')
+        self.site_title = site_title
+        self.site_footer = """
+        <br/><br/>
+        <small>
+          <p>
+            <a href=" """ + site_url + """ ">""" + site_title + """</a>
+          </p>
+          <p>
+            <a href=" """ + newsletter_url + """ ">\
+            Sign up for our newsletter</a> | \
+            <a href=" """ + twitter_url + """ ">Follow us on Twitter</a>\
+             | <a href="mailto:""" + contact_email + """ ">Contact us</a>
+          </p>
+        </small>
+
+    """
+
+    def render(self, context):
+        '''Renders the email.
+
+        :param context: The prefetched values of the request, with the
+            ``name`` and ``email`` of the sender, the ``message``, the
+            sender's ``organization``, the ``data_maintainers`` names, the
+            ``dataset_name`` and ``dataset_url``, whether the sender
+            ``is_sysadmin``, whether the email goes ``only_org_admins``
+            because the maintainers don't exist, the ``requests_url`` where
+            the request can be handled and optionally the
+            ``organization_requests_url``.
+        :type context: dictionary
+
+        :rtype: string
+        '''
+
+        if self.message_only:
+            return context['message']
+
+        values = self._values(context)
+
+        body = _render(self.body, values)
+
+        if context['only_org_admins']:
+            body += '<br><br> This dataset\'s maintainer does not exist.'\
+                ' Go to your organisation\'s <a href="' +\
+                context['requests_url'] + '">Requested Data</a> page to'\
+                ' see the new request. Please also edit the dataset and'\
+                ' assign a new maintainer.'
+        else:
+            body += '<br><br><strong> Please accept or decline the request'\
+                ' as soon as you can by visiting the <a href="' +\
+                context['requests_url'] + '">My Requests</a> page.</strong>'
+
+            if context.get('organization_requests_url'):
+                body += '<br><br> Go to <a href="' +\
+                    context['organization_requests_url'] + '">Requested'\
+                    ' data</a> page in organization admin.'
+
+        return _render(self.header, values) + '<br><br>' + body +\
+            '<br><br>' + _render(self.footer, values) + self.site_footer
+
+    def _values(self, context):
+        dataset = context['dataset_name'] or ''
+
+        if dataset:
+            dataset = '<a href="' + context['dataset_url'] + '">' +\
+                dataset + '</a>'
+
+        organization = context['organization']
+
+        if context['is_sysadmin']:
+            organization = self.site_title
+
+        return {
+            'name': context['name'],
+            'data_maintainers':
+                _join_names(context['data_maintainers']),
+            'dataset': dataset,
+            'organization': organization,
+            'message': context['message'],
+            'email': context['email']
+        }
+
+
+def get_renderer():
+    '''Returns the renderer for the configured email templates. It is
+    compiled again only when the configuration has changed.
+
+    :rtype: EmailTemplateRenderer
+    '''
+
+    site_url = config.get('ckan.site_url')
+    settings = (
+        tuple(config.get(key) for key in TEMPLATE_KEYS) + (
+            site_url,
+            config.get('ckan.site_title'),
+            config.get('ckanext.requestdata.newsletter_url', site_url),
+            config.get('ckanext.requestdata.twitter_url',
+                       'https://twitter.com'),
+            config.get('ckanext.requestdata.contact_email', '')))
+
+    if _cache['key'] != settings:
+        log.debug('Compiling the request email templates.')
+        _cache['renderer'] = EmailTemplateRenderer(*settings)
+        _cache['key'] = settings
+
+    return _cache['renderer']
+
+
+def invalidate():
+    '''Discards the compiled templates, e.g. after they were updated.'''
+
+    _cache['key'] = None
+    _cache['renderer'] = None
+
+
+def _compile(template):
+    # re.split alternates literal text and placeholder names
+    parts = PLACEHOLDER.split(template)
+
+    return [(i % 2 == 1, part) for i, part in enumerate(parts) if part]
+
+
+def _render(parts, values):
+    return ''.join(values[part] if is_placeholder else part
+                   for is_placeholder, part in parts)
+
+
+def _join_names(names):
+    if len(names) < 2:
+        return ''.join(names)
+
+    return ', '.join(names[:-1]) + ' and ' + names[-1]
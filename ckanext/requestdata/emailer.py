@@ -1,13 +1,21 @@
 import logging
 import smtplib
 import cgi
+import datetime
+import threading
+import time
 from socket import error as socket_error
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.MIMEBase import MIMEBase
 from email import Encoders
-from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPRecipientsRefused, SMTPException,\
+    SMTPServerDisconnected
 from pylons import config
+from paste.deploy.converters import asbool, asint
+
+from ckanext.requestdata import metrics
+from ckanext.requestdata.model import ckanextRequestdataEmailOutbox
 
 
 log = logging.getLogger(__name__)
@@ -17,6 +25,18 @@ SMTP_USER = config.get('smtp.user', '')
 SMTP_PASSWORD = config.get('smtp.password', '')
 SMTP_FROM = config.get('smtp.mail_from')
 
+# When enabled, the emails are stored in the outbox and delivered by the
+# `paster requestdata send-emails` worker instead of inside the web request
+EMAIL_QUEUE = asbool(config.get('ckanext.requestdata.email_queue', False))
+EMAIL_MAX_ATTEMPTS = \
+    asint(config.get('ckanext.requestdata.email_max_attempts', 5))
+# Seconds before the first retry, doubled after each failed attempt
+EMAIL_RETRY_DELAY = \
+    asint(config.get('ckanext.requestdata.email_retry_delay', 60))
+EMAIL_MAX_RETRY_DELAY = 6 * 60 * 60
+# How long a worker reserves an email while it is being sent
+EMAIL_LEASE = datetime.timedelta(minutes=10)
+
 
 def send_email(content, to, subject, file=None):
     '''Sends email
@@ -32,15 +52,130 @@ def send_email(content, to, subject, file=None):
 
        '''
 
-    msg = MIMEMultipart()
+    to = _recipients(to)
+    attachment, extension = _read_attachment(file)
+    msg = build_message(content, to, subject, attachment, extension)
+
+    try:
+        deliver(to, msg)
+        response_dict = {
+            'success': True,
+            'message': 'Email message was successfully sent.'
+        }
+        return response_dict
+    except SMTPRecipientsRefused:
+        error = {
+            'success': False,
+            'error': {
+                'fields': {
+                    'recepient': 'Invalid email recepient, maintainer not '
+                    'found'
+                }
+            }
+        }
+        return error
+    except socket_error:
+        log.critical('Could not connect to email server. Have you configured '
+                     'the SMTP settings?')
+        error_dict = {
+            'success': False,
+            'message': 'An error occured while sending the email. Try again.'
+        }
+        return error_dict
 
-    from_ = SMTP_FROM
 
-    if isinstance(to, basestring):
-        to = [to]
+def queue_email(content, to, subject, file=None):
+    '''Stores the email in the outbox, it is delivered by the
+    `paster requestdata send-emails` worker.
+
+    Takes the same parameters as ``send_email``.
+
+    :rtype: dictionary
+    '''
+
+    to = _recipients(to)
+    attachment, extension = _read_attachment(file)
+
+    ckanextRequestdataEmailOutbox.enqueue(to, subject, content,
+                                          attachment=attachment,
+                                          attachment_extension=extension)
+
+    return {
+        'success': True,
+        'message': 'Email message was queued for delivery.'
+    }
+
+
+def dispatch_email(content, to, subject, file=None):
+    '''Queues the email when the outbox is enabled with
+    ``ckanext.requestdata.email_queue``, otherwise sends it right away.'''
+
+    if EMAIL_QUEUE:
+        return queue_email(content, to, subject, file=file)
+
+    return send_email(content, to, subject, file=file)
+
+
+def send_queued_emails(limit=100):
+    '''Delivers the emails of the outbox that are due.
+
+    A failed email is retried with an exponential backoff until it has
+    been attempted ``ckanext.requestdata.email_max_attempts`` times. Emails
+    refused by the server for all of the recipients are not retried.
+
+    :param limit: The maximum number of emails to deliver.
+    :type limit: int
+
+    :returns: the number of emails that were sent and that failed
+    :rtype: dictionary
+    '''
+
+    result = {'sent': 0, 'failed': 0}
+
+    for email in ckanextRequestdataEmailOutbox.due(limit,
+                                                   EMAIL_MAX_ATTEMPTS):
+        if not email.claim(EMAIL_LEASE, EMAIL_MAX_ATTEMPTS):
+            continue
+
+        to = email.recipients.split(',')
+
+        try:
+            msg = build_message(email.content, to, email.subject,
+                                email.attachment, email.attachment_extension)
+            deliver(to, msg)
+        except SMTPRecipientsRefused as e:
+            log.warning('Email %s was refused: %r', email.id, e)
+            email.mark_failed(repr(e))
+            result['failed'] += 1
+        except Exception as e:
+            if isinstance(e, (SMTPException, socket_error)):
+                log.warning('Could not send email %s (attempt %s): %r',
+                            email.id, email.attempts, e)
+            else:
+                # Any other error is retried as well, it must not stop the
+                # worker while the email stays claimed
+                log.exception('Could not build or send email %s (attempt '
+                              '%s)', email.id, email.attempts)
+
+            email.mark_failed(repr(e), retry_at=_retry_at(email.attempts))
+            result['failed'] += 1
+        else:
+            email.mark_sent()
+            result['sent'] += 1
+
+    return result
+
+
+def build_message(content, to, subject, attachment=None, extension=None):
+    '''Builds the HTML email, with the optional attachment.
+
+    :rtype: email.mime.multipart.MIMEMultipart
+    '''
+
+    msg = MIMEMultipart()
 
     msg['Subject'] = subject
-    msg['From'] = from_
+    msg['From'] = SMTP_FROM
     msg['To'] = ','.join(to)
 
     content = """\
@@ -54,46 +189,164 @@ def send_email(content, to, subject, file=None):
 
     msg.attach(MIMEText(content, 'html', _charset='utf-8'))
 
-    if isinstance(file, cgi.FieldStorage):
+    if attachment is not None:
         part = MIMEBase('application', 'octet-stream')
-        part.set_payload(file.file.read())
+        part.set_payload(attachment)
         Encoders.encode_base64(part)
 
-        extension = file.filename.split('.')[-1]
-
         header_value = 'attachment; filename=attachment.{0}'.format(extension)
 
         part.add_header('Content-Disposition', header_value)
 
         msg.attach(part)
 
+    return msg
+
+
+def deliver(to, msg):
+    '''Sends the message through a pooled connection to the configured
+    SMTP server. A pooled connection that was closed by the server is
+    replaced by a new one and the message is sent again.
+
+    :raises: smtplib.SMTPException or socket.error when the message could
+        not be sent
+    '''
+
+    msg = msg.as_string()
+    start = time.time()
+
     try:
-        s = smtplib.SMTP(SMTP_SERVER)
-        if SMTP_USER:
-            s.login(SMTP_USER, SMTP_PASSWORD)
-        s.sendmail(from_, to, msg.as_string())
-        s.quit()
-        response_dict = {
-            'success': True,
-            'message': 'Email message was successfully sent.'
-        }
-        return response_dict
-    except SMTPRecipientsRefused:
-        error = {
-            'success': False,
-            'error': {
-                'fields': {
-                    'recepient': 'Invalid email recepient, maintainer not '
-                    'found'
-                }
-            }
-        }
-        return error
-    except socket_error:
-        log.critical('Could not connect to email server. Have you configured '
-                     'the SMTP settings?')
-        error_dict = {
-            'success': False,
-            'message': 'An error occured while sending the email. Try again.'
-        }
-        return error_dict
+        _deliver(to, msg)
+    except Exception as e:
+        metrics.email_failures.inc(type=_failure_type(e))
+        raise
+    finally:
+        metrics.email_send_seconds.time(start)
+
+
+def _deliver(to, msg):
+    for attempt in range(2):
+        connection = smtp_pool.acquire()
+
+        try:
+            connection.sendmail(SMTP_FROM, to, msg)
+        except SMTPServerDisconnected:
+            smtp_pool.discard(connection)
+
+            if attempt:
+                raise
+
+            log.debug('SMTP connection was closed, reconnecting.')
+        except Exception:
+            smtp_pool.discard(connection)
+            raise
+        else:
+            smtp_pool.release(connection)
+            return
+
+
+class SMTPConnectionPool(object):
+    '''Keeps authenticated SMTP connections open, so consecutive emails
+    are sent in the same session.
+
+    A connection is used by one thread at a time. Connections that were
+    idle for longer than ``idle_timeout`` seconds are closed instead of
+    being reused, and at most ``size`` idle connections are kept.
+
+    '''
+
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        now = time.time()
+
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+
+                if now - last_used <= self.idle_timeout:
+                    return connection
+
+                self._close(connection)
+
+        return self._connect()
+
+    def release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((connection, time.time()))
+                return
+
+        self._close(connection)
+
+    def discard(self, connection):
+        self._close(connection)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, last_used in idle:
+            self._close(connection)
+
+    def _connect(self):
+        connection = smtplib.SMTP(SMTP_SERVER)
+
+        try:
+            if SMTP_USER:
+                connection.login(SMTP_USER, SMTP_PASSWORD)
+        except Exception:
+            self._close(connection)
+            raise
+
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.quit()
+        except (SMTPException, socket_error):
+            connection.close()
+
+
+smtp_pool = SMTPConnectionPool(
+    asint(config.get('ckanext.requestdata.smtp_pool_size', 4)),
+    asint(config.get('ckanext.requestdata.smtp_idle_timeout', 60)))
+
+
+def _recipients(to):
+    if isinstance(to, basestring):
+        to = [to]
+
+    return to
+
+
+def _read_attachment(file):
+    if not isinstance(file, cgi.FieldStorage):
+        return None, None
+
+    return file.file.read(), file.filename.split('.')[-1]
+
+
+def _retry_delay(attempts):
+    return min(EMAIL_RETRY_DELAY * 2 ** (attempts - 1), EMAIL_MAX_RETRY_DELAY)
+
+
+def _retry_at(attempts):
+    # None gives up on the email once it was attempted too many times
+    if attempts >= EMAIL_MAX_ATTEMPTS:
+        return None
+
+    return datetime.datetime.now() + \
+        datetime.timedelta(seconds=_retry_delay(attempts))
+
+
+def _failure_type(error):
+    # socket.error is named "error", its subclasses have meaningful names
+    if type(error) is socket_error:
+        return 'socket_error'
+
+    return type(error).__name__
@@ -5,6 +5,7 @@ from operator import itemgetter
 import json
 
 from paste.deploy.converters import asbool
+from sqlalchemy import or_
 
 from ckan import model, logic
 from ckan.common import c, _, request
@@ -12,6 +13,9 @@ from ckan.lib import base
 from ckan.plugins import toolkit
 from ckan.model.user import User
 
+from ckanext.requestdata.cache import maintainer_emails, current_user,\
+    maintainer_set
+
 try:
     # CKAN 2.7 and later
     from ckan.common import config
@@ -97,19 +101,71 @@ def get_request_counters(id):
     return counters
 
 
+def get_request_counters_many(package_ids):
+    '''
+        Returns the counters for many packages with a single query
+
+       :param package_ids: The ids of the packages the requests belong to.
+       :type package_ids: list of strings
+
+       :returns: the counters keyed by package id
+       :rtype: dictionary
+
+     '''
+
+    data_dict = {'package_ids': list(package_ids)}
+    counters = _get_action('requestdata_request_data_counters_get_many',
+                           data_dict)
+    return counters
+
+
 def convert_id_to_email(ids):
+    '''Returns the emails of the maintainers of a dataset. Ids or names that
+    aren't users are returned as they are.
+
+    The emails are cached per process, the ones that aren't cached are
+    looked up with one query.
+
+    :param ids: The ids or names of the maintainers, separated by commas.
+    :type ids: string
+
+    :rtype: string
+
+    '''
+
     ids = ids.split(',')
-    emails = []
+    emails = {}
+    missing = []
 
     for id in ids:
-        user = User.get(id)
+        email = maintainer_emails.get(id)
 
-        if user:
-            emails.append(user.email)
+        if email is None:
+            missing.append(id)
         else:
-            emails.append(id)
+            emails[id] = email
+
+    if missing:
+        emails.update(_lookup_emails(missing))
+
+    return ','.join(emails[id] for id in ids)
+
+
+def _lookup_emails(keys):
+    keys = list(set(keys))
+    emails = dict((key, key) for key in keys)
+    users = model.Session.query(User.id, User.name, User.email)\
+        .filter(or_(User.id.in_(keys), User.name.in_(keys)))
+
+    for id, name, email in users:
+        for key in (id, name):
+            if key in emails:
+                emails[key] = email or ''
 
-    return ','.join(emails)
+    for key, email in emails.items():
+        maintainer_emails.set(key, email)
+
+    return emails
 
 
 def group_archived_requests_by_dataset(requests):
@@ -160,15 +216,23 @@ def is_hdx_portal():
 
 
 def is_current_user_a_maintainer(maintainers):
-    if c.user:
-        current_user = _get_action('user_show', {'id': c.user})
-        user_id = current_user.get('id')
-        user_name = current_user.get('name')
+    '''Returns whether the logged in user is one of the maintainers of a
+    dataset, without any action calls.
 
-        if user_id in maintainers or user_name in maintainers:
-            return True
+    :param maintainers: The maintainer field of the dataset, ids or names
+        separated by commas.
+    :type maintainers: string
 
-    return False
+    :rtype: bool
+
+    '''
+
+    user = current_user()
+
+    if user is None:
+        return False
+
+    return bool(maintainer_set(maintainers) & set(user))
 
 
 def get_orgs_for_user(user_id):
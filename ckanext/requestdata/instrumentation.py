@@ -0,0 +1,216 @@
+import time
+import logging
+import functools
+import threading
+
+from paste.deploy.converters import asbool
+from sqlalchemy import event
+
+try:
+    # CKAN 2.7 and later
+    from ckan.common import config
+except ImportError:
+    # CKAN 2.6 and earlier
+    from pylons import config
+
+log = logging.getLogger(__name__)
+
+ENABLED = asbool(config.get('ckanext.requestdata.instrumentation', False))
+
+HEADER = 'X-Requestdata-Queries'
+
+_local = threading.local()
+_installed = set()
+
+
+class QueryStats(object):
+    '''The statements executed for an action or an HTTP request, with their
+    total duration and the number of rows they returned or changed.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.duration = 0.0
+        self.rows = 0
+
+    def add(self, duration, rows):
+        self.statements += 1
+        self.duration += duration
+        self.rows += max(rows, 0)
+
+    def __str__(self):
+        return 'statements={0}; time={1:.1f}ms; rows={2}'.format(
+            self.statements, self.duration * 1000, self.rows)
+
+
+class RequestStats(QueryStats):
+    '''The statements of an HTTP request, with the statements of each
+    ``requestdata_*`` action called while handling it.'''
+
+    def __init__(self, name):
+        super(RequestStats, self).__init__(name)
+        self.actions = {}
+        self.stack = []
+
+    def enter(self, action):
+        stats = self.actions.get(action)
+
+        if stats is None:
+            stats = self.actions[action] = QueryStats(action)
+
+        self.stack.append(stats)
+
+    def leave(self):
+        self.stack.pop()
+
+    def add(self, duration, rows):
+        super(RequestStats, self).add(duration, rows)
+
+        # Nested actions are attributed to the innermost one
+        if self.stack:
+            self.stack[-1].add(duration, rows)
+
+
+def current():
+    '''Returns the statistics of the current HTTP request or action call,
+    ``None`` when nothing is instrumented.
+
+    :rtype: RequestStats
+    '''
+
+    return getattr(_local, 'stats', None)
+
+
+def install(engine):
+    '''Listens to the statements executed by an engine, so they are counted
+    for the current request, see ``current``.'''
+
+    if engine in _installed:
+        return
+
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    _installed.add(engine)
+
+    log.info('Requestdata query instrumentation is enabled.')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('requestdata_query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get('requestdata_query_start')
+
+    if not starts:
+        return
+
+    start = starts.pop()
+    stats = current()
+
+    if stats is not None:
+        stats.add(time.time() - start, cursor.rowcount)
+
+
+def instrument_action(name, action):
+    '''Wraps an action so the statements it executes are attributed to it.
+    Called outside of an HTTP request, e.g. from a command, the action's
+    statements are logged on their own.
+
+    :param name: The name the action is registered with.
+    :type name: string
+    :param action: The action function.
+    :type action: function
+
+    :rtype: function
+    '''
+
+    @functools.wraps(action)
+    def wrapper(context, data_dict):
+        stats = current()
+        owner = stats is None
+
+        if owner:
+            stats = _local.stats = RequestStats(name)
+
+        stats.enter(name)
+
+        try:
+            return action(context, data_dict)
+        finally:
+            stats.leave()
+
+            if owner:
+                _local.stats = None
+                log.debug('%s: %s', name, stats)
+
+    return wrapper
+
+
+def instrument_actions(actions):
+    '''Wraps each of the actions with ``instrument_action``.
+
+    :param actions: The actions keyed by name.
+    :type actions: dictionary
+
+    :rtype: dictionary
+    '''
+
+    return dict((name, instrument_action(name, action))
+                for name, action in actions.items())
+
+
+class QueryStatsMiddleware(object):
+    '''Counts the statements of each HTTP request and adds them to the
+    response in the ``X-Requestdata-Queries`` header, when the request was
+    handled by a requestdata controller or called a requestdata action.
+
+    The header is added when the response starts, statements executed while
+    a response is streamed are not counted.
+
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        stats = _local.stats = RequestStats(environ.get('PATH_INFO'))
+
+        def _start_response(status, headers, exc_info=None):
+            stats.name = _route_name(environ) or stats.name
+
+            if _is_requestdata(environ, stats):
+                headers = list(headers) + [(HEADER, str(stats))]
+
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.app(environ, _start_response)
+        finally:
+            _local.stats = None
+
+            if _is_requestdata(environ, stats):
+                log.debug('%s: %s', stats.name, stats)
+
+                for action in sorted(stats.actions.values(),
+                                     key=lambda x: x.duration, reverse=True):
+                    log.debug('  %s: %s', action.name, action)
+
+
+def _route_name(environ):
+    routes = environ.get('wsgiorg.routing_args', (None, {}))[1] or {}
+
+    if not routes.get('controller'):
+        return None
+
+    return '{0}:{1}'.format(routes['controller'], routes.get('action'))
+
+
+def _is_requestdata(environ, stats):
+    routes = environ.get('wsgiorg.routing_args', (None, {}))[1] or {}
+    controller = routes.get('controller') or ''
+
+    return controller.startswith('ckanext.requestdata.') or \
+        bool(stats.actions)
@@ -1,13 +1,31 @@
 import datetime
 
+from sqlalchemy import or_
+
 from ckan.plugins import toolkit
 from ckan.logic import check_access, NotFound
 import ckan.lib.navl.dictization_functions as df
+from ckan.model.meta import Session
 from ckan.model.user import User
+from ckanext.requestdata import metrics
 from ckanext.requestdata.logic import schema
+from ckanext.requestdata.cache import notification_flags
 from ckanext.requestdata.model import ckanextRequestdata,\
-    ckanextUserNotification, ckanextMaintainers, ckanextRequestDataCounters
-from ckanext.requestdata import helpers
+    ckanextUserNotification, ckanextMaintainers, ckanextRequestDataCounters,\
+    ckanextRequestdataPackages, ckanextRequestdataOrgStats, encode_cursor,\
+    package_fields, STATE_COLUMNS
+
+LIST_FILTERS = ['state', 'package_id', 'created_after', 'created_before',
+                'after', 'maintainer_ids']
+
+# Counters incremented for each flag of increment_request_data_counters
+COUNTER_FLAGS = {
+    'request': ['requests'],
+    'replied': ['replied'],
+    'declined': ['declined'],
+    'shared': ['shared'],
+    'shared and replied': ['shared', 'replied']
+}
 
 
 def request_create(context, data_dict):
@@ -62,28 +80,44 @@ def request_create(context, data_dict):
         'package_id': package_id
     }
 
+    # The request, its package projection and its maintainers are committed
+    # together by insert_all
     requestdata = ckanextRequestdata(**data)
-    requestdata.save()
+    Session.add(requestdata)
+    Session.flush()
+
+    # Maintainers are stored as ids, or as names on HDX
+    users = Session.query(User)\
+                   .filter(or_(User.id.in_(maintainers),
+                               User.name.in_(maintainers))).all()
+    users_by_key = {}
+
+    for user in users:
+        users_by_key[user.id] = user
+        users_by_key[user.name] = user
+
     maintainers_list = []
-    is_hdx = helpers.is_hdx_portal()
 
     for id in maintainers:
-        try:
-            if is_hdx:
-                main_ids = toolkit.get_action('user_show')(context, {'id': id})
-                user = User.get(main_ids['id'])
-            else:
-                user = User.get(id)
-            data = ckanextMaintainers()
-            data.maintainer_id = user.id
-            data.request_data_id = requestdata.id
-            data.email = user.email
-            maintainers_list.append(data)
-        except NotFound:
-            pass
+        user = users_by_key.get(id)
+
+        if user is not None:
+            maintainers_list.append({
+                'maintainer_id': user.id,
+                'email': user.email
+            })
+
+    # Keep the listings' copy of the package fields and the organization's
+    # statistics up to date
+    ckanextRequestdataPackages.refresh(package)
+    ckanextRequestdataOrgStats.adjust(
+        package.get('owner_org'), {STATE_COLUMNS['new']: 1},
+        last_request_at=requestdata.created_at)
 
     out = ckanextMaintainers.insert_all(maintainers_list, requestdata.id)
 
+    metrics.request_events.inc(event='created')
+
     return out
 
 
@@ -120,33 +154,83 @@ def request_show(context, data_dict):
 
 @toolkit.side_effect_free
 def request_list_for_sysadmin(context, data_dict):
-    '''Returns a list of all requests.
+    '''Returns a list of all requests, most recently modified first.
+
+    :param limit: Return at most this many requests and paginate the
+        results (optional).
+    :type limit: int
+
+    :param after: The ``next_after`` cursor returned with the previous page
+        (optional).
+    :type after: string
 
-    :rtype: list of dictionaries
+    :param state: Only return requests in this state (optional).
+    :type state: string
+
+    :param package_id: Only return requests for this dataset (optional).
+    :type package_id: string
+
+    :param created_after: Only return requests created after this date
+        (optional).
+    :type created_after: ISO 8601 string
+
+    :param created_before: Only return requests created before this date
+        (optional). A date without a time includes the whole day.
+    :type created_before: ISO 8601 string
+
+    :param maintainer_ids: Only return requests sent to one of these
+        maintainers (optional).
+    :type maintainer_ids: list of strings or comma separated string
+
+    :returns: a list of requests, or when ``limit`` is provided a
+        dictionary with the ``results`` of the page and the ``next_after``
+        cursor for the following one (``None`` on the last page).
+    :rtype: list of dictionaries or dictionary
+
+    Each request also carries the ``title``, ``package_name``,
+    ``owner_org``, ``package_maintainer`` and ``package_state`` of its
+    dataset, so listings don't need ``package_show``.
 
     '''
 
+    data, errors = df.validate(data_dict, schema.request_list_schema(),
+                               context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
     check_access('requestdata_request_list_for_sysadmin',
                  context, data_dict)
 
-    requests = ckanextRequestdata.search()
+    limit = data.get('limit')
 
-    out = []
+    requests = ckanextRequestdata.search_page(limit=_fetch_size(limit),
+                                              **_list_filters(data))
+    requests, next_after = _paginate(requests, limit,
+                                     lambda r: (r[0].modified_at, r[0].id))
 
-    for item in requests:
-        out.append(item.as_dict())
+    out = [_request_dict(request, package) for request, package in requests]
 
-    return out
+    return _list_response(out, limit, next_after)
 
 
 @toolkit.side_effect_free
 def request_list_for_organization(context, data_dict):
-    '''Returns a list of requests for specified organization.
+    '''Returns a list of requests for specified organization, most
+    recently modified first.
 
-    :param org_id: The organization id.
+    :param org_id: The organization id or name.
     :type org_id: string
 
-    :rtype: list of dictionaries
+    Accepts the same optional ``limit``, ``after``, ``state``,
+    ``package_id``, ``created_after``, ``created_before`` and
+    ``maintainer_ids`` parameters as
+    ``requestdata_request_list_for_sysadmin``.
+
+    :returns: a list of requests, or when ``limit`` is provided a
+        dictionary with the ``results`` of the page and the ``next_after``
+        cursor for the following one.
+    :rtype: list of dictionaries or dictionary
 
     '''
 
@@ -160,53 +244,173 @@ def request_list_for_organization(context, data_dict):
     check_access('requestdata_request_list_for_organization',
                  context, data_dict)
 
-    org_id = data.get('org_id')
-    org = toolkit.get_action('organization_show')(context, {'id': org_id})
+    org = get_organization(context, data.get('org_id'))
 
-    data_dict = {
-        'fq': 'organization:' + org['name'],
-        'rows': 1000000
-    }
+    limit = data.get('limit')
+
+    requests = ckanextRequestdata.search_by_organization(
+        org.id, limit=_fetch_size(limit), **_list_filters(data))
+    requests, next_after = _paginate(requests, limit,
+                                     lambda r: (r[0].modified_at, r[0].id))
 
-    packages = toolkit.get_action('package_search')(context, data_dict)
-    total_requests = []
-    for package in packages['results']:
-        data = {
-            'package_id': package['id']
-        }
-        requests = ckanextRequestdata.search(**data)
-        for item in requests:
-            total_requests.append(item.as_dict())
+    out = [_request_dict(request, package) for request, package in requests]
 
-    return total_requests
+    return _list_response(out, limit, next_after)
+
+
+@toolkit.side_effect_free
+def request_archive_for_organization(context, data_dict):
+    '''Returns the archived requests for the datasets of an organization,
+    grouped by dataset. The datasets are grouped, counted and ordered by
+    the database, so a page doesn't read the requests of the other pages.
+
+    :param org_id: The organization id or name.
+    :type org_id: string
+
+    :param order_by: How the datasets are ordered, by
+        ``last_request_created_at`` (default), ``title``, ``shared`` or
+        ``requests`` (optional).
+    :type order_by: string
+
+    :param reverse: Whether the datasets are sorted descending, defaults to
+        ``True`` (optional).
+    :type reverse: bool
+
+    :param limit: Maximum number of datasets to return (optional).
+    :type limit: int
+
+    :param offset: Number of datasets to skip (optional).
+    :type offset: int
+
+    :param maintainer_ids: Only return requests sent to one of these
+        maintainers (optional).
+    :type maintainer_ids: list of strings or comma separated string
+
+    :returns: the ``count`` of datasets and the ``total_requests`` archived
+        for all of the pages, and the ``results`` of the page, each with its
+        ``package_id``, ``title``, ``last_request_created_at``,
+        ``counters`` and ``requests_archived``
+    :rtype: dictionary
+
+    '''
+
+    data, errors = df.validate(
+        data_dict, schema.request_archive_for_organization_schema(), context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    check_access('requestdata_request_list_for_organization',
+                 context, data_dict)
+
+    org = get_organization(context, data['org_id'])
+
+    out = ckanextRequestdata.archive_by_organization(
+        org.id,
+        order=data.get('order_by', 'last_request_created_at'),
+        reverse=data.get('reverse', True),
+        limit=data.get('limit'),
+        offset=data.get('offset', 0),
+        maintainer_ids=data.get('maintainer_ids'))
+
+    for group in out['results']:
+        group['requests_archived'] = [
+            _request_dict(request, package)
+            for request, package in group['requests_archived']]
+        group['shared'] = group['counters']['shared']
+        group['requests'] = group['counters']['requests']
+
+    return out
 
 
 @toolkit.side_effect_free
 def request_list_for_current_user(context, data_dict):
-    '''Returns a list of requests.
+    '''Returns a list of requests for which the current user is a
+    maintainer, most recently modified first.
 
-    :param id: The id of a requestdata.
-    :type id: string
+    Accepts the same optional ``limit``, ``after``, ``state``,
+    ``package_id``, ``created_after`` and ``created_before`` parameters as
+    ``requestdata_request_list_for_sysadmin``.
 
-    :rtype: list of dictionaries
+    :returns: a list of requests, or when ``limit`` is provided a
+        dictionary with the ``results`` of the page and the ``next_after``
+        cursor for the following one.
+    :rtype: list of dictionaries or dictionary
 
     '''
 
+    data, errors = df.validate(data_dict, schema.request_list_schema(),
+                               context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
     check_access('requestdata_request_list_for_current_user',
                  context, data_dict)
 
     model = context['model']
     user_id = model.User.get(context['user']).id
 
-    requests = ckanextRequestdata.search_by_maintainers(user_id)
-    out = []
+    limit = data.get('limit')
+
+    requests = ckanextRequestdata.search_by_maintainers(
+        user_id, limit=_fetch_size(limit), **_list_filters(data))
+    out, next_after = _paginate(requests, limit,
+                                lambda r: (r['modified_at'], r['id']))
+
+    return _list_response(out, limit, next_after)
+
 
-    for item in requests:
-        out.append(item)
+def get_organization(context, org_id):
+    org = context['model'].Group.get(org_id)
+
+    # Group.get also finds groups that aren't organizations
+    if org is None or not org.is_organization:
+        raise NotFound('Organization with provided \'org_id\' cannot be '
+                       'found')
+
+    return org
+
+
+def _request_dict(request, package):
+    out = request.as_dict()
+    out.update(package_fields(package))
 
     return out
 
 
+def _list_filters(data):
+    return dict((key, data.get(key)) for key in LIST_FILTERS)
+
+
+def _fetch_size(limit):
+    # One extra row tells whether there is a following page
+    if limit is None:
+        return None
+
+    return limit + 1
+
+
+def _paginate(requests, limit, key):
+    next_after = None
+
+    if limit and len(requests) > limit:
+        requests = requests[:limit]
+        next_after = encode_cursor(*key(requests[-1]))
+
+    return requests, next_after
+
+
+def _list_response(requests, limit, next_after):
+    if limit is None:
+        return requests
+
+    return {
+        'results': requests,
+        'next_after': next_after
+    }
+
+
 def request_patch(context, data_dict):
     '''Patch a request.
 
@@ -251,12 +455,22 @@ def request_patch(context, data_dict):
     request_patch_schema.pop('package_id')
 
     fields = request_patch_schema.keys()
+    previous_state = request.state
 
     for field in fields:
         setattr(request, field, data.get(field))
 
     request.modified_at = datetime.datetime.now()
 
+    if request.state != previous_state:
+        # Moves the request between the counts of the organization's
+        # statistics, committed along with the request
+        package = ckanextRequestdataPackages.get(package_id=package_id)
+        ckanextRequestdataOrgStats.adjust(
+            package.owner_org if package else None,
+            {STATE_COLUMNS[previous_state]: -1,
+             STATE_COLUMNS[request.state]: 1})
+
     request.save()
 
     out = request.as_dict()
@@ -273,32 +487,22 @@ def request_delete(self):
 
 
 def notification_create(context, data_dict):
-    '''Create new notification data.
+    '''Marks the notifications of the maintainers as not seen, creating the
+    missing ones.
 
-    :param package_id: The id of the package the data belongs to.
-    :type package_id: string
+    :param users: The maintainers to notify, each with an ``id``.
+    :type users: list of dictionaries
 
-    :returns: the newly created notification data
-    :rtype: dictionary
+    :returns: the notifications of the maintainers
+    :rtype: list
 
     '''
-    not_seen = False
-    notifications = []
-    maintainers = data_dict['users']
-    for m in maintainers:
-        data = {
-            'package_maintainer_id': m['id'],
-            'seen': not_seen
-        }
-        user_notification = ckanextUserNotification(**data)
-        user_exist = ckanextUserNotification.get(package_maintainer_id=m['id'])
-        if user_exist is None:
-            user_notification.save()
-            notifications.append(user_notification)
-        else:
-            user_exist.seen = not_seen
-            user_exist.commit()
-            notifications.append(user_exist)
+    maintainer_ids = [m['id'] for m in data_dict['users']]
+    notifications = ckanextUserNotification.mark_unseen(maintainer_ids)
+
+    for maintainer_id in maintainer_ids:
+        notification_flags.set(maintainer_id, False)
+
     return notifications
 
 
@@ -310,15 +514,18 @@ def notification_for_current_user(context, data_dict):
 
     '''
 
-    model = context['model']
-    user_id = model.User.get(context['user']).id
-    notification = ckanextUserNotification.get(package_maintainer_id=user_id)
-    if notification is None:
-        # do not display notification
-        return True
-    else:
-        is_notified = notification.seen
-        return is_notified
+    user_obj = context.get('auth_user_obj') or \
+        context['model'].User.get(context['user'])
+    is_notified = notification_flags.get(user_obj.id)
+
+    if is_notified is None:
+        notification = \
+            ckanextUserNotification.get(package_maintainer_id=user_obj.id)
+        # do not display notification when there is none
+        is_notified = True if notification is None else notification.seen
+        notification_flags.set(user_obj.id, is_notified)
+
+    return is_notified
 
 
 @toolkit.side_effect_free
@@ -344,6 +551,7 @@ def notification_change(context, data_dict):
     if notification is not None:
         notification.seen = True
         notification.commit()
+        notification_flags.set(user_id, True)
         return notification
 
 
@@ -357,7 +565,12 @@ def increment_request_data_counters(context, data_dict):
        :param flag: The flag that indicates which counter to increment
        :type String
 
-       :return:
+       :param org_id: The owner organization of the package (optional).
+           Saves a lookup when the caller already knows it.
+       :type org_id: string
+
+       :return: the updated counters
+       :rtype: dictionary
      '''
     data, errors = df.validate(data_dict,
                                schema.increment_request_counters_schema(),
@@ -367,33 +580,17 @@ def increment_request_data_counters(context, data_dict):
 
     flag = data.get('flag')
     package_id = data.get('package_id')
-    package = toolkit.get_action('package_show')(context, {'id': package_id})
-    data = {
-        'package_id': package_id,
-        'org_id': package['owner_org']
-    }
+    org_id = data.get('org_id')
 
-    data_request = ckanextRequestDataCounters.get(package_id=package_id)
-    if data_request is None:
-        new_request = ckanextRequestDataCounters(**data)
-        new_request.requests = 1
-        new_request.save()
-        return new_request
-    else:
-        if flag == 'request':
-            data_request.requests += 1
-        elif flag == 'replied':
-            data_request.replied += 1
-        elif flag == 'declined':
-            data_request.declined += 1
-        elif flag == 'shared':
-            data_request.shared += 1
-        elif flag == 'shared and replied':
-            data_request.shared += 1
-            data_request.replied += 1
-
-        data_request.save()
-        return data_request
+    counters = ckanextRequestDataCounters.increment(package_id,
+                                                    COUNTER_FLAGS[flag],
+                                                    org_id=org_id)
+
+    for column in COUNTER_FLAGS[flag]:
+        if column != 'requests':
+            metrics.request_events.inc(event=column)
+
+    return counters
 
 
 @toolkit.side_effect_free
@@ -411,6 +608,35 @@ def request_data_counters_get(context, data_dict):
     return counters
 
 
+@toolkit.side_effect_free
+def request_data_counters_get_many(context, data_dict):
+    '''
+        Returns the counters for many packages at once
+
+       :param package_ids: The ids of the packages the requests belong to.
+       :type package_ids: list of strings
+
+       :returns: the counters keyed by package id
+       :rtype: dictionary
+
+     '''
+
+    data, errors = df.validate(data_dict,
+                               schema.request_data_counters_get_many_schema(),
+                               context)
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    package_ids = data.get('package_ids')
+
+    if isinstance(package_ids, basestring):
+        package_ids = package_ids.split(',')
+
+    counters = ckanextRequestDataCounters.search_by_packages(package_ids)
+
+    return counters
+
+
 @toolkit.side_effect_free
 def request_data_counters_get_all(context, data_dict):
     '''
@@ -440,3 +666,86 @@ def request_data_counters_get_by_org(context, data_dict):
     counters = ckanextRequestDataCounters.search_by_organization(**data)
 
     return counters
+
+
+@toolkit.side_effect_free
+def organization_stats(context, data_dict):
+    '''Returns the statistics of the requests of the organizations, read
+    from a table that is kept up to date as requests are created, patched
+    and counted.
+
+    :param org_id: Only return the statistics of this organization, given
+        by id or name (optional). Otherwise the statistics of every
+        organization with requests are returned, which is only allowed for
+        sysadmins.
+    :type org_id: string
+
+    :returns: the number of requests in each state (``requests_new``,
+        ``requests_open`` and ``requests_archive``), the ``requests``,
+        ``replied``, ``declined`` and ``shared`` counters and when the
+        ``last_request_at`` was made, keyed by organization id
+    :rtype: dictionary
+
+    '''
+
+    data, errors = df.validate(data_dict,
+                               schema.organization_stats_schema(), context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    if not data.get('org_id'):
+        check_access('requestdata_request_list_for_sysadmin',
+                     context, data_dict)
+
+        return ckanextRequestdataOrgStats.search()
+
+    check_access('requestdata_request_list_for_organization',
+                 context, data_dict)
+
+    org = get_organization(context, data['org_id'])
+
+    return {org.id: ckanextRequestdataOrgStats.get(org.id)}
+
+
+@toolkit.side_effect_free
+def request_count_by_maintainer(context, data_dict):
+    '''Returns how many requests each maintainer received for the active
+    public datasets of an organization, as in the request listing.
+
+    :param org_id: The organization id or name.
+    :type org_id: string
+
+    :returns: the number of requests keyed by maintainer id
+    :rtype: dictionary
+
+    '''
+
+    data, errors = df.validate(data_dict,
+                               schema.request_count_by_maintainer_schema(),
+                               context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    check_access('requestdata_request_list_for_organization',
+                 context, data_dict)
+
+    org = get_organization(context, data['org_id'])
+
+    return ckanextMaintainers.count_requests(org.id)
+
+
+@toolkit.side_effect_free
+def request_data_counters_get_all_by_org(context, data_dict):
+    '''
+        Return counters for requests of every organization at once
+
+       :returns: the counters keyed by organization id
+       :rtype: dictionary
+
+     '''
+
+    counters = ckanextRequestDataCounters.search_grouped_by_organization()
+
+    return counters
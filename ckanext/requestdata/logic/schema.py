@@ -5,11 +5,25 @@ from ckanext.requestdata.logic import validators
 
 not_missing = toolkit.get_validator('not_missing')
 not_empty = toolkit.get_validator('not_empty')
+ignore_missing = toolkit.get_validator('ignore_missing')
+default = toolkit.get_validator('default')
+one_of = toolkit.get_validator('OneOf')
+isodate = toolkit.get_validator('isodate')
+natural_number_validator = toolkit.get_validator('natural_number_validator')
+positive_integer_validator = \
+    toolkit.get_validator('positive_integer_validator')
 package_id_exists = toolkit.get_validator('package_id_exists')
 email_validator = validators.email_validator
 state_validator = validators.state_validator
+archive_order_validator = validators.archive_order_validator
 boolean_validator = validators.boolean_validator
 counters_validator = validators.request_counter_validator
+cursor_validator = validators.request_cursor_validator
+end_of_day_validator = validators.end_of_day_validator
+convert_to_list_if_string = toolkit.get_validator('convert_to_list_if_string')
+
+# File formats of the requests export, csv is the default
+EXPORT_FORMATS = [u'csv', u'json', u'jsonl']
 
 
 def request_create_schema():
@@ -38,9 +52,57 @@ def request_patch_schema():
     }
 
 
-def request_list_for_organization_schema():
+def request_list_schema():
     return {
+        'limit': [ignore_missing, positive_integer_validator],
+        'after': [ignore_missing, cursor_validator],
+        'state': [ignore_missing, state_validator],
+        'package_id': [ignore_missing, unicode],
+        'created_after': [ignore_missing, isodate],
+        'created_before': [ignore_missing, end_of_day_validator, isodate],
+        'maintainer_ids': [ignore_missing, convert_to_list_if_string]
+    }
+
+
+def request_export_schema():
+    return {
+        'format': [default(u'csv'), unicode, one_of(EXPORT_FORMATS)],
+        'org_id': [ignore_missing, unicode],
+        'state': [ignore_missing, state_validator],
+        'created_after': [ignore_missing, isodate],
+        'created_before': [ignore_missing, end_of_day_validator, isodate]
+    }
+
+
+def request_list_for_organization_schema():
+    schema = request_list_schema()
+    schema.update({
         'org_id': [not_empty]
+    })
+
+    return schema
+
+
+def request_archive_for_organization_schema():
+    return {
+        'org_id': [not_empty, unicode],
+        'order_by': [ignore_missing, archive_order_validator],
+        'reverse': [ignore_missing, boolean_validator],
+        'limit': [ignore_missing, positive_integer_validator],
+        'offset': [ignore_missing, natural_number_validator],
+        'maintainer_ids': [ignore_missing, convert_to_list_if_string]
+    }
+
+
+def organization_stats_schema():
+    return {
+        'org_id': [ignore_missing, unicode]
+    }
+
+
+def request_count_by_maintainer_schema():
+    return {
+        'org_id': [not_empty, unicode]
     }
 
 
@@ -59,5 +121,12 @@ def notification_change_schema():
 def increment_request_counters_schema():
     return{
         'package_id': [not_empty],
-        'flag': [counters_validator]
+        'flag': [counters_validator],
+        'org_id': [ignore_missing, unicode]
+    }
+
+
+def request_data_counters_get_many_schema():
+    return {
+        'package_ids': [not_missing]
     }
@@ -1,9 +1,13 @@
+import datetime
+
 from email_validator import validate_email
 from paste.deploy.converters import asbool
 
 from ckan.plugins.toolkit import _
 from ckan.plugins.toolkit import get_action
 
+from ckanext.requestdata.model import decode_cursor, ARCHIVE_ORDERS
+
 
 def email_validator(key, data, errors, context):
     email = data[key]
@@ -23,6 +27,13 @@ def state_validator(key, data, errors, context):
         errors[key].append(message)
 
 
+def archive_order_validator(key, data, errors, context):
+    if data[key] not in ARCHIVE_ORDERS:
+        message = _('The order_by parameter must be one of {0}.'
+                    .format(', '.join(ARCHIVE_ORDERS)))
+        errors[key].append(message)
+
+
 def boolean_validator(key, data, errors, context):
     data[key] = asbool(data[key])
     if not isinstance(data[key], bool):
@@ -86,3 +97,27 @@ def request_counter_validator(key, data, errors, context):
         message = _('The flag parameter must be request, replied, declined, '
                     'or shared')
         errors[key].append(message)
+
+
+def request_cursor_validator(key, data, errors, context):
+    try:
+        data[key] = decode_cursor(data[key])
+    except ValueError:
+        message = _('The after parameter is not a valid cursor.')
+        errors[key].append(message)
+
+
+def end_of_day_validator(key, data, errors, context):
+    # A date without a time stands for the end of that day, so the filters
+    # of created_before include the whole day. Runs before isodate.
+    value = data[key]
+
+    if not isinstance(value, basestring):
+        return
+
+    try:
+        day = datetime.datetime.strptime(value.strip(), '%Y-%m-%d')
+    except ValueError:
+        return
+
+    data[key] = datetime.datetime.combine(day.date(), datetime.time.max)
@@ -0,0 +1,197 @@
+import abc
+import time
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the buckets of the duration histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Metric(object):
+    '''A metric of the worker process, with a value for each combination of
+    the values of its labels.'''
+
+    __metaclass__ = abc.ABCMeta
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{0} expects the labels {1}'.format(
+                self.name, ', '.join(self.labelnames)))
+
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _labels(self, key, extra=None):
+        pairs = zip(self.labelnames, key) + (extra or [])
+
+        if not pairs:
+            return ''
+
+        return '{' + ','.join('{0}="{1}"'.format(name, _escape(value))
+                              for name, value in pairs) + '}'
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.type)]
+
+        with self._lock:
+            items = sorted(self._values.items())
+
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+
+        return lines
+
+    @abc.abstractmethod
+    def _render_value(self, key, value):
+        '''Returns the lines of the value of one combination of labels.'''
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        return ['{0}{1} {2}'.format(self.name, self._labels(key),
+                                    _format(value))]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [n + 1 if value <= bound else n
+                      for n, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, count + 1)
+
+    def time(self, start, **labels):
+        '''Observes the seconds since ``start``, a ``time.time()``.'''
+
+        self.observe(time.time() - start, **labels)
+
+    def get(self, **labels):
+        '''Returns the bucket counts, the sum and the count of the
+        observations.'''
+
+        with self._lock:
+            return self._values.get(self._key(labels),
+                                    ([0] * len(self.buckets), 0.0, 0))
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+
+        for n, bound in zip(counts, self.buckets):
+            lines.append('{0}_bucket{1} {2}'.format(
+                self.name, self._labels(key, [('le', _format(bound))]), n))
+
+        lines.extend([
+            '{0}_bucket{1} {2}'.format(
+                self.name, self._labels(key, [('le', '+Inf')]), count),
+            '{0}_sum{1} {2}'.format(self.name, self._labels(key),
+                                    _format(total)),
+            '{0}_count{1} {2}'.format(self.name, self._labels(key), count)
+        ])
+
+        return lines
+
+
+class Registry(object):
+    '''The metrics exposed by the worker process.'''
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+        return metric
+
+    def render(self):
+        '''Returns the metrics in the Prometheus text format.
+
+        :rtype: string
+        '''
+
+        lines = []
+
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n')\
+                         .replace('"', '\\"').encode('utf-8')
+
+
+registry = Registry()
+
+request_events = registry.register(Counter(
+    'requestdata_request_events_total',
+    'Data requests created, replied, declined and shared.',
+    ['event']))
+
+email_send_seconds = registry.register(Histogram(
+    'requestdata_email_send_seconds',
+    'Time spent delivering an email to the SMTP server.'))
+
+email_failures = registry.register(Counter(
+    'requestdata_email_failures_total',
+    'Emails that could not be delivered, by type of error.',
+    ['type']))
+
+dashboard_render_seconds = registry.register(Histogram(
+    'requestdata_dashboard_render_seconds',
+    'Time spent building and rendering the requested data dashboards.',
+    ['dashboard']))
+
+cache_lookups = registry.register(Counter(
+    'requestdata_cache_lookups_total',
+    'Lookups in the in-process caches, by result.',
+    ['cache', 'result']))
@@ -0,0 +1,460 @@
+import time
+import logging
+import contextlib
+
+from sqlalchemy import select, func, and_
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.exc import ProgrammingError, IntegrityError
+
+from ckan import model
+
+from ckanext.requestdata import model as requestdata_model
+
+log = logging.getLogger(__name__)
+
+# Arbitrary key for the PostgreSQL advisory lock that keeps several workers
+# from migrating at the same time
+ADVISORY_LOCK_KEY = 7239184312
+
+# Seconds between the attempts to take the lock of a process that waits for
+# another one to finish migrating
+LOCK_POLL_INTERVAL = 1
+
+# Number of times a unique index is built, merging the duplicates that were
+# created concurrently in between
+UNIQUE_INDEX_ATTEMPTS = 3
+
+
+def upgrade(wait=True):
+    '''Applies the pending schema migrations and records the new schema
+    version.
+
+    On PostgreSQL the indexes are built with ``CREATE INDEX CONCURRENTLY`` so
+    existing installs keep serving requests while they are upgraded.
+
+    :param wait: If another process is already migrating the schema, wait
+        for it to finish so the schema is up to date when it returns.
+        Otherwise the upgrade is left to the other process.
+    :type wait: bool
+
+    :returns: the schema version after the upgrade
+    :rtype: int
+
+    '''
+
+    connection = _connect()
+
+    try:
+        if not _acquire_lock(connection):
+            if not wait:
+                log.info('Requestdata schema is being upgraded by another '
+                         'process, skipping the upgrade.')
+
+                return current_version(connection)
+
+            log.info('Requestdata schema is being upgraded by another '
+                     'process, waiting for it to finish.')
+
+            # The lock is polled rather than waited for in one statement,
+            # an open statement would hold back the concurrent index builds
+            # of the other process
+            while not _acquire_lock(connection):
+                time.sleep(LOCK_POLL_INTERVAL)
+
+        try:
+            version = current_version(connection)
+
+            for migration_version, migration in MIGRATIONS:
+                if migration_version <= version:
+                    continue
+
+                log.info('Upgrading requestdata schema to version %s.',
+                         migration_version)
+                migration(connection)
+                _record_version(connection, migration_version)
+                version = migration_version
+
+            return version
+        finally:
+            _release_lock(connection)
+            requestdata_model.reset_schema_version()
+    finally:
+        connection.close()
+
+
+def current_version(connection=None):
+    '''Returns the last applied schema version, 0 on a fresh install.'''
+
+    table = requestdata_model.schema_version_table
+    query = select([func.max(table.c.version)])
+
+    if connection is None:
+        version = model.meta.engine.execute(query).scalar()
+    else:
+        version = connection.execute(query).scalar()
+
+    return version or 0
+
+
+def _is_postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def _connect():
+    connection = model.meta.engine.connect()
+
+    if _is_postgres(connection):
+        # Concurrent index builds cannot run inside a transaction block
+        connection = \
+            connection.execution_options(isolation_level='AUTOCOMMIT')
+
+    return connection
+
+
+def _acquire_lock(connection):
+    if not _is_postgres(connection):
+        return True
+
+    return connection.execute('SELECT pg_try_advisory_lock(%s)',
+                              ADVISORY_LOCK_KEY).scalar()
+
+
+def _release_lock(connection):
+    if _is_postgres(connection):
+        connection.execute('SELECT pg_advisory_unlock(%s)', ADVISORY_LOCK_KEY)
+
+
+def _record_version(connection, version):
+    table = requestdata_model.schema_version_table
+    connection.execute(table.insert().values(version=version))
+
+
+@contextlib.contextmanager
+def _transaction(connection):
+    # The migrations run in autocommit mode on PostgreSQL, statements that
+    # must be applied together get a connection of their own
+    if _is_postgres(connection):
+        transactional = connection.engine.connect()
+    else:
+        transactional = connection
+
+    try:
+        with transactional.begin():
+            yield transactional
+    finally:
+        if transactional is not connection:
+            transactional.close()
+
+
+def _index_names(connection, table_name):
+    inspector = Inspector.from_engine(connection)
+
+    return [index['name'] for index in inspector.get_indexes(table_name)]
+
+
+def _invalid_index(connection, name):
+    # A concurrent build that failed or was interrupted leaves an invalid
+    # index, which is neither used nor enforced
+    if not _is_postgres(connection):
+        return False
+
+    return bool(connection.execute(
+        'SELECT NOT i.indisvalid FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE c.relname = %s', name).scalar())
+
+
+def _create_index(connection, name, table_name, columns, unique=False):
+    if name in _index_names(connection, table_name):
+        if not _invalid_index(connection, name):
+            log.debug('Index %s already exists.', name)
+            return
+
+        log.warning('Index %s is invalid, rebuilding it.', name)
+        _drop_index(connection, name, table_name)
+
+    statement = 'CREATE {unique}INDEX {concurrently}{name} ON {table} '\
+                '({columns})'.format(
+                    unique='UNIQUE ' if unique else '',
+                    concurrently='CONCURRENTLY '
+                    if _is_postgres(connection) else '',
+                    name=name,
+                    table=table_name,
+                    columns=', '.join(columns))
+
+    log.debug('Creating index %s.', name)
+
+    try:
+        connection.execute(statement)
+    except ProgrammingError:
+        # Another process created the index in the meantime
+        if name not in _index_names(connection, table_name):
+            raise
+    except IntegrityError:
+        # Duplicates were inserted while a unique index was built, don't
+        # leave the invalid index behind
+        _drop_index(connection, name, table_name)
+        raise
+
+
+def _drop_index(connection, name, table_name):
+    if name not in _index_names(connection, table_name):
+        return
+
+    statement = 'DROP INDEX {concurrently}{name}'.format(
+        concurrently='CONCURRENTLY ' if _is_postgres(connection) else '',
+        name=name)
+
+    log.debug('Dropping index %s.', name)
+    connection.execute(statement)
+
+
+def _add_secondary_indexes(connection):
+    # The indexes on the id columns only duplicated the primary keys
+    _drop_index(connection, 'ckanext_requestdata_requests_id_idx',
+                'ckanext_requestdata_requests')
+    _drop_index(connection, 'ckanext_requestdata_user_notification_id_idx',
+                'ckanext_requestdata_user_notification')
+    _drop_index(connection, 'ckanext_requestdata_maintainers_id_idx',
+                'ckanext_requestdata_maintainers')
+    _drop_index(connection, 'ckanext_requestdata_counters_id_idx',
+                'ckanext_requestdata_counters')
+
+    _create_index(connection, 'ckanext_requestdata_requests_package_id_idx',
+                  'ckanext_requestdata_requests', ['package_id'])
+    _create_index(connection,
+                  'ckanext_requestdata_requests_sender_user_id_idx',
+                  'ckanext_requestdata_requests', ['sender_user_id'])
+    _create_index(connection, 'ckanext_requestdata_requests_state_idx',
+                  'ckanext_requestdata_requests', ['state'])
+    _create_index(connection, 'ckanext_requestdata_requests_modified_at_idx',
+                  'ckanext_requestdata_requests', ['modified_at', 'id'])
+
+    _create_index(connection,
+                  'ckanext_requestdata_maintainers_maintainer_id_idx',
+                  'ckanext_requestdata_maintainers', ['maintainer_id'])
+    _create_index(connection,
+                  'ckanext_requestdata_maintainers_request_data_id_idx',
+                  'ckanext_requestdata_maintainers', ['request_data_id'])
+
+    _create_index(connection, 'ckanext_requestdata_counters_package_id_idx',
+                  'ckanext_requestdata_counters', ['package_id'])
+    _create_index(connection, 'ckanext_requestdata_counters_org_id_idx',
+                  'ckanext_requestdata_counters', ['org_id'])
+
+    _create_index(connection,
+                  'ckanext_requestdata_user_notification_maintainer_idx',
+                  'ckanext_requestdata_user_notification',
+                  ['package_maintainer_id'])
+
+
+def _unique_counters_per_package(connection):
+    # Until the unique index is valid the counters are incremented with an
+    # update followed by an insert, and concurrent increments can create
+    # several rows for the same package. They are merged into one before
+    # the index is built, and again if more were created during the build.
+    for attempt in range(UNIQUE_INDEX_ATTEMPTS):
+        _merge_duplicate_counters(connection)
+
+        try:
+            _create_index(connection,
+                          'ckanext_requestdata_counters_package_id_key',
+                          'ckanext_requestdata_counters', ['package_id'],
+                          unique=True)
+            break
+        except IntegrityError:
+            if attempt == UNIQUE_INDEX_ATTEMPTS - 1:
+                raise
+
+            log.warning('Counters were duplicated while their unique index '
+                        'was built, merging them again.')
+
+    _drop_index(connection, 'ckanext_requestdata_counters_package_id_idx',
+                'ckanext_requestdata_counters')
+
+
+def _merge_duplicate_counters(connection):
+    table = requestdata_model.request_data_counters_table
+    columns = requestdata_model.COUNTER_COLUMNS
+
+    duplicates = select([table.c.package_id,
+                         func.min(table.c.id).label('id')] +
+                        [func.sum(func.coalesce(table.c[column], 0))
+                         .label(column) for column in columns])\
+        .group_by(table.c.package_id)\
+        .having(func.count(table.c.id) > 1)
+
+    for row in connection.execute(duplicates).fetchall():
+        log.debug('Merging duplicate counters for package %s.',
+                  row['package_id'])
+        connection.execute(table.update()
+                           .where(table.c.id == row['id'])
+                           .values(dict((column, row[column])
+                                        for column in columns)))
+        connection.execute(table.delete()
+                           .where(and_(table.c.package_id ==
+                                       row['package_id'],
+                                       table.c.id != row['id'])))
+
+
+def _request_packages_projection(connection):
+    _create_index(connection, 'ckanext_requestdata_packages_owner_org_idx',
+                  'ckanext_requestdata_packages', ['owner_org'])
+
+    # Backfill the projection for the packages that already have requests
+    statement = '''
+        INSERT INTO ckanext_requestdata_packages
+            (package_id, name, title, owner_org, maintainer, state,
+             modified_at)
+        SELECT p.id, p.name, p.title, p.owner_org,
+               COALESCE(e.value, p.maintainer), p.state, CURRENT_TIMESTAMP
+        FROM package p
+        LEFT JOIN package_extra e
+            ON e.package_id = p.id AND e.key = 'maintainer'
+            AND e.state = 'active'
+        WHERE p.id IN (SELECT package_id FROM ckanext_requestdata_requests)
+        AND p.id NOT IN (SELECT package_id FROM ckanext_requestdata_packages)
+    '''
+
+    if _is_postgres(connection) and \
+            connection.dialect.server_version_info >= (9, 5):
+        statement += ' ON CONFLICT DO NOTHING'
+
+    connection.execute(statement)
+
+
+def _email_outbox_due_index(connection):
+    _create_index(connection, 'ckanext_requestdata_email_outbox_due_idx',
+                  'ckanext_requestdata_email_outbox',
+                  ['state', 'next_attempt_at'])
+
+
+def _unique_notification_per_maintainer(connection):
+    # Concurrent requests could create several notifications for the same
+    # maintainer until the unique index is valid, they are merged before
+    # the index is built and again if more were created during the build
+    for attempt in range(UNIQUE_INDEX_ATTEMPTS):
+        _merge_duplicate_notifications(connection)
+
+        try:
+            _create_index(
+                connection,
+                'ckanext_requestdata_user_notification_maintainer_key',
+                'ckanext_requestdata_user_notification',
+                ['package_maintainer_id'], unique=True)
+            break
+        except IntegrityError:
+            if attempt == UNIQUE_INDEX_ATTEMPTS - 1:
+                raise
+
+            log.warning('Notifications were duplicated while their unique '
+                        'index was built, merging them again.')
+
+    _drop_index(connection,
+                'ckanext_requestdata_user_notification_maintainer_idx',
+                'ckanext_requestdata_user_notification')
+
+
+def _merge_duplicate_notifications(connection):
+    # Keep one notification that is unseen when any of them is
+    table = requestdata_model.user_notification_table
+
+    duplicates = select([table.c.package_maintainer_id,
+                         func.min(table.c.id).label('id')])\
+        .group_by(table.c.package_maintainer_id)\
+        .having(func.count(table.c.id) > 1)
+
+    for row in connection.execute(duplicates).fetchall():
+        maintainer_id = row['package_maintainer_id']
+        log.debug('Merging duplicate notifications for maintainer %s.',
+                  maintainer_id)
+
+        unseen = connection.execute(
+            select([func.count(table.c.id)])
+            .where(and_(table.c.package_maintainer_id == maintainer_id,
+                        table.c.seen.is_(False)))).scalar()
+        connection.execute(table.update()
+                           .where(table.c.id == row['id'])
+                           .values(seen=not unseen))
+        connection.execute(table.delete()
+                           .where(and_(table.c.package_maintainer_id ==
+                                       maintainer_id,
+                                       table.c.id != row['id'])))
+
+
+def _organization_stats(connection):
+    # Backfill the statistics of the organizations from their requests and
+    # counters, replacing any partial statistics. Processes on the new code
+    # already update the statistics, the table is locked so their updates
+    # wait and are applied on top of the backfill.
+    with _transaction(connection) as transaction:
+        if _is_postgres(transaction):
+            transaction.execute('LOCK TABLE ckanext_requestdata_organization_'
+                                'stats IN SHARE ROW EXCLUSIVE MODE')
+
+        stats = _count_organization_stats(transaction)
+        table = requestdata_model.organization_stats_table
+
+        transaction.execute(table.delete())
+
+        if stats:
+            transaction.execute(table.insert(), stats.values())
+
+
+def _count_organization_stats(connection):
+    requests = requestdata_model.request_data_table
+    packages = requestdata_model.request_packages_table
+    counters = requestdata_model.request_data_counters_table
+    stats = {}
+
+    def org_stats(org_id):
+        if org_id not in stats:
+            stats[org_id] = dict(
+                [(name, 0) for name in requestdata_model.STATS_COLUMNS],
+                org_id=org_id, last_request_at=None)
+
+        return stats[org_id]
+
+    by_state = select([packages.c.owner_org, requests.c.state,
+                       func.count(requests.c.id),
+                       func.max(requests.c.created_at)])\
+        .select_from(requests.join(packages, packages.c.package_id ==
+                                   requests.c.package_id))\
+        .where(packages.c.owner_org.isnot(None))\
+        .group_by(packages.c.owner_org, requests.c.state)
+
+    for org_id, state, count, last_request_at in \
+            connection.execute(by_state):
+        row = org_stats(org_id)
+        column = requestdata_model.STATE_COLUMNS.get(state)
+
+        if column is not None:
+            row[column] += count
+        if row['last_request_at'] is None or \
+                last_request_at > row['last_request_at']:
+            row['last_request_at'] = last_request_at
+
+    columns = requestdata_model.COUNTER_COLUMNS
+    by_org = select([counters.c.org_id] +
+                    [func.sum(func.coalesce(counters.c[name], 0))
+                     for name in columns])\
+        .where(counters.c.org_id.isnot(None))\
+        .group_by(counters.c.org_id)
+
+    for row in connection.execute(by_org):
+        org_stats(row[0]).update(
+            (name, int(value)) for name, value in zip(columns, row[1:]))
+
+    return stats
+
+
+# Ordered list of (version, migration). Migrations must be idempotent, a
+# migration that was interrupted is applied again on the next upgrade.
+MIGRATIONS = [
+    (1, _add_secondary_indexes),
+    (2, _unique_counters_per_package),
+    (3, _request_packages_projection),
+    (4, _email_outbox_due_index),
+    (5, _unique_notification_per_maintainer),
+    (6, _organization_stats),
+]
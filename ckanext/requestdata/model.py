@@ -1,13 +1,17 @@
+import time
 import logging
 import datetime
+import base64
 
-from sqlalchemy import Table, Column, Index, ForeignKey
-from sqlalchemy import types, func
+from sqlalchemy import Table, Column, ForeignKey
+from sqlalchemy import types, func, or_, and_, select, text, false, case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 
-from sqlalchemy.engine.reflection import Inspector
-from ckan.model.meta import metadata, mapper, Session, engine
+from ckan.model.meta import metadata, mapper, Session
 from ckan.model.types import make_uuid
 from ckan.model.domain_object import DomainObject
+from ckan.model.package import Package, package_table
 
 log = logging.getLogger(__name__)
 
@@ -15,6 +19,71 @@ request_data_table = None
 user_notification_table = None
 maintainers_table = None
 request_data_counters_table = None
+schema_version_table = None
+request_packages_table = None
+email_outbox_table = None
+organization_stats_table = None
+
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Seconds between the reads of the schema version while it is behind, see
+# ``schema_at_least``
+SCHEMA_VERSION_CHECK_INTERVAL = 60
+
+# The latest schema version read by this process
+_schema_version = {'version': 0, 'checked_at': None}
+
+COUNTER_COLUMNS = ['requests', 'replied', 'declined', 'shared']
+
+# The statistics of an organization counted for each state of its requests
+STATE_COLUMNS = {
+    'new': 'requests_new',
+    'open': 'requests_open',
+    'archive': 'requests_archive'
+}
+
+STATS_COLUMNS = sorted(STATE_COLUMNS.values()) + COUNTER_COLUMNS
+
+# The orders of the archived requests grouped by dataset
+ARCHIVE_ORDERS = ['last_request_created_at', 'title', 'shared', 'requests']
+
+# One statement upsert, relies on the unique index on package_id built by
+# migration 2. The owner organization is only looked up when it is not
+# provided.
+COUNTERS_UPSERT = '''
+    INSERT INTO ckanext_requestdata_counters
+        (id, package_id, org_id, requests, replied, declined, shared)
+    VALUES (:id, :package_id,
+            COALESCE(:org_id, (SELECT owner_org FROM package
+                               WHERE id = :package_id)),
+            :requests, :replied, :declined, :shared)
+    ON CONFLICT (package_id) DO UPDATE SET
+        org_id = COALESCE(ckanext_requestdata_counters.org_id,
+                          EXCLUDED.org_id),
+        requests = ckanext_requestdata_counters.requests + EXCLUDED.requests,
+        replied = ckanext_requestdata_counters.replied + EXCLUDED.replied,
+        declined = ckanext_requestdata_counters.declined + EXCLUDED.declined,
+        shared = ckanext_requestdata_counters.shared + EXCLUDED.shared
+    RETURNING requests, replied, declined, shared, org_id
+'''
+
+# One statement increment of the statistics of an organization, relies on
+# the primary key on org_id. Statistics without a delta are added 0.
+STATS_UPSERT = '''
+    INSERT INTO ckanext_requestdata_organization_stats
+        (org_id, {columns}, last_request_at)
+    VALUES (:org_id, {params}, :last_request_at)
+    ON CONFLICT (org_id) DO UPDATE SET
+        {updates},
+        last_request_at = GREATEST(
+            ckanext_requestdata_organization_stats.last_request_at,
+            EXCLUDED.last_request_at)
+'''.format(
+    columns=', '.join(STATS_COLUMNS),
+    params=', '.join(':' + column for column in STATS_COLUMNS),
+    updates=',\n        '.join(
+        '{0} = ckanext_requestdata_organization_stats.{0} + '
+        'EXCLUDED.{0}'.format(column) for column in STATS_COLUMNS))
 
 
 def setup():
@@ -26,16 +95,6 @@ def setup():
         request_data_table.create()
     else:
         log.debug('Requestdata table already exists.')
-    inspector = Inspector.from_engine(engine)
-
-    index_names =\
-        [index['name'] for index in
-            inspector.get_indexes('ckanext_requestdata_requests')]
-
-    if 'ckanext_requestdata_requests_id_idx' not in index_names:
-        log.debug('Creating index for ckanext_requestdata.')
-        Index('ckanext_requestdata_requests_id_idx',
-              request_data_table.c.id).create()
 
     if user_notification_table is None:
         define_user_notification_table()
@@ -45,16 +104,6 @@ def setup():
         user_notification_table.create()
     else:
         log.debug('UserNotification table already exists.')
-    inspector = Inspector.from_engine(engine)
-
-    index_names = \
-        [index['name'] for index in
-         inspector.get_indexes('ckanext_requestdata_user_notification')]
-
-    if 'ckanext_requestdata_user_notification_id_idx' not in index_names:
-        log.debug('Creating index for ckanext_user_notification.')
-        Index('ckanext_requestdata_user_notification_id_idx',
-              user_notification_table.c.id).create()
 
     if maintainers_table is None:
         define_maintainers_table()
@@ -64,16 +113,6 @@ def setup():
         maintainers_table.create()
     else:
         log.debug('Maintainers table already exists.')
-    inspector = Inspector.from_engine(engine)
-
-    index_names = \
-        [index['name'] for index in
-         inspector.get_indexes('ckanext_requestdata_maintainers')]
-
-    if 'ckanext_requestdata_maintainers_id_idx' not in index_names:
-        log.debug('Creating index for ckanext_user_notification.')
-        Index('ckanext_requestdata_maintainers_id_idx',
-              maintainers_table.c.id).create()
 
     if request_data_counters_table is None:
         define_request_data_counters_table()
@@ -83,16 +122,44 @@ def setup():
         request_data_counters_table.create()
     else:
         log.debug('Request data counters table already exists.')
-    inspector = Inspector.from_engine(engine)
 
-    index_names = \
-        [index['name'] for index in
-         inspector.get_indexes('ckanext_requestdata_counters')]
+    if request_packages_table is None:
+        define_request_packages_table()
+        log.debug('Request packages table defined in memory.')
+
+    if not request_packages_table.exists():
+        request_packages_table.create()
+    else:
+        log.debug('Request packages table already exists.')
+
+    if email_outbox_table is None:
+        define_email_outbox_table()
+        log.debug('Email outbox table defined in memory.')
+
+    if not email_outbox_table.exists():
+        email_outbox_table.create()
+    else:
+        log.debug('Email outbox table already exists.')
+
+    if organization_stats_table is None:
+        define_organization_stats_table()
+        log.debug('Organization stats table defined in memory.')
+
+    if not organization_stats_table.exists():
+        organization_stats_table.create()
+    else:
+        log.debug('Organization stats table already exists.')
+
+    if schema_version_table is None:
+        define_schema_version_table()
+        log.debug('Schema version table defined in memory.')
+
+    if not schema_version_table.exists():
+        schema_version_table.create()
+    else:
+        log.debug('Schema version table already exists.')
 
-    if 'ckanext_requestdata_counters_id_idx' not in index_names:
-        log.debug('Creating index for ckanext_request_data_counters.')
-        Index('ckanext_requestdata_counters_id_idx',
-              request_data_counters_table.c.id).create()
+    # Indexes are created by the versioned migrations, see migration.py
 
 
 class ckanextRequestdata(DomainObject):
@@ -119,19 +186,49 @@ class ckanextRequestdata(DomainObject):
         return query.all()
 
     @classmethod
-    def search_by_maintainers(self, id, order='modified_at desc'):
+    def search_page(self, limit=None, **kwds):
+        '''Finds requests that satisfy the optional listing filters,
+        newest first, along with the projection of their package.
+
+        :param limit: Maximum number of rows to return.
+        :type limit: int
+
+        :returns: ``(request, package)`` pairs, ``package`` is ``None``
+            when the package is unknown
+        :rtype: list of tuples
+        '''
+
+        query = Session.query(self, ckanextRequestdataPackages)\
+                       .autoflush(False)\
+                       .outerjoin(ckanextRequestdataPackages,
+                                  ckanextRequestdataPackages.package_id ==
+                                  self.package_id)
+        query = _filter_requests(query, **kwds)
+        query = _order_requests(query).limit(limit)
+
+        return query.all()
+
+    @classmethod
+    def search_by_maintainers(self, id, limit=None, **kwds):
         '''Finds all of the requests for the specific maintainer
         :param id: User is
         :type id: string
+        :param limit: Maximum number of rows to return.
+        :type limit: int
         '''
         maintainer_id = id
-        requests = Session.query(ckanextRequestdata, ckanextMaintainers)\
+        requests = Session.query(ckanextRequestdata, ckanextMaintainers,
+                                 ckanextRequestdataPackages)\
                           .join(ckanextMaintainers)\
+                          .outerjoin(ckanextRequestdataPackages,
+                                     ckanextRequestdataPackages.package_id ==
+                                     ckanextRequestdata.package_id)\
                           .filter(ckanextRequestdata.id ==
                                   ckanextMaintainers.request_data_id,
                                   ckanextMaintainers.maintainer_id ==
-                                  maintainer_id)\
-                          .order_by(order).all()
+                                  maintainer_id)
+        requests = _filter_requests(requests, **kwds)
+        requests = _order_requests(requests).limit(limit).all()
 
         requests_data = []
         for r in requests:
@@ -151,9 +248,305 @@ class ckanextRequestdata(DomainObject):
                 'maintainer_id': r.ckanextMaintainers.maintainer_id,
                 'email': r.ckanextMaintainers.email
             })
+            request.update(package_fields(r.ckanextRequestdataPackages))
             requests_data.append(request)
         return requests_data
 
+    @classmethod
+    def search_by_organization(self, org_id, limit=None, **kwds):
+        '''Finds all of the requests for the active public datasets owned
+        by the specific organization, in a single query against the package
+        projection. Private datasets are left out, as they are by
+        ``package_search``.
+
+        :param org_id: The organization id.
+        :type org_id: string
+        :param limit: Maximum number of rows to return.
+        :type limit: int
+
+        :returns: ``(request, package)`` pairs
+        :rtype: list of tuples
+        '''
+
+        packages = ckanextRequestdataPackages
+        query = Session.query(self, packages).autoflush(False)
+        query = query.join(packages, packages.package_id == self.package_id)\
+                     .join(Package, Package.id == self.package_id)\
+                     .filter(packages.owner_org == org_id,
+                             packages.state == 'active',
+                             Package.private.isnot(True))
+        query = _filter_requests(query, **kwds)
+        query = _order_requests(query).limit(limit)
+
+        return query.all()
+
+    @classmethod
+    def archive_by_organization(self, org_id, order='last_request_created_at',
+                                reverse=True, limit=None, offset=0,
+                                maintainer_ids=None):
+        '''Finds the archived requests for the active public datasets owned
+        by the specific organization, grouped by dataset and ordered by the
+        database.
+
+        The datasets of the page are found with one grouped query, which
+        also returns their counters and the totals of every page, and
+        their requests with a second query. The totals are counted on their
+        own when the page is empty, e.g. past the last page.
+
+        :param org_id: The organization id.
+        :type org_id: string
+        :param order: One of ``ARCHIVE_ORDERS``.
+        :type order: string
+        :param reverse: Whether the datasets are sorted descending.
+        :type reverse: bool
+        :param limit: Maximum number of datasets to return.
+        :type limit: int
+        :param offset: Number of datasets to skip.
+        :type offset: int
+        :param maintainer_ids: Only the requests sent to one of these
+            maintainers are returned (optional).
+        :type maintainer_ids: list of strings
+
+        :returns: the ``count`` of datasets and of archived
+            ``total_requests``, and the ``results``, one for each dataset
+            with its ``title``, ``last_request_created_at``, ``counters`` and
+            ``requests_archived`` as ``(request, package)`` pairs, most
+            recently modified first
+        :rtype: dictionary
+        '''
+
+        table = request_data_table
+        packages = request_packages_table
+        counters = request_data_counters_table
+        conditions = [table.c.state == 'archive'] + \
+            _request_conditions(maintainer_ids=maintainer_ids)
+
+        archived = select([table.c.package_id,
+                           func.max(table.c.created_at)
+                           .label('last_request_created_at'),
+                           func.count(table.c.id).label('archived')])\
+            .where(and_(*conditions))\
+            .group_by(table.c.package_id)\
+            .alias('archived')
+
+        order_column = {
+            'last_request_created_at': archived.c.last_request_created_at,
+            'title': packages.c.title,
+            'shared': func.coalesce(counters.c.shared, 0),
+            'requests': func.coalesce(counters.c.requests, 0)
+        }[order]
+
+        datasets = archived.join(
+            packages, packages.c.package_id == archived.c.package_id)\
+            .join(package_table, package_table.c.id == archived.c.package_id)
+        dataset_conditions = and_(packages.c.owner_org == org_id,
+                                  packages.c.state == 'active',
+                                  package_table.c.private.isnot(True))
+
+        query = select([archived.c.package_id,
+                        archived.c.last_request_created_at,
+                        packages.c.title,
+                        counters.c.requests, counters.c.replied,
+                        counters.c.declined, counters.c.shared,
+                        # The totals of every page, in the same query
+                        func.count().over().label('total_packages'),
+                        func.sum(archived.c.archived).over()
+                        .label('total_requests')])\
+            .select_from(datasets.outerjoin(
+                counters, counters.c.package_id == archived.c.package_id))\
+            .where(dataset_conditions)\
+            .order_by(order_column.desc() if reverse else order_column,
+                      archived.c.package_id)\
+            .limit(limit).offset(offset)
+
+        rows = Session.execute(query).fetchall()
+
+        if rows:
+            total_packages = rows[0].total_packages
+            total_requests = int(rows[0].total_requests)
+        else:
+            total_packages, total_requests = Session.execute(
+                select([func.count(),
+                        func.coalesce(func.sum(archived.c.archived), 0)])
+                .select_from(datasets)
+                .where(dataset_conditions)).fetchone()
+
+        results = []
+        groups = {}
+
+        for row in rows:
+            group = {
+                'package_id': row.package_id,
+                'title': row.title,
+                'last_request_created_at': row.last_request_created_at,
+                'counters': dict((key, row[key] or 0)
+                                 for key in COUNTER_COLUMNS),
+                'requests_archived': []
+            }
+            groups[row.package_id] = group
+            results.append(group)
+
+        if groups:
+            query = Session.query(self, ckanextRequestdataPackages)\
+                           .autoflush(False)\
+                           .join(ckanextRequestdataPackages,
+                                 ckanextRequestdataPackages.package_id ==
+                                 self.package_id)\
+                           .filter(self.package_id.in_(groups.keys()),
+                                   *conditions)
+            for request, package in _order_requests(query):
+                groups[request.package_id]['requests_archived']\
+                    .append((request, package))
+
+        return {
+            'count': total_packages,
+            'total_requests': int(total_requests),
+            'results': results
+        }
+
+
+def _filter_requests(query, **kwds):
+    '''Applies the optional filters shared by the request listings, see
+    ``_request_conditions``.'''
+
+    return query.filter(*_request_conditions(**kwds))
+
+
+def _request_conditions(state=None, package_id=None, created_after=None,
+                        created_before=None, after=None,
+                        maintainer_ids=None):
+    '''Returns the conditions for the optional listing filters.
+
+    :param after: Keyset cursor, only rows that sort after this
+        ``(modified_at, id)`` pair are returned.
+    :type after: tuple
+    :param maintainer_ids: Only requests sent to one of these maintainers
+        are returned, none when the list is empty.
+    :type maintainer_ids: list of strings
+    '''
+
+    table = request_data_table
+    conditions = []
+
+    if state:
+        conditions.append(table.c.state == state)
+    if package_id:
+        conditions.append(table.c.package_id == package_id)
+    if created_after:
+        conditions.append(table.c.created_at >= created_after)
+    if created_before:
+        conditions.append(table.c.created_at <= created_before)
+    if maintainer_ids is not None and not maintainer_ids:
+        # None of the selected maintainers exist
+        conditions.append(false())
+    elif maintainer_ids:
+        maintainers = maintainers_table
+        conditions.append(table.c.id.in_(
+            select([maintainers.c.request_data_id])
+            .where(maintainers.c.maintainer_id.in_(maintainer_ids))))
+    if after:
+        modified_at, id = after
+        conditions.append(
+            or_(table.c.modified_at < modified_at,
+                and_(table.c.modified_at == modified_at,
+                     table.c.id < id)))
+
+    return conditions
+
+
+def iter_requests(org_id=None, batch_size=1000, **kwds):
+    '''Streams all of the requests that satisfy the optional listing
+    filters, most recently modified first, in constant memory.
+
+    The rows are read with a server side cursor on a dedicated connection,
+    so the generator can be consumed after the web request's session has
+    been removed.
+
+    :param org_id: Only return requests for datasets of this organization.
+    :type org_id: string
+    :param batch_size: Number of rows fetched from the cursor at once.
+    :type batch_size: int
+
+    :returns: the requests as dictionaries, with the projected package
+        fields of ``package_fields``
+    :rtype: generator
+    '''
+
+    table = request_data_table
+    packages = request_packages_table
+    package_columns = [packages.c.title,
+                       packages.c.name.label('package_name'),
+                       packages.c.owner_org,
+                       packages.c.maintainer.label('package_maintainer'),
+                       packages.c.state.label('package_state')]
+    conditions = _request_conditions(**kwds)
+
+    if org_id:
+        conditions.append(packages.c.owner_org == org_id)
+
+    query = select([table] + package_columns)\
+        .select_from(table.outerjoin(
+            packages, packages.c.package_id == table.c.package_id))\
+        .order_by(table.c.modified_at.desc(), table.c.id.desc())
+
+    for condition in conditions:
+        query = query.where(condition)
+
+    connection = Session.bind.connect()
+
+    try:
+        result = connection.execution_options(stream_results=True)\
+                           .execute(query)
+
+        while True:
+            rows = result.fetchmany(batch_size)
+
+            if not rows:
+                break
+
+            for row in rows:
+                out = dict((column.name, row[column])
+                           for column in table.c)
+                out.update((column.name, row[column.name])
+                           for column in package_columns)
+
+                yield out
+    finally:
+        connection.close()
+
+
+def _order_requests(query):
+    '''Orders the request listings newest first, with the id as a tie
+    breaker so the keyset cursor is stable.'''
+
+    return query.order_by(ckanextRequestdata.modified_at.desc(),
+                          ckanextRequestdata.id.desc())
+
+
+def encode_cursor(modified_at, id):
+    '''Returns an opaque token for the keyset pagination of requests.'''
+
+    value = u'{0}|{1}'.format(modified_at.strftime(CURSOR_DATE_FORMAT), id)
+
+    return base64.urlsafe_b64encode(value.encode('utf-8'))
+
+
+def decode_cursor(token):
+    '''Returns the ``(modified_at, id)`` pair encoded in a cursor token.
+
+    :raises ValueError: if the token is malformed.
+    '''
+
+    try:
+        value = base64.urlsafe_b64decode(str(token)).decode('utf-8')
+        modified_at, id = value.split(u'|', 1)
+    except (TypeError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+    modified_at = datetime.datetime.strptime(modified_at, CURSOR_DATE_FORMAT)
+
+    return modified_at, id
+
 
 def define_request_data_table():
     global request_data_table
@@ -181,9 +574,7 @@ def define_request_data_table():
                                Column('created_at', types.DateTime,
                                       default=datetime.datetime.now),
                                Column('modified_at', types.DateTime,
-                                      default=datetime.datetime.now),
-                               Index('ckanext_requestdata_requests_id_idx',
-                                     'id'))
+                                      default=datetime.datetime.now))
 
     mapper(
         ckanextRequestdata,
@@ -213,6 +604,85 @@ class ckanextUserNotification(DomainObject):
 
         return query.all()
 
+    @classmethod
+    def mark_unseen(self, maintainer_ids):
+        '''Marks the notifications of the maintainers as not seen, creating
+        the missing ones, in one transaction. On PostgreSQL this is a single
+        upsert backed by the unique index on ``package_maintainer_id``, once
+        migration 5 has built it.
+
+        :param maintainer_ids: The ids of the maintainers to notify.
+        :type maintainer_ids: list of strings
+
+        :returns: the notifications of the maintainers
+        :rtype: list of ckanextUserNotification
+        '''
+
+        maintainer_ids = list(set(maintainer_ids))
+
+        if not maintainer_ids:
+            return []
+
+        table = user_notification_table
+
+        if _supports_upsert() and schema_at_least(5):
+            values = {}
+            rows = []
+
+            for i, maintainer_id in enumerate(maintainer_ids):
+                values['id_%s' % i] = make_uuid()
+                values['maintainer_%s' % i] = maintainer_id
+                rows.append('(:id_%s, :maintainer_%s, false)' % (i, i))
+
+            statement = 'INSERT INTO {table} (id, package_maintainer_id, '\
+                        'seen) VALUES {rows} '\
+                        'ON CONFLICT (package_maintainer_id) '\
+                        'DO UPDATE SET seen = false'.format(
+                            table=table.name, rows=', '.join(rows))
+            Session.execute(text(statement), values)
+        else:
+            Session.execute(
+                table.update()
+                     .where(table.c.package_maintainer_id.in_(maintainer_ids))
+                     .values(seen=False))
+
+            existing = Session.execute(
+                select([table.c.package_maintainer_id])
+                .where(table.c.package_maintainer_id.in_(maintainer_ids)))
+            existing = set(row[0] for row in existing)
+            missing = [{
+                'id': make_uuid(),
+                'package_maintainer_id': maintainer_id,
+                'seen': False
+            } for maintainer_id in maintainer_ids
+                if maintainer_id not in existing]
+
+            if missing:
+                savepoint = Session.begin_nested()
+                try:
+                    Session.execute(table.insert(), missing)
+                    savepoint.commit()
+                except IntegrityError:
+                    # Notifications were created concurrently, mark them
+                    # unseen instead
+                    savepoint.rollback()
+                    Session.execute(
+                        table.update()
+                             .where(table.c.package_maintainer_id.in_(
+                                 [row['package_maintainer_id']
+                                  for row in missing]))
+                             .values(seen=False))
+
+        Session.commit()
+
+        # The rows were changed with Core statements, notifications already
+        # loaded in the session are refreshed rather than returned as they
+        # were
+        query = Session.query(self).autoflush(False).populate_existing()
+        query = query.filter(self.package_maintainer_id.in_(maintainer_ids))
+
+        return query.all()
+
 
 def define_user_notification_table():
     global user_notification_table
@@ -226,9 +696,7 @@ def define_user_notification_table():
                                            types.UnicodeText,
                                            nullable=False),
                                     Column('seen', types.Boolean,
-                                           default=False),
-                                    Index('ckanext_requestdata_user_'
-                                          'notification_id_idx', 'id'))
+                                           default=False))
 
     mapper(
         ckanextUserNotification,
@@ -261,17 +729,59 @@ class ckanextMaintainers(DomainObject):
 
     @classmethod
     def insert_all(self, maintainers, requestdata_id):
-        '''Finds entities in the table that satisfy certain criteria.
-        :param order: Order rows by specified column.
-        :type order: string
+        '''Inserts the maintainers of a request with a single bulk insert
+        and commits them together with any pending changes, e.g. the
+        request itself.
+
+        :param maintainers: The maintainers to insert, each with the
+            ``maintainer_id`` and ``email`` keys.
+        :type maintainers: list of dictionaries
+        :param requestdata_id: The id of the request.
+        :type requestdata_id: string
         '''
-        Session.add_all(maintainers)
+        rows = [{
+            'id': make_uuid(),
+            'request_data_id': requestdata_id,
+            'maintainer_id': maintainer['maintainer_id'],
+            'email': maintainer['email']
+        } for maintainer in maintainers]
+
+        if rows:
+            Session.execute(maintainers_table.insert(), rows)
         Session.commit()
         data_dict = {
             'requestdata_id': requestdata_id
         }
         return data_dict
 
+    @classmethod
+    def count_requests(self, org_id):
+        '''Counts the requests sent to each maintainer for the active public
+        datasets of an organization, with a single aggregate query.
+
+        :param org_id: The organization id.
+        :type org_id: string
+
+        :returns: the number of requests keyed by maintainer id
+        :rtype: dictionary
+        '''
+
+        packages = ckanextRequestdataPackages
+        query = Session.query(self.maintainer_id, func.count(self.id))\
+                       .join(ckanextRequestdata,
+                             ckanextRequestdata.id == self.request_data_id)\
+                       .join(packages,
+                             packages.package_id ==
+                             ckanextRequestdata.package_id)\
+                       .join(Package,
+                             Package.id == ckanextRequestdata.package_id)\
+                       .filter(packages.owner_org == org_id,
+                               packages.state == 'active',
+                               Package.private.isnot(True))\
+                       .group_by(self.maintainer_id)
+
+        return dict(query.all())
+
 
 def define_maintainers_table():
     global maintainers_table
@@ -283,9 +793,7 @@ def define_maintainers_table():
                                      ForeignKey('ckanext_requestdata_'
                                                 'requests.id')),
                               Column('maintainer_id', types.UnicodeText),
-                              Column('email', types.UnicodeText),
-                              Index('ckanext_requestdata_maintainers_id_idx',
-                                    'id'))
+                              Column('email', types.UnicodeText))
 
     mapper(
         ckanextMaintainers,
@@ -304,53 +812,143 @@ class ckanextRequestDataCounters(DomainObject):
 
         return query
 
+    @classmethod
+    def increment(self, package_id, columns, org_id=None):
+        '''Atomically increments the counters of a package, creating its
+        row when it doesn't exist yet.
+
+        :param package_id: The id of the package the request belongs to.
+        :type package_id: string
+        :param columns: The counters to increment by one.
+        :type columns: list of strings
+        :param org_id: The owner organization of the package, looked up
+            when not provided.
+        :type org_id: string
+
+        The statistics of the package's organization are incremented in the
+        same transaction, see ``ckanextRequestdataOrgStats``.
+
+        :returns: the updated counters
+        :rtype: dictionary
+        '''
+
+        values = dict((column, 1 if column in columns else 0)
+                      for column in COUNTER_COLUMNS)
+
+        if _supports_upsert() and schema_at_least(2):
+            values.update({
+                'id': make_uuid(),
+                'package_id': package_id,
+                'org_id': org_id
+            })
+            row = Session.execute(text(COUNTERS_UPSERT), values).fetchone()
+            ckanextRequestdataOrgStats.adjust(
+                row['org_id'], dict((column, 1) for column in columns))
+            Session.commit()
+
+            return dict(zip(COUNTER_COLUMNS, row))
+
+        table = request_data_counters_table
+        update = table.update()\
+            .where(table.c.package_id == package_id)\
+            .values(dict((column, table.c[column] + values[column])
+                         for column in columns))
+
+        if Session.execute(update).rowcount == 0:
+            if org_id is None:
+                org_id = Session.query(Package.owner_org)\
+                                .filter(Package.id == package_id).scalar()
+            values.update({
+                'id': make_uuid(),
+                'package_id': package_id,
+                'org_id': org_id
+            })
+            savepoint = Session.begin_nested()
+            try:
+                Session.execute(table.insert().values(values))
+                savepoint.commit()
+            except IntegrityError:
+                # The row was inserted concurrently, increment it instead
+                savepoint.rollback()
+                Session.execute(update)
+
+        query = select([table.c[column] for column in COUNTER_COLUMNS] +
+                       [table.c.org_id])\
+            .where(table.c.package_id == package_id)
+        row = Session.execute(query).fetchone()
+
+        ckanextRequestdataOrgStats.adjust(
+            row['org_id'], dict((column, 1) for column in columns))
+        Session.commit()
+
+        return dict(zip(COUNTER_COLUMNS, row))
+
     @classmethod
     def search(self, **kwds):
-        '''Finds entities in the table that satisfy certain criteria.
-        :param order: Order rows by specified column.
-        :type order: string
+        '''Returns the totals of all counters in a single query.
+
+        :rtype: dictionary of ints
         '''
 
-        request = Session.query(func.sum(ckanextRequestDataCounters.requests))\
-                         .all()
-        replied = Session.query(func.sum(ckanextRequestDataCounters.replied))\
-                         .all()
-        declined_sum = func.sum(ckanextRequestDataCounters.declined)
-        declined = Session.query(declined_sum).all()
-        shared = Session.query(func.sum(ckanextRequestDataCounters.shared))\
-                        .all()
-        counters = {
-            'requests': request,
-            'replied': replied,
-            'declined': declined,
-            'shared': shared
-        }
+        query = Session.query(*_counter_sums())
+        query = query.filter_by(**kwds)
 
-        return counters
+        return _counters_dict(query.one())
 
     @classmethod
     def search_by_organization(self, **kwds):
-        '''Finds entities in the table that satisfy certain criteria.
-        :param order: Order rows by specified column.
-        :type order: string
+        '''Returns the totals of the counters that satisfy certain
+        criteria, e.g. ``org_id``, in a single query.
+
+        :rtype: dictionary of ints
         '''
 
-        request = Session.query(func.sum(ckanextRequestDataCounters.requests))
-        request = request.filter_by(**kwds).all()
-        replied = Session.query(func.sum(ckanextRequestDataCounters.replied))
-        replied = replied.filter_by(**kwds).all()
-        declined = Session.query(func.sum(ckanextRequestDataCounters.declined))
-        declined = declined.filter_by(**kwds).all()
-        shared = Session.query(func.sum(ckanextRequestDataCounters.shared))
-        shared = shared.filter_by(**kwds).all()
-        counters = {
-            'requests': request,
-            'replied': replied,
-            'declined': declined,
-            'shared': shared
-        }
+        return self.search(**kwds)
+
+    @classmethod
+    def search_by_packages(self, package_ids):
+        '''Finds the counters of many packages in a single query.
+
+        :param package_ids: The ids of the packages.
+        :type package_ids: list of strings
+
+        :returns: the counters keyed by package id, packages without
+            counters are left out
+        :rtype: dictionary
+        '''
+
+        if not package_ids:
+            return {}
 
-        return counters
+        columns = [getattr(self, column) for column in COUNTER_COLUMNS]
+        query = Session.query(self.package_id, *columns)
+        query = query.filter(self.package_id.in_(package_ids))
+
+        return dict((row[0], _counters_dict(row[1:])) for row in query)
+
+    @classmethod
+    def search_grouped_by_organization(self):
+        '''Returns the totals of the counters for every organization in a
+        single grouped query.
+
+        :returns: the totals keyed by organization id
+        :rtype: dictionary
+        '''
+
+        query = Session.query(self.org_id, *_counter_sums())
+        query = query.group_by(self.org_id)
+
+        return dict((row[0], _counters_dict(row[1:])) for row in query)
+
+
+def _counter_sums():
+    return [func.sum(getattr(ckanextRequestDataCounters, column))
+            for column in COUNTER_COLUMNS]
+
+
+def _counters_dict(sums):
+    return dict((column, int(value or 0))
+                for column, value in zip(COUNTER_COLUMNS, sums))
 
 
 def define_request_data_counters_table():
@@ -371,11 +969,508 @@ def define_request_data_counters_table():
                                         Column('declined', types.Integer,
                                                default=0),
                                         Column('shared', types.Integer,
-                                               default=0),
-                                        Index('ckanext_requestdata_counters_'
-                                              'id_idx', 'id'))
+                                               default=0))
 
     mapper(
         ckanextRequestDataCounters,
         request_data_counters_table
     )
+
+
+class ckanextRequestdataPackages(DomainObject):
+    '''Read optimized projection of the packages that have requests, so the
+    listings don't need ``package_show``.'''
+
+    @classmethod
+    def get(self, **kwds):
+        '''Finds a single entity in the table.
+        '''
+
+        query = Session.query(self).autoflush(False)
+        query = query.filter_by(**kwds).first()
+
+        return query
+
+    @classmethod
+    def refresh(self, package):
+        '''Creates or updates the projection of a package.
+
+        :param package: The package as returned by ``package_show``.
+        :type package: dictionary
+        '''
+
+        values = {
+            'package_id': package['id'],
+            'name': package.get('name'),
+            'title': package.get('title'),
+            'owner_org': package.get('owner_org'),
+            'maintainer': package.get('maintainer'),
+            'state': package.get('state', 'active'),
+            'modified_at': datetime.datetime.now()
+        }
+
+        _upsert(request_packages_table, 'package_id', values)
+
+    @classmethod
+    def update_from_package(self, package):
+        '''Updates the projection of a package after it was changed, packages
+        without requests are skipped. When the package moved to another
+        organization its requests are moved to the statistics of the new
+        one.
+
+        :param package: The package model object.
+        :type package: ckan.model.Package
+        '''
+
+        table = request_packages_table
+        maintainer = package.extras.get('maintainer') or package.maintainer
+
+        projected = Session.execute(
+            select([table.c.owner_org])
+            .where(table.c.package_id == package.id)).first()
+
+        if projected is None:
+            return
+
+        Session.execute(table.update()
+                        .where(table.c.package_id == package.id)
+                        .values(name=package.name,
+                                title=package.title,
+                                owner_org=package.owner_org,
+                                maintainer=maintainer,
+                                state=package.state,
+                                modified_at=datetime.datetime.now()))
+
+        if projected.owner_org != package.owner_org:
+            _move_package_stats(package.id, projected.owner_org,
+                                package.owner_org)
+
+
+def _move_package_stats(package_id, old_org_id, new_org_id):
+    requests = request_data_table
+    counters = request_data_counters_table
+    deltas = dict((column, 0) for column in STATS_COLUMNS)
+    last_request_at = None
+
+    by_state = select([requests.c.state, func.count(requests.c.id),
+                       func.max(requests.c.created_at)])\
+        .where(requests.c.package_id == package_id)\
+        .group_by(requests.c.state)
+
+    for state, count, created_at in Session.execute(by_state):
+        column = STATE_COLUMNS.get(state)
+
+        if column is not None:
+            deltas[column] += count
+        if last_request_at is None or created_at > last_request_at:
+            last_request_at = created_at
+
+    row = Session.execute(
+        select([counters.c[column] for column in COUNTER_COLUMNS])
+        .where(counters.c.package_id == package_id)).first()
+
+    if row is not None:
+        deltas.update((column, value or 0)
+                      for column, value in zip(COUNTER_COLUMNS, row))
+        Session.execute(counters.update()
+                        .where(counters.c.package_id == package_id)
+                        .values(org_id=new_org_id))
+
+    ckanextRequestdataOrgStats.adjust(
+        old_org_id, dict((column, -value)
+                         for column, value in deltas.items()))
+    ckanextRequestdataOrgStats.adjust(new_org_id, deltas,
+                                      last_request_at=last_request_at)
+
+
+def package_fields(package):
+    '''Returns the projected package fields that are added to the listed
+    requests.'''
+
+    if package is None:
+        return {
+            'title': None,
+            'package_name': None,
+            'owner_org': None,
+            'package_maintainer': None,
+            'package_state': None
+        }
+
+    return {
+        'title': package.title,
+        'package_name': package.name,
+        'owner_org': package.owner_org,
+        'package_maintainer': package.maintainer,
+        'package_state': package.state
+    }
+
+
+def define_request_packages_table():
+    global request_packages_table
+
+    request_packages_table = Table('ckanext_requestdata_packages', metadata,
+                                   Column('package_id', types.UnicodeText,
+                                          primary_key=True),
+                                   Column('name', types.UnicodeText),
+                                   Column('title', types.UnicodeText),
+                                   Column('owner_org', types.UnicodeText),
+                                   Column('maintainer', types.UnicodeText),
+                                   Column('state', types.UnicodeText,
+                                          default=u'active'),
+                                   Column('modified_at', types.DateTime,
+                                          default=datetime.datetime.now))
+
+    mapper(
+        ckanextRequestdataPackages,
+        request_packages_table
+    )
+
+
+def _is_postgres():
+    return Session.bind.dialect.name == 'postgresql'
+
+
+def _supports_upsert():
+    # INSERT ... ON CONFLICT was added in PostgreSQL 9.5, older versions use
+    # an update followed by an insert
+    return _is_postgres() and \
+        Session.bind.dialect.server_version_info >= (9, 5)
+
+
+def schema_at_least(version):
+    '''Returns whether the schema migrations up to ``version`` were applied,
+    see ``migration.upgrade``. Code that relies on an index built by a
+    migration checks it, so the extension keeps working on a schema that
+    is being upgraded.
+
+    The version is read again at most once a minute while it is behind.
+
+    :rtype: bool
+    '''
+
+    if _schema_version['version'] >= version:
+        return True
+
+    now = time.time()
+    checked_at = _schema_version['checked_at']
+
+    if checked_at is None or \
+            now - checked_at >= SCHEMA_VERSION_CHECK_INTERVAL:
+        table = schema_version_table
+        _schema_version['version'] = Session.execute(
+            select([func.max(table.c.version)])).scalar() or 0
+        _schema_version['checked_at'] = now
+
+    return _schema_version['version'] >= version
+
+
+def reset_schema_version():
+    '''Makes ``schema_at_least`` read the schema version again.'''
+
+    _schema_version['checked_at'] = None
+
+
+def _upsert(table, key, values):
+    '''Inserts a row, or updates the existing row with the same ``key``.
+    Doesn't commit.'''
+
+    if _supports_upsert():
+        columns = sorted(values.keys())
+        statement = 'INSERT INTO {table} ({columns}) VALUES ({params}) '\
+                    'ON CONFLICT ({key}) DO UPDATE SET {updates}'.format(
+                        table=table.name,
+                        columns=', '.join(columns),
+                        params=', '.join(':' + c for c in columns),
+                        key=key,
+                        updates=', '.join('{0} = EXCLUDED.{0}'.format(c)
+                                          for c in columns if c != key))
+        Session.execute(text(statement), values)
+        return
+
+    update = table.update().where(table.c[key] == values[key])\
+                           .values(values)
+
+    if Session.execute(update).rowcount == 0:
+        savepoint = Session.begin_nested()
+        try:
+            Session.execute(table.insert().values(values))
+            savepoint.commit()
+        except IntegrityError:
+            # The row was inserted concurrently, update it instead
+            savepoint.rollback()
+            Session.execute(update)
+
+
+class ckanextRequestdataEmailOutbox(DomainObject):
+    @classmethod
+    def get(self, **kwds):
+        '''Finds a single entity in the table.
+        '''
+
+        query = Session.query(self).autoflush(False)
+        query = query.filter_by(**kwds).first()
+
+        return query
+
+    @classmethod
+    def enqueue(self, to, subject, content, attachment=None,
+                attachment_extension=None):
+        '''Stores an email to be delivered by the outbox worker.
+
+        :param to: The recipients of the email.
+        :type to: list of strings
+        :param subject: The subject of the email.
+        :type subject: string
+        :param content: The HTML body of the email.
+        :type content: string
+        :param attachment: The content of the attached file (optional).
+        :type attachment: string
+        :param attachment_extension: The extension of the attached file.
+        :type attachment_extension: string
+
+        :rtype: ckanextRequestdataEmailOutbox
+        '''
+
+        email = self(recipients=','.join(to), subject=subject,
+                     content=content, attachment=attachment,
+                     attachment_extension=attachment_extension)
+        email.save()
+
+        return email
+
+    @classmethod
+    def due(self, limit=100, max_attempts=5):
+        '''Returns the pending emails whose next attempt is due and that
+        were attempted less than ``max_attempts`` times, oldest first.'''
+
+        now = datetime.datetime.now()
+
+        query = Session.query(self).autoflush(False)
+        query = query.filter(self.state == u'pending',
+                             self.attempts < max_attempts,
+                             self.next_attempt_at <= now)\
+                     .order_by(self.next_attempt_at)\
+                     .limit(limit)
+
+        return query.all()
+
+    def claim(self, lease, max_attempts=5):
+        '''Claims the email for one delivery attempt.
+
+        The attempt is counted and the email isn't due again until the lease
+        expires, so other workers skip it and it is retried if this worker
+        dies while sending.
+
+        :param lease: For how long the email is reserved.
+        :type lease: datetime.timedelta
+        :param max_attempts: The email isn't claimed once it was attempted
+            this many times.
+        :type max_attempts: int
+
+        :returns: whether the email was claimed, ``False`` when another
+            worker claimed it first
+        :rtype: bool
+        '''
+
+        table = email_outbox_table
+        next_attempt_at = datetime.datetime.now() + lease
+        result = Session.execute(
+            table.update()
+                 .where(and_(table.c.id == self.id,
+                             table.c.state == u'pending',
+                             table.c.attempts == self.attempts,
+                             table.c.attempts < max_attempts))
+                 .values(attempts=table.c.attempts + 1,
+                         next_attempt_at=next_attempt_at))
+        Session.commit()
+
+        if result.rowcount != 1:
+            return False
+
+        # The session doesn't expire the email on commit, the claimed
+        # values are set as loaded so they aren't written again
+        set_committed_value(self, 'attempts', self.attempts + 1)
+        set_committed_value(self, 'next_attempt_at', next_attempt_at)
+
+        return True
+
+    def mark_sent(self):
+        self.state = u'sent'
+        self.sent_at = datetime.datetime.now()
+        self.last_error = None
+        self.attachment = None
+        self.save()
+
+    def mark_failed(self, error, retry_at=None):
+        '''Records a failed attempt. The email stays pending until
+        ``retry_at``, or is given up on when it is not provided.'''
+
+        self.last_error = error
+
+        if retry_at is None:
+            self.state = u'failed'
+        else:
+            self.next_attempt_at = retry_at
+
+        self.save()
+
+
+def define_email_outbox_table():
+    global email_outbox_table
+
+    email_outbox_table = Table('ckanext_requestdata_email_outbox', metadata,
+                               Column('id', types.UnicodeText,
+                                      primary_key=True, default=make_uuid),
+                               Column('recipients', types.UnicodeText,
+                                      nullable=False),
+                               Column('subject', types.UnicodeText),
+                               Column('content', types.UnicodeText),
+                               Column('attachment', types.LargeBinary),
+                               Column('attachment_extension',
+                                      types.UnicodeText),
+                               Column('state', types.UnicodeText,
+                                      nullable=False, default=u'pending'),
+                               Column('attempts', types.Integer,
+                                      nullable=False, default=0),
+                               Column('last_error', types.UnicodeText),
+                               Column('created_at', types.DateTime,
+                                      default=datetime.datetime.now),
+                               Column('next_attempt_at', types.DateTime,
+                                      default=datetime.datetime.now),
+                               Column('sent_at', types.DateTime))
+
+    mapper(
+        ckanextRequestdataEmailOutbox,
+        email_outbox_table
+    )
+
+
+class ckanextRequestdataOrgStats(DomainObject):
+    '''Statistics of the requests of each organization, kept up to date
+    as requests are created, patched and counted, so the overviews read
+    one row per organization instead of aggregating every request.'''
+
+    @classmethod
+    def get(self, org_id):
+        '''Returns the statistics of an organization.
+
+        :param org_id: The organization id.
+        :type org_id: string
+
+        :returns: the ``STATS_COLUMNS`` and ``last_request_at``, all zero
+            when the organization has no requests
+        :rtype: dictionary
+        '''
+
+        query = Session.query(self).autoflush(False)
+
+        return _stats_dict(query.filter_by(org_id=org_id).first())
+
+    @classmethod
+    def search(self):
+        '''Returns the statistics of every organization with requests.
+
+        :returns: the statistics keyed by organization id
+        :rtype: dictionary
+        '''
+
+        query = Session.query(self).autoflush(False)
+
+        return dict((row.org_id, _stats_dict(row)) for row in query)
+
+    @classmethod
+    def adjust(self, org_id, deltas, last_request_at=None):
+        '''Atomically adds to the statistics of an organization, creating
+        its row when it doesn't exist yet. Doesn't commit, so the
+        statistics are changed in the transaction of the request.
+
+        :param org_id: The organization id, nothing is counted when it is
+            ``None``.
+        :type org_id: string
+        :param deltas: The amounts added keyed by column, see
+            ``STATS_COLUMNS``.
+        :type deltas: dictionary
+        :param last_request_at: When a request was made (optional).
+        :type last_request_at: datetime
+        '''
+
+        values = dict((column, deltas.get(column, 0))
+                      for column in STATS_COLUMNS)
+
+        if org_id is None or \
+                not any(values.values()) and last_request_at is None:
+            return
+
+        if _supports_upsert():
+            values.update({
+                'org_id': org_id,
+                'last_request_at': last_request_at
+            })
+            Session.execute(text(STATS_UPSERT), values)
+            return
+
+        table = organization_stats_table
+        updates = dict((column, table.c[column] + values[column])
+                       for column in STATS_COLUMNS if values[column])
+
+        if last_request_at is not None:
+            updates['last_request_at'] = case(
+                [(or_(table.c.last_request_at.is_(None),
+                      table.c.last_request_at < last_request_at),
+                  last_request_at)],
+                else_=table.c.last_request_at)
+
+        update = table.update()\
+            .where(table.c.org_id == org_id)\
+            .values(updates)
+
+        if Session.execute(update).rowcount == 0:
+            values.update({
+                'org_id': org_id,
+                'last_request_at': last_request_at
+            })
+            savepoint = Session.begin_nested()
+            try:
+                Session.execute(table.insert().values(values))
+                savepoint.commit()
+            except IntegrityError:
+                # The row was inserted concurrently, update it instead
+                savepoint.rollback()
+                Session.execute(update)
+
+
+def _stats_dict(row):
+    out = dict((column, getattr(row, column, 0) or 0)
+               for column in STATS_COLUMNS)
+    out['last_request_at'] = getattr(row, 'last_request_at', None)
+
+    return out
+
+
+def define_organization_stats_table():
+    global organization_stats_table
+
+    columns = [Column(column, types.Integer, nullable=False, default=0)
+               for column in STATS_COLUMNS]
+
+    organization_stats_table = Table(
+        'ckanext_requestdata_organization_stats', metadata,
+        Column('org_id', types.UnicodeText, primary_key=True),
+        *(columns + [Column('last_request_at', types.DateTime)]))
+
+    mapper(
+        ckanextRequestdataOrgStats,
+        organization_stats_table
+    )
+
+
+def define_schema_version_table():
+    global schema_version_table
+
+    schema_version_table = Table('ckanext_requestdata_schema_version',
+                                 metadata,
+                                 Column('version', types.Integer,
+                                        primary_key=True,
+                                        autoincrement=False),
+                                 Column('applied_at', types.DateTime,
+                                        default=datetime.datetime.now))
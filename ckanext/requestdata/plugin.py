@@ -1,12 +1,20 @@
+import logging
+
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
+from ckan import model
 
 from ckanext.requestdata.model import setup as model_setup
+from ckanext.requestdata.model import ckanextRequestdataPackages
+from ckanext.requestdata import migration
+from ckanext.requestdata import instrumentation
 from ckanext.requestdata.logic import actions
 from ckanext.requestdata.logic import auth
 from ckanext.requestdata import helpers
 from ckanext.requestdata.logic import validators
 
+log = logging.getLogger(__name__)
+
 
 class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     plugins.implements(plugins.IConfigurer)
@@ -17,6 +25,7 @@ class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IDatasetForm)
     plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     # IConfigurer
 
@@ -92,6 +101,9 @@ class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
                     controller=admin_controller,
                     action='download_requests_data')
 
+        map.connect('requestdata_metrics', '/ckan-admin/metrics',
+                    controller=admin_controller, action='metrics')
+
         map.connect('requestdata_organization_requests',
                     '/organization/requested_data/{id}',
                     controller=organization_controller,
@@ -112,10 +124,23 @@ class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
         # Setup requestdata model
         model_setup()
 
+        try:
+            # Workers don't wait for another one that is already migrating,
+            # they serve on the previous schema in the meantime
+            migration.upgrade(wait=False)
+        except Exception:
+            # The extension works on the previous schema until the upgrade
+            # succeeds, see ``model.schema_at_least``
+            log.exception('Could not upgrade the requestdata schema, run '
+                          '`paster requestdata upgrade-db` to retry.')
+
+        if instrumentation.ENABLED:
+            instrumentation.install(model.meta.engine)
+
     # IActions
 
     def get_actions(self):
-        return {
+        actions_ = {
             'requestdata_request_create': actions.request_create,
             'requestdata_request_show': actions.request_show,
             'requestdata_request_list_for_current_user':
@@ -124,6 +149,11 @@ class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
             actions.request_list_for_organization,
             'requestdata_request_list_for_sysadmin':
             actions.request_list_for_sysadmin,
+            'requestdata_request_archive_for_organization':
+            actions.request_archive_for_organization,
+            'requestdata_request_count_by_maintainer':
+            actions.request_count_by_maintainer,
+            'requestdata_organization_stats': actions.organization_stats,
             'requestdata_request_patch': actions.request_patch,
             'requestdata_request_update': actions.request_update,
             'requestdata_request_delete': actions.request_delete,
@@ -135,12 +165,21 @@ class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
             actions.increment_request_data_counters,
             'requestdata_request_data_counters_get':
             actions.request_data_counters_get,
+            'requestdata_request_data_counters_get_many':
+            actions.request_data_counters_get_many,
             'requestdata_request_data_counters_get_all':
             actions.request_data_counters_get_all,
             'requestdata_request_data_counters_get_by_org':
-            actions.request_data_counters_get_by_org
+            actions.request_data_counters_get_by_org,
+            'requestdata_request_data_counters_get_all_by_org':
+            actions.request_data_counters_get_all_by_org
         }
 
+        if instrumentation.ENABLED:
+            actions_ = instrumentation.instrument_actions(actions_)
+
+        return actions_
+
     # IAuthFunctions
 
     def get_auth_functions(self):
@@ -168,6 +207,8 @@ class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
                 helpers.get_notification,
             'requestdata_get_request_counters':
                 helpers.get_request_counters,
+            'requestdata_get_request_counters_many':
+                helpers.get_request_counters_many,
             'requestdata_convert_id_to_email':
                 helpers.convert_id_to_email,
             'requestdata_has_query_param':
@@ -183,6 +224,14 @@ class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
                 helpers.role_in_org
         }
 
+    # IMiddleware
+
+    def make_middleware(self, app, config):
+        if instrumentation.ENABLED:
+            return instrumentation.QueryStatsMiddleware(app)
+
+        return app
+
     # IDatasetForm
 
     def _modify_package_schema(self, schema):
@@ -240,3 +289,15 @@ class RequestdataPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
             search_params.update({'fq': fq})
 
         return search_params
+
+    def after_update(self, context, pkg_dict):
+        package = context['model'].Package.get(pkg_dict['id'])
+
+        if package:
+            ckanextRequestdataPackages.update_from_package(package)
+
+    def after_delete(self, context, pkg_dict):
+        package = context['model'].Package.get(pkg_dict['id'])
+
+        if package:
+            ckanextRequestdataPackages.update_from_package(package)
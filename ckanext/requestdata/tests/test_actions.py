@@ -3,6 +3,8 @@ from nose.tools import assert_raises, raises
 from ckan.tests import helpers, factories
 from ckan import plugins, logic
 
+from ckanext.requestdata.model import iter_requests, ckanextUserNotification
+
 
 class ActionBase(object):
     @classmethod
@@ -225,6 +227,53 @@ class TestActions(ActionBase):
 
         assert len(result) == 10
 
+    def test_requestdata_request_list_for_current_user_paginated(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        factories.Organization(name='test_org', users=users)
+
+        package = factories.Dataset(owner_org='test_org', name='test_dataset',
+                                    maintainer=user['id'])
+        context = {'user': user['name']}
+        data_dict = {
+            'package_id': package['id'],
+            'sender_name': 'John Doe',
+            'message_content': 'I want to add additional data.',
+            'organization': 'Google',
+            'email_address': user['email'],
+        }
+
+        for i in range(5):
+            helpers.call_action('requestdata_request_create',
+                                context=context, **data_dict)
+
+        ids = []
+        after = None
+
+        for i in range(3):
+            params = {'limit': 2}
+            if after:
+                params['after'] = after
+            page = helpers.call_action(
+                'requestdata_request_list_for_current_user', context=context,
+                **params)
+            ids.extend([item['id'] for item in page['results']])
+            after = page['next_after']
+
+        assert len(ids) == 5
+        assert len(set(ids)) == 5
+        assert after is None
+
+    def test_requestdata_request_list_limit_must_be_positive(self):
+        user = factories.User()
+
+        with assert_raises(logic.ValidationError) as cm:
+            helpers.call_action('requestdata_request_list_for_current_user',
+                                context={'user': user['name']}, limit=0)
+
+        assert 'limit' in cm.exception.error_dict
+
     def test_requestdata_request_list_for_organization(self):
         user = factories.User()
         users = [{'name': user['name']}]
@@ -256,6 +305,178 @@ class TestActions(ActionBase):
 
         assert len(result) == 5
 
+    def test_requestdata_request_list_for_organization_visibility(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        org = factories.Organization(name='test_org', users=users)
+        group = factories.Group(users=users)
+        context = {'user': user['name']}
+
+        for private in [False, True]:
+            package = factories.Dataset(owner_org='test_org',
+                                        maintainer=user['id'],
+                                        private=private)
+            helpers.call_action('requestdata_request_create',
+                                context=context, package_id=package['id'],
+                                sender_name='John Doe',
+                                message_content='I want to add data.',
+                                email_address='test@test.com')
+
+        result = helpers.call_action(
+            'requestdata_request_list_for_organization', org_id=org['id'])
+
+        # Private datasets are left out, as by package_search
+        assert len(result) == 1
+
+        counts = helpers.call_action(
+            'requestdata_request_count_by_maintainer', org_id=org['id'])
+
+        assert counts == {user['id']: 1}
+
+        with assert_raises(logic.NotFound):
+            helpers.call_action('requestdata_request_list_for_organization',
+                                org_id=group['id'])
+
+    def test_requestdata_request_list_for_organization_filter_state(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        org = factories.Organization(name='test_org', users=users)
+        context = {'user': user['name']}
+        data_dict = {
+            'sender_name': 'John Doe',
+            'message_content': 'I want to add additional data.',
+            'organization': 'Google',
+            'email_address': 'test@test.com',
+        }
+
+        package = factories.Dataset(owner_org='test_org',
+                                    maintainer=user['id'])
+        data_dict['package_id'] = package['id']
+
+        for i in range(3):
+            helpers.call_action('requestdata_request_create',
+                                context=context, **data_dict)
+
+        request = helpers.call_action(
+            'requestdata_request_list_for_organization', org_id=org['id'])[0]
+        helpers.call_action('requestdata_request_patch',
+                            id=request['id'], package_id=package['id'],
+                            state='open')
+
+        result = helpers.call_action(
+            'requestdata_request_list_for_organization', org_id=org['name'],
+            state='new')
+
+        assert len(result) == 2
+        assert request['id'] not in [item['id'] for item in result]
+
+    def test_requestdata_request_list_for_organization_filter_maintainers(
+            self):
+        user_1 = factories.User()
+        user_2 = factories.User()
+        users = [{'name': user_1['name']}, {'name': user_2['name']}]
+
+        org = factories.Organization(name='test_org', users=users)
+        package_1 = factories.Dataset(owner_org='test_org',
+                                      maintainer=user_1['id'])
+        package_2 = factories.Dataset(owner_org='test_org',
+                                      maintainer=user_2['id'])
+        context = {'user': user_1['name']}
+
+        for package_id in [package_1['id'], package_2['id'], package_2['id']]:
+            helpers.call_action('requestdata_request_create',
+                                context=context,
+                                package_id=package_id,
+                                sender_name='John Doe',
+                                message_content='I want to add data.',
+                                email_address='test@test.com')
+
+        result = helpers.call_action(
+            'requestdata_request_list_for_organization', org_id=org['id'],
+            maintainer_ids=user_2['id'])
+
+        assert len(result) == 2
+        assert all(item['package_id'] == package_2['id'] for item in result)
+
+        result = helpers.call_action(
+            'requestdata_request_list_for_organization', org_id=org['id'],
+            maintainer_ids=[])
+
+        assert result == []
+
+        counts = helpers.call_action(
+            'requestdata_request_count_by_maintainer', org_id=org['name'])
+
+        assert counts == {user_1['id']: 1, user_2['id']: 2}
+
+    def test_request_archive_for_organization(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        org = factories.Organization(name='test_org', users=users)
+        packages = [factories.Dataset(owner_org='test_org',
+                                      maintainer=user['id'], title=title)
+                    for title in ['B', 'A', 'C']]
+        context = {'user': user['name']}
+
+        for package, count in zip(packages, [2, 1, 1]):
+            for i in range(count):
+                request = helpers.call_action(
+                    'requestdata_request_create', context=context,
+                    package_id=package['id'], sender_name='John Doe',
+                    message_content='I want to add data.',
+                    email_address='test@test.com')
+                helpers.call_action(
+                    'requestdata_request_patch', id=request['requestdata_id'],
+                    package_id=package['id'], state='archive')
+
+        # A new request isn't archived
+        helpers.call_action('requestdata_request_create', context=context,
+                            package_id=packages[2]['id'],
+                            sender_name='John Doe',
+                            message_content='I want to add data.',
+                            email_address='test@test.com')
+
+        helpers.call_action('requestdata_increment_request_data_counters',
+                            package_id=packages[1]['id'], flag='shared')
+
+        result = helpers.call_action(
+            'requestdata_request_archive_for_organization',
+            org_id=org['name'])
+
+        assert result['count'] == 3
+        assert result['total_requests'] == 4
+        assert [x['package_id'] for x in result['results']] == \
+            [packages[2]['id'], packages[1]['id'], packages[0]['id']]
+        assert len(result['results'][2]['requests_archived']) == 2
+        assert all(x['state'] == 'archive' for group in result['results']
+                   for x in group['requests_archived'])
+
+        result = helpers.call_action(
+            'requestdata_request_archive_for_organization',
+            org_id=org['id'], order_by='title', reverse=False, limit=2)
+
+        assert result['count'] == 3
+        assert [x['title'] for x in result['results']] == ['A', 'B']
+
+        result = helpers.call_action(
+            'requestdata_request_archive_for_organization',
+            org_id=org['id'], order_by='shared', limit=1, offset=0)
+
+        assert result['results'][0]['package_id'] == packages[1]['id']
+        assert result['results'][0]['counters']['shared'] == 1
+
+        # A page past the end still reports the totals
+        result = helpers.call_action(
+            'requestdata_request_archive_for_organization',
+            org_id=org['id'], limit=2, offset=10)
+
+        assert result['results'] == []
+        assert result['count'] == 3
+        assert result['total_requests'] == 4
+
     def test_requestdata_request_list_for_organization_missing_org_id(self):
         with assert_raises(logic.ValidationError) as cm:
             helpers.call_action('requestdata_request_list_for_organization')
@@ -338,3 +559,296 @@ class TestActions(ActionBase):
                                      context=context, **data_dict)
 
         assert result.seen is True
+
+    def test_increment_request_data_counters(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        org = factories.Organization(name='test_org', users=users)
+        package = factories.Dataset(owner_org='test_org',
+                                    maintainer=user['id'])
+
+        for flag in ['request', 'request', 'shared and replied']:
+            result = helpers.call_action(
+                'requestdata_increment_request_data_counters',
+                package_id=package['id'], flag=flag)
+
+        assert result == {'requests': 2, 'replied': 1, 'declined': 0,
+                          'shared': 1}
+
+        counters = helpers.call_action(
+            'requestdata_request_data_counters_get', package_id=package['id'])
+
+        assert counters.org_id == org['id']
+
+    def test_request_data_counters_get_all_by_org(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        org_1 = factories.Organization(users=users)
+        org_2 = factories.Organization(users=users)
+        package_1 = factories.Dataset(owner_org=org_1['id'],
+                                      maintainer=user['id'])
+        package_2 = factories.Dataset(owner_org=org_2['id'],
+                                      maintainer=user['id'])
+
+        for package_id, flag in [(package_1['id'], 'request'),
+                                 (package_1['id'], 'declined'),
+                                 (package_2['id'], 'request')]:
+            helpers.call_action('requestdata_increment_request_data_counters',
+                                package_id=package_id, flag=flag)
+
+        result = helpers.call_action(
+            'requestdata_request_data_counters_get_all_by_org')
+
+        assert result[org_1['id']] == {'requests': 1, 'replied': 0,
+                                       'declined': 1, 'shared': 0}
+        assert result[org_2['id']]['requests'] == 1
+
+        result = helpers.call_action(
+            'requestdata_request_data_counters_get_all')
+
+        assert result['requests'] == 2
+
+    def test_organization_stats(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        org = factories.Organization(name='test_org', users=users)
+        other_org = factories.Organization(name='other_org', users=users)
+        package = factories.Dataset(owner_org='test_org',
+                                    maintainer=user['id'])
+        other_package = factories.Dataset(owner_org='other_org',
+                                          maintainer=user['id'])
+        context = {'user': user['name']}
+        created = []
+
+        for package_id in [package['id'], package['id'], other_package['id']]:
+            created.append(helpers.call_action(
+                'requestdata_request_create', context=context,
+                package_id=package_id, sender_name='John Doe',
+                message_content='I want to add data.',
+                email_address='test@test.com'))
+
+        helpers.call_action('requestdata_request_patch',
+                            id=created[0]['requestdata_id'],
+                            package_id=package['id'], state='archive')
+        helpers.call_action('requestdata_increment_request_data_counters',
+                            package_id=package['id'],
+                            flag='shared and replied')
+
+        result = helpers.call_action('requestdata_organization_stats')
+        stats = result[org['id']]
+
+        assert set(result.keys()) == set([org['id'], other_org['id']])
+        assert stats['requests_new'] == 1
+        assert stats['requests_open'] == 0
+        assert stats['requests_archive'] == 1
+        assert stats['shared'] == 1
+        assert stats['replied'] == 1
+        assert stats['declined'] == 0
+        assert stats['last_request_at'] is not None
+        assert result[other_org['id']]['requests_new'] == 1
+
+        result = helpers.call_action('requestdata_organization_stats',
+                                     org_id=org['name'])
+
+        assert result == {org['id']: stats}
+
+    def test_organization_stats_follow_moved_dataset(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        org = factories.Organization(name='test_org', users=users)
+        other_org = factories.Organization(name='other_org', users=users)
+        package = factories.Dataset(owner_org='test_org',
+                                    maintainer=user['id'])
+        context = {'user': user['name']}
+
+        created = helpers.call_action(
+            'requestdata_request_create', context=context,
+            package_id=package['id'], sender_name='John Doe',
+            message_content='I want to add data.',
+            email_address='test@test.com')
+        helpers.call_action('requestdata_increment_request_data_counters',
+                            package_id=package['id'], flag='request')
+
+        helpers.call_action('package_patch', id=package['id'],
+                            owner_org=other_org['id'])
+        helpers.call_action('requestdata_request_patch',
+                            id=created['requestdata_id'],
+                            package_id=package['id'], state='archive')
+
+        result = helpers.call_action('requestdata_organization_stats')
+
+        assert result[org['id']]['requests_new'] == 0
+        assert result[org['id']]['requests_archive'] == 0
+        assert result[org['id']]['requests'] == 0
+        assert result[other_org['id']]['requests_new'] == 0
+        assert result[other_org['id']]['requests_archive'] == 1
+        assert result[other_org['id']]['requests'] == 1
+
+    def test_request_data_counters_get_many(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        factories.Organization(name='test_org', users=users)
+        package_ids = []
+
+        for i in range(3):
+            package = factories.Dataset(owner_org='test_org',
+                                        maintainer=user['id'])
+            package_ids.append(package['id'])
+
+        for package_id in package_ids[:2]:
+            helpers.call_action('requestdata_increment_request_data_counters',
+                                package_id=package_id, flag='request')
+
+        result = helpers.call_action(
+            'requestdata_request_data_counters_get_many',
+            package_ids=package_ids)
+
+        assert sorted(result.keys()) == sorted(package_ids[:2])
+        assert result[package_ids[0]]['requests'] == 1
+
+    def test_request_list_for_sysadmin_package_projection(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        factories.Organization(name='test_org', users=users)
+        package = factories.Dataset(owner_org='test_org', title='Old title',
+                                    maintainer=user['id'])
+        context = {'user': user['name']}
+        data_dict = {
+            'package_id': package['id'],
+            'sender_name': 'John Doe',
+            'message_content': 'I want to add additional data.',
+            'organization': 'Google',
+            'email_address': 'test@test.com',
+        }
+
+        helpers.call_action('requestdata_request_create',
+                            context=context, **data_dict)
+
+        helpers.call_action('package_patch', id=package['id'],
+                            title='New title')
+
+        result = helpers.call_action('requestdata_request_list_for_sysadmin')
+
+        assert result[0]['title'] == 'New title'
+        assert result[0]['owner_org'] == package['owner_org']
+        assert result[0]['package_maintainer'] == user['id']
+
+    def test_create_requestdata_multiple_maintainers(self):
+        user_1 = factories.User()
+        user_2 = factories.User()
+        users = [{'name': user_1['name']}, {'name': user_2['name']}]
+
+        factories.Organization(name='test_org', users=users)
+        package = factories.Dataset(
+            owner_org='test_org',
+            maintainer=','.join([user_1['id'], user_2['email']]))
+        context = {'user': user_1['name']}
+        data_dict = {
+            'package_id': package['id'],
+            'sender_name': 'John Doe',
+            'message_content': 'I want to add additional data.',
+            'organization': 'Google',
+            'email_address': 'test@test.com',
+        }
+
+        helpers.call_action('requestdata_request_create',
+                            context=context, **data_dict)
+
+        for user in [user_1, user_2]:
+            result = helpers.call_action(
+                'requestdata_request_list_for_current_user',
+                context={'user': user['name']})
+
+            assert len(result) == 1
+            assert result[0]['email'] == user['email']
+
+    def test_iter_requests_filters_by_organization(self):
+        user = factories.User()
+        users = [{'name': user['name']}]
+
+        org = factories.Organization(name='test_org', users=users)
+        factories.Organization(name='other_org', users=users)
+        package = factories.Dataset(owner_org='test_org',
+                                    maintainer=user['id'])
+        other_package = factories.Dataset(owner_org='other_org',
+                                          maintainer=user['id'])
+        context = {'user': user['name']}
+
+        for package_id in [package['id'], package['id'], other_package['id']]:
+            helpers.call_action('requestdata_request_create',
+                                context=context,
+                                package_id=package_id,
+                                sender_name='John Doe',
+                                message_content='I want to add data.',
+                                email_address='test@test.com')
+
+        requests = list(iter_requests(org_id=org['id'], batch_size=1))
+
+        assert len(requests) == 2
+        assert all(item['package_id'] == package['id'] for item in requests)
+        assert requests[0]['owner_org'] == org['id']
+        assert requests[0]['modified_at'] >= requests[1]['modified_at']
+
+        assert len(list(iter_requests(state='archive'))) == 0
+        assert len(list(iter_requests(state='new'))) == 3
+
+    def test_requestdata_notification_create_marks_existing_unseen(self):
+        user_1 = factories.User()
+        user_2 = factories.User()
+
+        helpers.call_action('requestdata_notification_create',
+                            users=[{'id': user_1['id']}])
+        helpers.call_action('requestdata_notification_change',
+                            user_id=user_1['id'])
+
+        result = helpers.call_action('requestdata_notification_create',
+                                     users=[{'id': user_1['id']},
+                                            {'id': user_2['id']},
+                                            {'id': user_2['id']}])
+
+        assert len(result) == 2
+        assert all(notification.seen is False for notification in result)
+        assert len(ckanextUserNotification.search(
+            package_maintainer_id=user_1['id'])) == 1
+
+    def test_mark_unseen_refreshes_loaded_notifications(self):
+        user = factories.User()
+
+        ckanextUserNotification.mark_unseen([user['id']])
+        loaded = ckanextUserNotification.get(package_maintainer_id=user['id'])
+        loaded.seen = True
+        loaded.save()
+
+        result = ckanextUserNotification.mark_unseen([user['id']])
+
+        assert result == [loaded]
+        assert loaded.seen is False
+
+    def test_notification_for_current_user_cached_flag_is_updated(self):
+        user = factories.User()
+        context = {'user': user['name']}
+
+        result = helpers.call_action(
+            'requestdata_notification_for_current_user', context=context)
+
+        assert result is True
+
+        helpers.call_action('requestdata_notification_create',
+                            users=[{'id': user['id']}])
+        result = helpers.call_action(
+            'requestdata_notification_for_current_user', context=context)
+
+        assert result is False
+
+        helpers.call_action('requestdata_notification_change',
+                            user_id=user['id'])
+        result = helpers.call_action(
+            'requestdata_notification_for_current_user', context=context)
+
+        assert result is True
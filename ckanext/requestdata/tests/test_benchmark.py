@@ -0,0 +1,73 @@
+from nose.tools import eq_
+
+from ckan.tests import helpers
+from ckan import plugins, model
+
+from ckanext.requestdata import benchmark
+from ckanext.requestdata.model import ckanextRequestdataOrgStats
+
+
+class TestBenchmark(object):
+    @classmethod
+    def setup_class(self):
+        self.app = helpers._get_test_app()
+        if not plugins.plugin_loaded('requestdata'):
+            plugins.load('requestdata')
+
+    def setup(self):
+        helpers.reset_db()
+
+    @classmethod
+    def teardown_class(self):
+        if plugins.plugin_loaded('requestdata'):
+            plugins.unload('requestdata')
+
+    def test_generate(self):
+        data = benchmark.generate(organizations=2, packages=3, maintainers=2,
+                                  requests=4)
+        org = model.Group.get(data['organization'])
+
+        requests = helpers.call_action(
+            'requestdata_request_list_for_organization',
+            org_id=data['organization'])
+        stats = ckanextRequestdataOrgStats.get(org.id)
+
+        eq_(len(requests), 12)
+        eq_(stats['requests'], 12)
+        eq_(stats['requests_new'] + stats['requests_open'] +
+            stats['requests_archive'], 12)
+
+        requests = helpers.call_action(
+            'requestdata_request_list_for_current_user',
+            context={'user': data['maintainer']})
+
+        assert requests
+
+    def test_run_counts_queries(self):
+        data = benchmark.generate(organizations=1, packages=2, maintainers=1,
+                                  requests=2)
+
+        results = benchmark.run(data, repeat=2, app=self.app)
+        names = [result['name'] for result in results]
+
+        assert 'request_list_for_sysadmin' in names
+        assert 'organization dashboard' in names
+        assert all(result['queries'] > 0 for result in results)
+        assert all(result['min'] <= result['mean'] <= result['max']
+                   for result in results)
+
+    def test_cleanup(self):
+        data = benchmark.generate(organizations=1, packages=2, maintainers=1,
+                                  requests=2)
+        sysadmin = model.User.get(data['sysadmin'])
+
+        assert not sysadmin.validate_password('benchmark')
+
+        eq_(benchmark.cleanup(data['prefix']), 4)
+
+        assert model.User.get(data['sysadmin']) is None
+        assert model.Group.get(data['organization']) is None
+        eq_(model.Session.query(model.Package)
+            .filter(model.Package.name.like(data['prefix'] + '-%')).count(),
+            0)
+        eq_(ckanextRequestdataOrgStats.search(), {})
@@ -0,0 +1,98 @@
+from nose.tools import assert_raises, eq_
+import mock
+from mock import patch
+
+from ckan import logic
+
+from ckanext.requestdata import cache
+
+
+class TestRequestLookupCache(object):
+
+    @patch('ckanext.requestdata.cache._get_context', lambda: {})
+    @patch('ckanext.requestdata.cache.toolkit.get_action')
+    def test_get_action_memoizes_by_action_and_data_dict(self, get_action):
+        get_action.return_value = lambda context, data_dict: dict(data_dict)
+        lookups = cache.RequestLookupCache()
+
+        lookups.get_action('package_show', {'id': 'a'})
+        lookups.get_action('package_show', {'id': 'a'})
+        lookups.get_action('package_show', {'id': 'b'})
+        lookups.get_action('user_show', {'id': 'a'})
+
+        eq_(lookups.stats(), {'hits': 1, 'misses': 3, 'size': 3})
+
+    @patch('ckanext.requestdata.cache._get_context', lambda: {})
+    @patch('ckanext.requestdata.cache.toolkit.get_action')
+    def test_get_action_memoizes_not_found(self, get_action):
+        def package_show(context, data_dict):
+            raise logic.NotFound
+
+        get_action.return_value = package_show
+        lookups = cache.RequestLookupCache()
+
+        for i in range(2):
+            with assert_raises(logic.NotFound):
+                lookups.get_action('package_show', {'id': 'missing'})
+
+        eq_(get_action.call_count, 1)
+        eq_(lookups.hits, 1)
+
+
+class TestTTLCache(object):
+
+    @patch('ckanext.requestdata.cache.time.time')
+    def test_get_expires_entries(self, time):
+        time.return_value = 100
+        flags = cache.TTLCache(maxsize=10, ttl=30)
+
+        flags.set('user', False)
+
+        time.return_value = 129
+        eq_(flags.get('user'), False)
+
+        time.return_value = 131
+        eq_(flags.get('user'), None)
+
+    def test_set_evicts_least_recently_used(self):
+        flags = cache.TTLCache(maxsize=2, ttl=30)
+
+        flags.set('a', True)
+        flags.set('b', True)
+        flags.get('a')
+        flags.set('c', True)
+
+        eq_(flags.get('a'), True)
+        eq_(flags.get('b'), None)
+        eq_(flags.get('c'), True)
+
+
+class TestCurrentUser(object):
+
+    @patch('ckanext.requestdata.cache.c')
+    def test_current_user_is_read_once_per_request(self, c):
+        c.user = 'user'
+        c.userobj = mock.Mock(id='user-id')
+        c.userobj.name = 'user'
+        c.requestdata_current_user = None
+
+        eq_(cache.current_user(), ('user-id', 'user'))
+
+        c.userobj = None
+        eq_(cache.current_user(), ('user-id', 'user'))
+
+    @patch('ckanext.requestdata.cache.c')
+    def test_current_user_is_none_for_anonymous_users(self, c):
+        c.user = ''
+        c.requestdata_current_user = ''
+
+        eq_(cache.current_user(), None)
+        eq_(c.requestdata_current_user, (None, None))
+
+    def test_maintainer_set(self):
+        cache.maintainer_sets.clear()
+
+        eq_(cache.maintainer_set('a, b,,c'), frozenset(['a', 'b', 'c']))
+        eq_(cache.maintainer_set(None), frozenset())
+        assert cache.maintainer_set('a, b,,c') is \
+            cache.maintainer_set('a, b,,c')
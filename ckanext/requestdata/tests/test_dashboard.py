@@ -0,0 +1,306 @@
+import copy
+import random
+import datetime
+import itertools
+from collections import Counter
+from operator import itemgetter
+
+from nose.tools import eq_
+
+from ckan.tests import helpers, factories
+
+from ckanext.requestdata import dashboard
+
+
+USERS = {}
+
+for i in range(5):
+    user = {'id': 'user-id-%s' % i, 'name': 'user%s' % i,
+            'fullname': 'User %s' % i if i % 2 else ''}
+    USERS[user['id']] = user
+    USERS[user['name']] = user
+
+
+def _requests(count, seed=0):
+    rng = random.Random(seed)
+    created_at = datetime.datetime(2018, 1, 1)
+    requests = []
+
+    for i in range(count):
+        package = rng.randint(0, 9)
+        maintainers = rng.sample(['user-id-%s' % j for j in range(5)] +
+                                 ['missing'], rng.randint(0, 3))
+        requests.append({
+            'id': 'request-%s' % i,
+            'package_id': 'package-%s' % package,
+            'title': 'Dataset %s' % package,
+            'owner_org': 'org',
+            'package_maintainer': ','.join(maintainers),
+            'state': rng.choice(['new', 'open', 'archive']),
+            'created_at': (created_at - datetime.timedelta(hours=i))
+            .isoformat()
+        })
+
+    return requests
+
+
+def _legacy_organization_page(requests, filtered_maintainers=None,
+                              order='last_request_created_at', reverse=True,
+                              sort_archive=False):
+    '''The grouping done by the organization page before the view model
+    builder, with the ``user_show`` calls replaced by USERS.'''
+
+    maintainers = []
+    for item in requests:
+        package_maintainer_ids = \
+            (item['package_maintainer'] or '').split(',')
+        package_maintainers = []
+
+        for maint_id in package_maintainer_ids:
+            if maint_id not in USERS:
+                continue
+            user = USERS[maint_id]
+            name = user['fullname'] or user['name']
+            payload = {'id': maint_id, 'name': name,
+                       'username': user['name'], 'fullname': name}
+            maintainers.append(payload)
+            package_maintainers.append(payload)
+        item['maintainers'] = package_maintainers
+
+    copy_of_maintainers = maintainers
+    maintainers = dict((item['id'], item) for item in maintainers).values()
+
+    for main in maintainers:
+        count = Counter(
+            item for dct in copy_of_maintainers for item in dct.items())
+        main['count'] = count[('id', main['id'])]
+
+    maintainers = sorted(maintainers, key=lambda k: k['count'], reverse=True)
+
+    for r in requests[:]:
+        package_maintainer_ids = (r['package_maintainer'] or '').split(',')
+
+        if filtered_maintainers is not None and \
+                not set(filtered_maintainers) & set(package_maintainer_ids):
+            requests.remove(r)
+
+    requests_new = [x for x in requests if x['state'] == 'new']
+    requests_open = [x for x in requests if x['state'] == 'open']
+    requests_archive = [x for x in requests if x['state'] == 'archive']
+
+    grouped = []
+    for key, group in itertools.groupby(
+            sorted(requests_archive, key=itemgetter('package_id')),
+            key=lambda x: x['package_id']):
+        group = list(group)
+        grouped.append({
+            'package_id': key,
+            'title': group[0].get('title'),
+            'maintainers': group[0].get('maintainers'),
+            'requests_archived': group,
+            'shared': group[0].get('shared'),
+            'requests': group[0].get('requests')
+        })
+
+    if order == 'last_request_created_at':
+        for dataset in grouped:
+            dataset['last_request_created_at'] = \
+                dataset['requests_archived'][0]['created_at']
+
+    if sort_archive:
+        grouped = sorted(grouped, key=lambda x: x[order], reverse=reverse)
+
+    return {
+        'requests_new': requests_new,
+        'requests_open': requests_open,
+        'requests_archive': grouped,
+        'maintainers': maintainers
+    }
+
+
+def _strip_counts(requests):
+    # The old page leaked the maintainer counts into the maintainers of the
+    # requests, which aren't shown
+    for item in requests:
+        item['maintainers'] = [dict((k, v) for k, v in m.items()
+                                    if k != 'count')
+                               for m in item['maintainers']]
+
+    return requests
+
+
+def _counts(maintainers):
+    return sorted((m['id'], m['count']) for m in maintainers)
+
+
+class TestBuildDashboard(object):
+
+    def _assert_matches_legacy(self, requests, **kwds):
+        expected = _legacy_organization_page(copy.deepcopy(requests),
+                                             **kwds)
+
+        order = kwds.get('order', dashboard.MOST_RECENT)
+        result = dashboard.build_dashboard(
+            requests, USERS,
+            order=order if kwds.get('sort_archive') else None,
+            reverse=kwds.get('reverse', True))
+
+        for key in ['requests_new', 'requests_open']:
+            eq_(result[key], _strip_counts(expected[key]))
+
+        eq_([x['package_id'] for x in result['requests_archive']],
+            [x['package_id'] for x in expected['requests_archive']])
+
+        for group, expected_group in zip(result['requests_archive'],
+                                         expected['requests_archive']):
+            _strip_counts(expected_group['requests_archived'])
+
+            for key in ['title', 'requests_archived']:
+                eq_(group[key], expected_group[key])
+
+        eq_(_counts(result['maintainers']), _counts(expected['maintainers']))
+
+        counts = [m['count'] for m in result['maintainers']]
+        eq_(counts, sorted(counts, reverse=True))
+
+    def test_matches_organization_page(self):
+        for seed in range(5):
+            self._assert_matches_legacy(_requests(50, seed))
+
+    def test_matches_organization_page_sorted_by_title(self):
+        self._assert_matches_legacy(_requests(50), order='title',
+                                    reverse=False, sort_archive=True)
+
+    def test_matches_organization_page_sorted_by_most_recent(self):
+        self._assert_matches_legacy(_requests(50), sort_archive=True)
+
+    def test_filtered_by_maintainers(self):
+        # The database returns the requests of the selected maintainers
+        requests = _requests(50)
+        selected = dashboard.user_ids(['user1', 'user-id-3', 'missing'],
+                                      USERS)
+        filtered = [item for item in requests
+                    if set(selected) & set(dashboard._maintainer_keys(item))]
+        maintainer_counts = Counter(
+            key for item in requests for key in
+            dashboard._maintainer_keys(item) if key in USERS)
+        maintainer_counts['unknown'] = 1
+
+        expected = _legacy_organization_page(
+            copy.deepcopy(requests), filtered_maintainers=selected)
+        result = dashboard.build_dashboard(
+            filtered, USERS, maintainer_counts=maintainer_counts, order=None)
+
+        eq_(selected, ['user-id-1', 'user-id-3'])
+
+        for key in ['requests_new', 'requests_open']:
+            eq_(result[key], _strip_counts(expected[key]))
+
+        eq_(_counts(result['maintainers']), _counts(expected['maintainers']))
+        eq_(result['maintainers'][0]['username'],
+            USERS[result['maintainers'][0]['id']]['name'])
+
+    def test_skips_requests_of_missing_datasets(self):
+        requests = _requests(2)
+        requests[0]['owner_org'] = None
+
+        result = dashboard.build_dashboard(requests, USERS)
+        total = sum(len(result[key]) for key in
+                    ['requests_new', 'requests_open'])
+        total += sum(len(x['requests_archived'])
+                     for x in result['requests_archive'])
+
+        eq_(total, 1)
+
+    def test_sorted_by_counters(self):
+        requests = _requests(50)
+        counters = dict(('package-%s' % i, {'shared': i, 'requests': 10 - i})
+                        for i in range(10))
+
+        result = dashboard.build_dashboard(requests, USERS,
+                                           counters=counters, order='shared')
+        shared = [x['shared'] for x in result['requests_archive']]
+
+        eq_(shared, sorted(shared, reverse=True))
+
+    def test_build_archive(self):
+        requests = _requests(3)
+        groups = [{'package_id': 'package-1', 'requests_archived': requests},
+                  {'package_id': 'package-2', 'requests_archived': []}]
+
+        result = dashboard.build_archive(groups, USERS)
+
+        eq_(result[0]['maintainers'], requests[0]['maintainers'])
+        eq_([m['username'] for m in requests[0]['maintainers']],
+            [USERS[key]['name'] for key in
+             requests[0]['package_maintainer'].split(',') if key in USERS])
+        eq_(result[1]['maintainers'], [])
+
+    def test_group_by_organization(self):
+        requests = _requests(3)
+        requests[1]['owner_org'] = 'other'
+        requests[2]['owner_org'] = 'missing'
+        organizations = {
+            'org': {'id': 'org', 'name': 'org', 'title': 'Org'},
+            'other': {'id': 'other', 'name': 'other', 'title': 'Other'}
+        }
+
+        result = dashboard.group_by_organization(requests, organizations)
+
+        eq_([org['id'] for org in result], ['org', 'other'])
+        eq_(result[0]['requests'], [requests[0]])
+
+    def test_parse_order(self):
+        eq_(dashboard.parse_order('asc'),
+            ('title', False, 'Alphabetical (A-Z)'))
+        eq_(dashboard.parse_order('order_by=shared'),
+            ('shared', True, 'Sharing Rate'))
+        eq_(dashboard.parse_order('most_recent'),
+            (dashboard.MOST_RECENT, True, 'Most Recent'))
+
+    def test_parse_maintainer_filter(self):
+        eq_(dashboard.parse_maintainer_filter('org:test|maintainers:a,b'),
+            ('test', ['a', 'b']))
+        eq_(dashboard.parse_maintainer_filter('org:test|maintainers:*all*'),
+            ('test', None))
+
+    def test_sender_ids(self):
+        requests = _requests(3)
+        for i, item in enumerate(requests):
+            item['sender_user_id'] = 'sender-%s' % i
+        groups = [{'package_id': 'package-1',
+                   'requests_archived': requests[1:]}]
+
+        eq_(dashboard.sender_ids(requests[:1] + groups),
+            set(['sender-0', 'sender-1', 'sender-2']))
+
+
+class TestPrefetchSenders(object):
+
+    def setup(self):
+        helpers.reset_db()
+
+    def test_prefetch_senders(self):
+        sender = factories.User()
+        other = factories.User()
+        sysadmin = factories.Sysadmin()
+        factories.Organization(title='C', users=[
+            {'name': sender['name'], 'capacity': 'admin'}])
+        factories.Organization(title='B', users=[
+            {'name': sender['name'], 'capacity': 'editor'},
+            {'name': other['name'], 'capacity': 'member'}])
+        factories.Organization(title='A', users=[
+            {'name': sender['name'], 'capacity': 'admin'}])
+
+        senders = dashboard.prefetch_senders([sender['id'], other['id'],
+                                              sysadmin['id']])
+        orgs, role = senders[sender['id']]
+
+        # Only the organizations the sender is an admin of
+        eq_([org['title'] for org in orgs], ['A', 'C'])
+        eq_(role, 'admin')
+        assert other['id'] not in senders
+
+        orgs, role = senders[sysadmin['id']]
+
+        eq_([org['title'] for org in orgs], ['A', 'B', 'C'])
@@ -0,0 +1,86 @@
+from nose.tools import eq_
+from mock import patch
+
+from ckanext.requestdata import email_template
+
+
+CONFIG = {
+    'email_header': 'Dear {data_maintainers},',
+    'email_body': '{name} ({email}) from {organization} requested '
+                  '{dataset}: {message}',
+    'email_footer': 'Thanks',
+    'ckan.site_url': 'http://test.ckan.net',
+    'ckan.site_title': 'CKAN'
+}
+
+
+def _context(**kwds):
+    context = {
+        'name': 'John Doe',
+        'email': 'john@test.com',
+        'message': 'I want the data.',
+        'organization': 'Google',
+        'data_maintainers': ['Alice', 'Bob', 'Carol'],
+        'dataset_name': 'test-dataset',
+        'dataset_url': 'http://test.ckan.net/dataset/test-dataset',
+        'is_sysadmin': False,
+        'only_org_admins': False,
+        'requests_url': 'http://test.ckan.net/user/alice/my_requested_data',
+        'organization_requests_url': None
+    }
+    context.update(kwds)
+
+    return context
+
+
+class TestEmailTemplateRenderer(object):
+
+    def setup(self):
+        email_template.invalidate()
+
+    @patch.object(email_template, 'config', CONFIG)
+    def test_render_replaces_placeholders(self):
+        content = email_template.get_renderer().render(_context())
+
+        assert content.startswith('Dear Alice, Bob and Carol,<br><br>')
+        assert 'John Doe (john@test.com) from Google requested '\
+            '<a href="http://test.ckan.net/dataset/test-dataset">'\
+            'test-dataset</a>: I want the data.' in content
+        assert 'my_requested_data">My Requests</a>' in content
+        assert 'Thanks' in content
+
+    @patch.object(email_template, 'config', CONFIG)
+    def test_render_sysadmin_organization_is_site_title(self):
+        content = email_template.get_renderer().render(
+            _context(is_sysadmin=True, data_maintainers=['Alice']))
+
+        assert content.startswith('Dear Alice,<br><br>')
+        assert 'from CKAN requested' in content
+
+    @patch.object(email_template, 'config', CONFIG)
+    def test_render_placeholders_in_values_are_not_replaced(self):
+        content = email_template.get_renderer().render(
+            _context(message='{email}'))
+
+        assert ': {email}' in content
+
+    @patch.object(email_template, 'config', {'ckan.site_url': '',
+                                             'ckan.site_title': ''})
+    def test_render_without_templates_returns_message(self):
+        content = email_template.get_renderer().render(_context())
+
+        eq_(content, 'I want the data.')
+
+    def test_get_renderer_is_compiled_again_when_config_changes(self):
+        config = dict(CONFIG)
+
+        with patch.object(email_template, 'config', config):
+            renderer = email_template.get_renderer()
+
+            assert email_template.get_renderer() is renderer
+
+            config['email_footer'] = 'Regards'
+
+            assert email_template.get_renderer() is not renderer
+            assert 'Regards' in \
+                email_template.get_renderer().render(_context())
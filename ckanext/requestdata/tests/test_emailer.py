@@ -7,8 +7,38 @@ import mock
 from mock import patch, call
 import unittest
 import smtplib
+import smtpd
+import asyncore
+import threading
+import datetime
 from ckanext.requestdata.emailer import send_email
 from ckanext.requestdata import emailer
+from ckanext.requestdata.model import ckanextRequestdataEmailOutbox
+
+
+class RecordingSMTPServer(smtpd.SMTPServer):
+    '''Local debugging SMTP server that keeps the received messages.'''
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+        emailer.smtp_pool.close_all()
+        self.messages = []
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def address(self):
+        return 'localhost:{0}'.format(self.socket.getsockname()[1])
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+    def stop(self):
+        emailer.smtp_pool.close_all()
+        self.close()
+        self.thread.join()
 
 
 class ActionBase(unittest.TestCase):
@@ -29,6 +59,9 @@ class ActionBase(unittest.TestCase):
 
 class TestEmailer(ActionBase):
 
+    def tearDown(self):
+        emailer.smtp_pool.close_all()
+
     def test_send_email(self):
         with patch("smtplib.SMTP") as mock_smtp:
             to_address = "aleksandar.ristov@keitaro.com"
@@ -51,3 +84,149 @@ class TestEmailer(ActionBase):
             except Exception:
                 instance = mock_smtp.return_value
                 self.assertFalse(instance.sendmail.called)
+
+    def test_queue_email_is_delivered_by_worker(self):
+        server = RecordingSMTPServer()
+
+        try:
+            with patch.object(emailer, 'SMTP_SERVER', server.address):
+                response = emailer.queue_email('testContent',
+                                               'test@test.com',
+                                               'testQueuedSubject')
+
+                self.assertTrue(response['success'])
+                self.assertEqual(server.messages, [])
+
+                result = emailer.send_queued_emails()
+        finally:
+            server.stop()
+
+        self.assertEqual(result, {'sent': 1, 'failed': 0})
+        self.assertEqual(server.messages[0][0], ['test@test.com'])
+
+        email = ckanextRequestdataEmailOutbox.get(
+            subject='testQueuedSubject')
+        self.assertEqual(email.state, 'sent')
+        self.assertEqual(email.attempts, 1)
+
+    def test_send_queued_emails_retries_with_backoff(self):
+        emailer.queue_email('testContent', 'test@test.com', 'testRetry')
+
+        with patch("smtplib.SMTP") as mock_smtp:
+            instance = mock_smtp.return_value
+            instance.sendmail.side_effect = \
+                smtplib.SMTPServerDisconnected('Connection lost')
+
+            result = emailer.send_queued_emails()
+
+            self.assertEqual(result, {'sent': 0, 'failed': 1})
+
+            email = ckanextRequestdataEmailOutbox.get(subject='testRetry')
+            self.assertEqual(email.state, 'pending')
+            self.assertEqual(email.attempts, 1)
+            self.assertTrue(email.next_attempt_at > datetime.datetime.now())
+
+            # Not due again until the backoff expires
+            result = emailer.send_queued_emails()
+
+            self.assertEqual(result, {'sent': 0, 'failed': 0})
+
+    def test_send_queued_emails_counts_attempts_and_backs_off(self):
+        emailer.queue_email('testContent', 'test@test.com', 'testBackoff')
+
+        with patch("smtplib.SMTP") as mock_smtp, \
+                patch.object(emailer, 'EMAIL_RETRY_DELAY', 60):
+            instance = mock_smtp.return_value
+            instance.sendmail.side_effect = \
+                smtplib.SMTPServerDisconnected('Connection lost')
+
+            before = datetime.datetime.now()
+            emailer.send_queued_emails()
+
+        email = ckanextRequestdataEmailOutbox.get(subject='testBackoff')
+        self.assertEqual(email.attempts, 1)
+        # The first retry waits the whole configured delay
+        self.assertTrue(email.next_attempt_at >=
+                        before + datetime.timedelta(seconds=60))
+        self.assertTrue(email.next_attempt_at <
+                        before + datetime.timedelta(seconds=90))
+
+    def test_send_queued_emails_gives_up_after_max_attempts(self):
+        emailer.queue_email('testContent', 'test@test.com', 'testGiveUp')
+
+        with patch("smtplib.SMTP") as mock_smtp, \
+                patch.object(emailer, 'EMAIL_MAX_ATTEMPTS', 1):
+            instance = mock_smtp.return_value
+            instance.sendmail.side_effect = \
+                smtplib.SMTPServerDisconnected('Connection lost')
+
+            emailer.send_queued_emails()
+
+        email = ckanextRequestdataEmailOutbox.get(subject='testGiveUp')
+        self.assertEqual(email.state, 'failed')
+        self.assertTrue('Connection lost' in email.last_error)
+
+    def test_send_queued_emails_survives_other_errors(self):
+        emailer.queue_email('testContent', 'test@test.com', 'testBroken')
+        emailer.queue_email('testContent', 'test@test.com', 'testWorking')
+
+        def build_message(content, to, subject, *args):
+            if subject == 'testBroken':
+                raise UnicodeEncodeError('ascii', u'\xe9', 0, 1, 'invalid')
+
+            return 'message'
+
+        with patch.object(emailer, 'build_message', build_message), \
+                patch.object(emailer, 'deliver') as deliver, \
+                patch.object(emailer, 'EMAIL_MAX_ATTEMPTS', 2), \
+                patch.object(emailer, 'EMAIL_RETRY_DELAY', 0):
+            result = emailer.send_queued_emails()
+
+            self.assertEqual(result, {'sent': 1, 'failed': 1})
+            deliver.assert_called_once_with(['test@test.com'], 'message')
+
+            email = ckanextRequestdataEmailOutbox.get(subject='testBroken')
+            self.assertEqual(email.state, 'pending')
+            self.assertTrue('UnicodeEncodeError' in email.last_error)
+
+            result = emailer.send_queued_emails()
+
+            self.assertEqual(result, {'sent': 0, 'failed': 1})
+            email = ckanextRequestdataEmailOutbox.get(subject='testBroken')
+            self.assertEqual(email.state, 'failed')
+            self.assertEqual(email.attempts, 2)
+
+            # Given up on, it isn't claimed again
+            result = emailer.send_queued_emails()
+
+            self.assertEqual(result, {'sent': 0, 'failed': 0})
+
+    def test_deliver_reuses_pooled_connection(self):
+        server = RecordingSMTPServer()
+
+        try:
+            with patch.object(emailer, 'SMTP_SERVER', server.address), \
+                    patch("smtplib.SMTP", wraps=smtplib.SMTP) as mock_smtp:
+                for subject in ['first', 'second']:
+                    msg = emailer.build_message('testContent',
+                                                ['test@test.com'], subject)
+                    emailer.deliver(['test@test.com'], msg)
+
+                self.assertEqual(mock_smtp.call_count, 1)
+        finally:
+            server.stop()
+
+        self.assertEqual(len(server.messages), 2)
+
+    def test_deliver_reconnects_when_disconnected(self):
+        with patch("smtplib.SMTP") as mock_smtp:
+            instance = mock_smtp.return_value
+            instance.sendmail.side_effect = [
+                smtplib.SMTPServerDisconnected('Connection lost'), {}]
+
+            msg = emailer.build_message('testContent', ['test@test.com'],
+                                        'testSubject')
+            emailer.deliver(['test@test.com'], msg)
+
+            self.assertEqual(mock_smtp.call_count, 2)
+            self.assertEqual(instance.sendmail.call_count, 2)
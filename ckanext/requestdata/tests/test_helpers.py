@@ -3,9 +3,10 @@ import nose
 import json
 from datetime import datetime, timedelta
 from ckanext.requestdata import helpers as h
+from ckanext.requestdata import cache
 import ckan.plugins as p
 from ckan.tests import helpers, factories
-from ckan import logic
+from ckan import logic, model
 from ckan.common import request
 
 ok_ = nose.tools.ok_
@@ -56,6 +57,27 @@ class TestHelpers(ActionBase):
         email = 'test_user_05@ckan.org'
         assert_not_equal(email, response)
 
+    def test_convert_id_to_emails_keeps_order_and_unknown_ids(self):
+        cache.maintainer_emails.clear()
+        user1 = factories.User()
+        user2 = factories.User()
+        ids = ','.join([user2['name'], 'unknown', user1['id']])
+
+        response = h.convert_id_to_email(ids)
+
+        eq_(response.split(','), [user2['email'], 'unknown', user1['email']])
+
+    def test_convert_id_to_emails_is_cached(self):
+        cache.maintainer_emails.clear()
+        user = factories.User()
+        email = user['email']
+
+        h.convert_id_to_email(user['id'])
+        model.User.get(user['id']).email = 'changed@example.com'
+        model.repo.commit()
+
+        eq_(h.convert_id_to_email(user['id']), email)
+
     def test_convert_str_to_json_invalid(self):
         str = "test: 123"
         res = h.convert_str_to_json(str)
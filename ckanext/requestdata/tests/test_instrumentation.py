@@ -0,0 +1,91 @@
+from nose.tools import eq_
+
+from ckan import model
+
+from ckanext.requestdata import instrumentation
+
+
+def _action(context, data_dict):
+    for i in range(data_dict['statements']):
+        model.Session.execute('SELECT 1')
+
+    return instrumentation.current()
+
+
+class TestInstrumentation(object):
+    @classmethod
+    def setup_class(self):
+        instrumentation.install(model.meta.engine)
+
+    def test_instrument_action_counts_statements(self):
+        action = instrumentation.instrument_action('requestdata_test',
+                                                   _action)
+
+        stats = action({}, {'statements': 3})
+
+        eq_(stats.statements, 3)
+        eq_(stats.actions['requestdata_test'].statements, 3)
+        assert instrumentation.current() is None
+
+    def test_nested_actions_are_attributed_to_the_innermost(self):
+        inner = instrumentation.instrument_action('requestdata_inner',
+                                                  _action)
+
+        def outer(context, data_dict):
+            model.Session.execute('SELECT 1')
+            inner(context, {'statements': 2})
+
+            return instrumentation.current()
+
+        stats = instrumentation.instrument_action('requestdata_outer',
+                                                  outer)({}, {})
+
+        eq_(stats.statements, 3)
+        eq_(stats.actions['requestdata_outer'].statements, 1)
+        eq_(stats.actions['requestdata_inner'].statements, 2)
+
+    def test_instrument_action_keeps_attributes(self):
+        def action(context, data_dict):
+            pass
+        action.side_effect_free = True
+
+        wrapper = instrumentation.instrument_action('requestdata_test',
+                                                    action)
+
+        assert wrapper.side_effect_free
+
+    def test_middleware_adds_header(self):
+        action = instrumentation.instrument_action('requestdata_test',
+                                                   _action)
+
+        def app(environ, start_response):
+            action({}, {'statements': 2})
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+
+            return ['OK']
+
+        responses = []
+        middleware = instrumentation.QueryStatsMiddleware(app)
+        middleware({'PATH_INFO': '/test'},
+                   lambda status, headers, exc_info=None:
+                   responses.append(dict(headers)))
+
+        header = responses[0][instrumentation.HEADER]
+
+        assert header.startswith('statements=2; time=')
+        assert instrumentation.current() is None
+
+    def test_middleware_skips_other_requests(self):
+        def app(environ, start_response):
+            model.Session.execute('SELECT 1')
+            start_response('200 OK', [])
+
+            return ['OK']
+
+        responses = []
+        middleware = instrumentation.QueryStatsMiddleware(app)
+        middleware({'PATH_INFO': '/dataset'},
+                   lambda status, headers, exc_info=None:
+                   responses.append(dict(headers)))
+
+        assert instrumentation.HEADER not in responses[0]
@@ -0,0 +1,95 @@
+from socket import error as socket_error
+from smtplib import SMTPRecipientsRefused
+
+from nose.tools import eq_, assert_raises
+from mock import patch
+
+from ckanext.requestdata import metrics, cache, emailer
+
+
+class TestMetrics(object):
+
+    def test_counter_renders_each_label_value(self):
+        counter = metrics.Counter('test_total', 'Test counter.', ['event'])
+
+        counter.inc(event='shared')
+        counter.inc(event='created')
+        counter.inc(2, event='created')
+
+        eq_(counter.get(event='created'), 3)
+        eq_(counter.render(), [
+            '# HELP test_total Test counter.',
+            '# TYPE test_total counter',
+            'test_total{event="created"} 3',
+            'test_total{event="shared"} 1'
+        ])
+
+    def test_counter_requires_its_labels(self):
+        counter = metrics.Counter('test_total', 'Test counter.', ['event'])
+
+        assert_raises(ValueError, counter.inc, type='created')
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram('test_seconds', 'Test histogram.',
+                                      buckets=[0.1, 1.0])
+
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5.0)
+
+        eq_(histogram.render(), [
+            '# HELP test_seconds Test histogram.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3'
+        ])
+
+    def test_labels_are_escaped(self):
+        counter = metrics.Counter('test_total', 'Test counter.', ['type'])
+
+        counter.inc(type=u'a "b"\n')
+
+        eq_(counter.render()[-1], 'test_total{type="a \\"b\\"\\n"} 1')
+
+    def test_metric_is_abstract(self):
+        assert_raises(TypeError, metrics.Metric, 'test_total', 'Test.')
+
+    def test_registry_renders_all_metrics(self):
+        registry = metrics.Registry()
+        registry.register(metrics.Counter('a_total', 'A.')).inc()
+        registry.register(metrics.Counter('b_total', 'B.'))
+
+        eq_(registry.render(), '# HELP a_total A.\n# TYPE a_total counter\n'
+                               'a_total 1\n# HELP b_total B.\n'
+                               '# TYPE b_total counter\n')
+
+
+class TestInstrumentedMetrics(object):
+
+    def setup(self):
+        metrics.registry.clear()
+
+    def test_named_cache_counts_hits_and_misses(self):
+        flags = cache.TTLCache(maxsize=10, ttl=30, name='test')
+
+        flags.set('a', True)
+        flags.get('a')
+        flags.get('b')
+
+        eq_(metrics.cache_lookups.get(cache='test', result='hit'), 1)
+        eq_(metrics.cache_lookups.get(cache='test', result='miss'), 1)
+
+    @patch('ckanext.requestdata.emailer._deliver')
+    def test_send_email_counts_failures_by_type(self, deliver):
+        deliver.side_effect = socket_error()
+        emailer.send_email('content', 'to@example.com', 'subject')
+
+        deliver.side_effect = SMTPRecipientsRefused({})
+        emailer.send_email('content', 'to@example.com', 'subject')
+
+        eq_(metrics.email_failures.get(type='socket_error'), 1)
+        eq_(metrics.email_failures.get(type='SMTPRecipientsRefused'), 1)
+        eq_(metrics.email_send_seconds.get()[2], 2)
@@ -1,7 +1,10 @@
 from ckan.tests import helpers, factories
 from ckan import plugins, logic
 import unittest
+import datetime
+from ckan.lib.navl.dictization_functions import validate
 from ckanext.requestdata.logic.validators import *
+from ckanext.requestdata.logic.schema import request_export_schema
 
 
 class ActionBase(unittest.TestCase):
@@ -51,6 +54,15 @@ class TestAuth(ActionBase):
         else:
             assert False
 
+    def test_archive_order_validator(self):
+        key = ('order_by')
+        errors = {key: []}
+        archive_order_validator(key, {key: 'title'}, errors, None)
+        assert len(errors[key]) == 0
+
+        archive_order_validator(key, {key: 'package_id'}, errors, None)
+        assert len(errors[key]) == 1
+
     def test_state_validator_in_possible_state(self):
         key = ('state')
         data = {('state'): 'new'}
@@ -167,3 +179,29 @@ class TestAuth(ActionBase):
             assert True
         else:
             assert False
+
+    def test_request_export_schema_format(self):
+        data, errors = validate({}, request_export_schema())
+        assert data['format'] == 'csv'
+
+        data, errors = validate({'format': 'jsonl', 'org_id': 'json-team'},
+                                request_export_schema())
+        assert data['format'] == 'jsonl'
+        assert not errors
+
+        data, errors = validate({'format': 'csv-team'},
+                                request_export_schema())
+        assert 'format' in errors
+
+    def test_end_of_day_validator(self):
+        key = ('created_before')
+        errors = {key: []}
+        data = {key: '2018-03-31'}
+        end_of_day_validator(key, data, errors, None)
+        assert data[key] == datetime.datetime(2018, 3, 31, 23, 59, 59,
+                                              999999)
+
+        data = {key: '2018-03-31T12:00:00'}
+        end_of_day_validator(key, data, errors, None)
+        assert data[key] == '2018-03-31T12:00:00'
+        assert len(errors[key]) == 0
@@ -86,6 +86,9 @@ setup(
         [ckan.plugins]
         requestdata=ckanext.requestdata.plugin:RequestdataPlugin
 
+        [paste.paster_command]
+        requestdata=ckanext.requestdata.commands:RequestdataCommand
+
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan
     ''',